@@ -67,7 +67,7 @@ logging.getLogger("requests").setLevel(logging.WARNING)
 sys.path.append(
     os.path.normpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'packages')))
 
-import saf.app, saf.repo, saf.tx
+import saf.agent, saf.app, saf.exporter, saf.repo, saf.tx
 from . import safutils
 from saf.exceptions import *
 
@@ -79,6 +79,9 @@ time_format = '%Y-%m-%d %H:%M:%S'
 # The main config dictionary (built from configfile, saf.conf by default)
 config = None
 
+# The name of the file config has been read from
+config_file = None
+
 # Temp directory for overlaying and other stuff
 temp_dir = None
 
@@ -86,7 +89,7 @@ temp_dir = None
 @safutils.method_trace
 def init(conf_file=None):
     # https://stackoverflow.com/questions/1977362/how-to-create-module-wide-variables-in-python#1978076
-    global config, temp_dir
+    global config, config_file, temp_dir
     if config is not None:
         return
     else:
@@ -107,6 +110,7 @@ def init(conf_file=None):
         except IOError as e:
             raise SafInitException('Cannot open config file %s: %s' % (conf_file, e))
         config.read(conf_file)
+        config_file = conf_file
         logger.debug('config._sections():%s' % config._sections)
         config_dict = {}
         for section in config.sections():
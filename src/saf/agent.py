@@ -0,0 +1,191 @@
+# ATTENTION! File managed by Puppet. Changes will be overwritten.
+
+""" SAF agent
+A long running process which answers read-only saf commands over a local unix socket. It keeps
+the configuration, parsed app metadata and a recent process table snapshot in memory so that
+frequent calls (e.g. by monitoring) do not pay for interpreter start, imports and host scans.
+
+Protocol: the client sends one JSON line {"argv": [...]}. The agent answers with JSON lines,
+either a single {"fallback": reason} if the client should run the command itself, or any number of
+{"level": levelno, "msg": message} lines followed by a final {"rc": rc}.
+"""
+
+import SocketServer
+import errno
+import json
+import os
+import socket
+import sys
+import threading
+
+import saf
+import saf.app
+
+from . import safutils
+
+from saf.exceptions import *
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# (object, action) pairs which are answered by the agent. Everything else either changes state,
+# needs the caller's terminal (knowhow prompts) or runs forever, and is executed by the client
+SERVED_COMMANDS = [('app', 'ls'), ('app', 'status'), ('app', 'ps'), ('app', 'pinfo'),
+                   ('app', 'check'), ('tx', 'ls'), ('tx', 'info'), ('tx', 'diff')]
+
+
+@safutils.method_trace
+def default_socket_name():
+    return os.getenv('SAF_AGENT_SOCKET', os.path.join(saf.base_path, 'var', 'saf-agent.sock'))
+
+
+class _SocketLogHandler(logging.Handler):
+    """ Send log records of the current command to the client """
+
+    def __init__(self, stream):
+        logging.Handler.__init__(self, logging.INFO)
+        self._stream = stream
+
+    def emit(self, record):
+        try:
+            self._stream.write('%s\n' % json.dumps({'level': record.levelno,
+                                                     'msg': record.getMessage()}))
+            self._stream.flush()
+        except (IOError, socket.error):
+            # client went away, the command still runs to its end
+            pass
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+
+    def _send(self, message):
+        self.wfile.write('%s\n' % json.dumps(message))
+        self.wfile.flush()
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # probe connection, e.g. by _remove_stale_socket()
+            return
+        try:
+            request = json.loads(line)
+            argv = [str(arg) for arg in request['argv']]
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warn('invalid agent request: %s' % e)
+            return
+
+        try:
+            args, arg_list = self.server.parse_command(argv)
+        except SystemExit:
+            # argparse errors and -h are printed by the client itself
+            self._send({'fallback': 'cannot parse command'})
+            return
+
+        if (args.object, getattr(args, 'action', None)) not in SERVED_COMMANDS:
+            self._send({'fallback': 'command not served by agent'})
+            return
+        if args.debug:
+            self._send({'fallback': 'debug output requested'})
+            return
+        if self.server.config_file_name(args) != self.server.conf_file:
+            self._send({'fallback': 'agent uses different config file'})
+            return
+
+        with self.server.command_lock:
+            handler = _SocketLogHandler(self.wfile)
+            logging.getLogger().addHandler(handler)
+            try:
+                rc = self.server.execute_command(args, arg_list)
+            except Exception as e:
+                logger.exception(e)
+                rc = 1
+            finally:
+                logging.getLogger().removeHandler(handler)
+        try:
+            self._send({'rc': rc})
+        except (IOError, socket.error) as e:
+            logger.debug('cannot send rc: %s' % e)
+
+
+class _AgentServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_name, conf_file, parse_command, execute_command,
+                 config_file_name):
+        self.conf_file = conf_file
+        self.parse_command = parse_command
+        self.execute_command = execute_command
+        self.config_file_name = config_file_name
+        # commands share module state (caches, log handlers), run them one at a time
+        self.command_lock = threading.Lock()
+        SocketServer.UnixStreamServer.__init__(self, socket_name, _RequestHandler)
+
+
+@safutils.method_trace
+def _remove_stale_socket(socket_name):
+    if not os.path.exists(socket_name):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_name)
+        raise SafExecutionException('Agent already running on %s' % socket_name)
+    except socket.error as e:
+        if e.errno not in [errno.ECONNREFUSED, errno.ENOENT]:
+            raise SafExecutionException('Cannot use agent socket %s: %s' % (socket_name, e))
+        logger.debug('removing stale socket %s' % socket_name)
+        os.remove(socket_name)
+    finally:
+        probe.close()
+
+
+@safutils.method_trace
+def serve(conf_file, parse_command, execute_command, config_file_name, socket_name=None):
+    """
+    Answer saf commands on a unix socket until interrupted
+    :param conf_file: The absolute name of the config file which was used for saf.init()
+    :param parse_command: Function taking an argv list and returning (args, arg_list). Raises
+        SystemExit like argparse on invalid input
+    :param execute_command: Function taking (args, arg_list) and returning the rc
+    :param config_file_name: Function returning the absolute config file name for parsed args
+    :param socket_name: The socket to listen on. Defaults to var/saf-agent.sock in the saf base
+        path or $SAF_AGENT_SOCKET
+    """
+    if socket_name is None:
+        socket_name = default_socket_name()
+    try:
+        saf.app.process_table_max_age = float(saf.config.get('agent.process_table.max_age', 2))
+    except ValueError as e:
+        raise SafConfigException('invalid agent.process_table.max_age: %s' % e)
+
+    socket_dir = os.path.dirname(socket_name)
+    if not os.path.isdir(socket_dir):
+        os.makedirs(socket_dir, mode=0o755)
+    _remove_stale_socket(socket_name)
+
+    # only the user running the agent may connect
+    old_umask = os.umask(0o077)
+    try:
+        server = _AgentServer(socket_name, conf_file, parse_command, execute_command,
+                              config_file_name)
+    finally:
+        os.umask(old_umask)
+
+    logger.info('saf agent listening on %s' % socket_name)
+
+    # command output is sent to the clients and must not show up on the agent console
+    for handler in list(logging.getLogger().handlers):
+        if getattr(handler, 'stream', None) == sys.stdout:
+            logging.getLogger().removeHandler(handler)
+
+    safutils.interrupt_on_sigterm()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.debug('KeyboardInterrupt')
+    finally:
+        server.server_close()
+        if os.path.exists(socket_name):
+            os.remove(socket_name)
+        logger.info('saf agent stopped')
+    return 0
@@ -1,10 +1,18 @@
 # ATTENTION! File managed by Puppet. Changes will be overwritten.
 
+import Queue
+import collections
+import errno
+import fcntl
 import getpass
+import json
+import multiprocessing
 import os
 import subprocess
+import sys
 
 import re
+import select
 import shlex
 import socket
 import sre_constants
@@ -16,6 +24,8 @@ import resource
 
 import datetime
 
+from multiprocessing.pool import ThreadPool
+
 import saf
 import saf.tx
 import saf.safutils
@@ -37,24 +47,156 @@ except ImportError as e:
     raise SafExecutionException(e)
 
 
+class ProcessTable(object):
+    """ Snapshot of the process table of the host. The table is read with a single pass over all
+        processes so that any number of Application objects can look up their PIDs without
+        rescanning the host. The host is only scanned when the table is used for the first time,
+        apps which are found through their cgroup do not need it. A snapshot does not change once
+        it has been read, create a new one to see new processes """
+
+    @safutils.method_trace
+    def __init__(self):
+        self.create_time = time.time()
+        self._processes = None
+        self._cmdlines = None
+        self._children = None
+        self._lock = threading.Lock()
+
+    @safutils.method_trace
+    def _load(self):
+        with self._lock:
+            if self._processes is not None:
+                return
+            processes = dict()
+            cmdlines = dict()
+            children = dict()
+            for process in psutil.process_iter(attrs=['pid', 'ppid', 'cmdline', 'create_time']):
+                process_info = process.info
+                processes[process_info['pid']] = process_info
+                if process_info['cmdline'] is not None:
+                    cmdlines[process_info['pid']] = ' '.join(process_info['cmdline'])
+                children.setdefault(process_info['ppid'], []).append(process_info['pid'])
+            logger.debug('processes:%s' % len(processes))
+            self._cmdlines = cmdlines
+            self._children = children
+            self._processes = processes
+
+    def __contains__(self, pid):
+        self._load()
+        return pid in self._processes
+
+    def pids(self):
+        self._load()
+        return sorted(self._processes.keys())
+
+    def ppid(self, pid):
+        self._load()
+        return self._processes[pid]['ppid']
+
+    def cmdline(self, pid):
+        self._load()
+        return self._processes[pid]['cmdline']
+
+    def process_create_time(self, pid):
+        self._load()
+        return self._processes[pid]['create_time']
+
+    @safutils.method_trace
+    def children(self, pid, recursive=True):
+        self._load()
+        result = []
+        pending = list(self._children.get(pid, []))
+        while len(pending) > 0:
+            child = pending.pop(0)
+            # pid 0 is its own parent on some platforms
+            if child == pid or child in result:
+                continue
+            result.append(child)
+            if recursive:
+                pending.extend(self._children.get(child, []))
+        return result
+
+    @safutils.method_trace
+    def match(self, pattern):
+        """ Return the pids of all processes whose space-joined cmdline matches pattern """
+        self._load()
+        return sorted([pid for pid, cmdline in self._cmdlines.items() if
+                       re.search(pattern, cmdline)])
+
+
+# Seconds after which app ls rescans the whole app directory. Logs and other files which grow in
+# place are not noticed by the size index before
+app_size_max_age = 300
+
+# Seconds a ProcessTable may be reused by get_process_table(). Only long running processes like
+# the saf agent set this, commands of a single saf invocation always read a new snapshot
+process_table_max_age = 0
+
+_last_process_table = None
+
+# Serializes launching apps. A preexec_fn is not safe while other threads fork at the same time
+_launch_lock = threading.Lock()
+
+
+@safutils.method_trace
+def get_process_table():
+    """ Return a ProcessTable for read-only commands. The snapshot is reused for
+    process_table_max_age seconds """
+    global _last_process_table
+    process_table = _last_process_table
+    if process_table is None or time.time() - process_table.create_time > process_table_max_age:
+        process_table = ProcessTable()
+        if process_table_max_age > 0:
+            _last_process_table = process_table
+    return process_table
+
+
 class Application(safutils.IKnowhow):
     #TODO use python @property annotation for all property-like features (e.g. pids, is_running...)
     @safutils.method_trace
-    def _run_app(self):
-        """ run a SAF app """
+    def _run_app(self, env, limits, cgroup_procs=None):
+        """ run a SAF app
+        :param env: The complete environment of the app process
+        :param limits: List of (resource, soft limit) tuples which are applied to the app process
+        :param cgroup_procs: Optional cgroup.procs file which the app process joins before exec
+        """
 
         # http://stackoverflow.com/questions/1191374/using-module-subprocess-with-timeout#4825933
         class AppRunner(object):
 
             @safutils.method_trace
-            def __init__(self, app):
+            def __init__(self, app, env, limits, cgroup_procs):
                 self.app = app
+                self.env = env
+                self.limits = limits
+                self.cgroup_procs = cgroup_procs
                 self.pidfile = app.pidfile()
                 self.timeout = app.start_timeout()
                 self.rc = 0
+                self.error = None
+
+            @safutils.method_trace
+            def pidfile_complete(self):
+                """ True if the pidfile exists and contains a pid. Daemons might create the file
+                before writing to it """
+                try:
+                    with open(self.pidfile) as pidfile:
+                        int(pidfile.read())
+                    return True
+                except (IOError, ValueError):
+                    return False
 
             @safutils.method_trace
             def do_command(self):
+                # the launcher thread writes to this pipe when the launcher terminates. This lets
+                # the main thread wait for launcher exit and pidfile creation at the same time
+                exit_pipe_r, exit_pipe_w = os.pipe()
+                # neither the app nor apps started concurrently may inherit the pipe, an open
+                # write end would hide the launcher exit
+                for fd in [exit_pipe_r, exit_pipe_w]:
+                    fcntl.fcntl(fd, fcntl.F_SETFD,
+                                fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
                 @safutils.method_trace
                 def run_the_app():
                     logger.debug('self.app:%s' % self.app)
@@ -68,63 +210,138 @@ class Application(safutils.IKnowhow):
                     # logWrap = LoggerWrapper(app_logger, logging.INFO)
                     # self.rc = subprocess.call(self.cmd, cwd=self.path, stdout=logWrap, stderr=logWrap)
 
-                    out_file = open(os.path.join(self.app.basedir, 'log/startup.log'), 'a')
-                    out_file.write(
-                        '----- %s ----- application start -----\n' % datetime.datetime.now().strftime(
-                            saf.time_format))
-
-                    self.rc = subprocess.call(self.app.launch_command(), cwd=self.app.basedir,
-                                              stdout=out_file, stderr=out_file)
-
-                    logger.debug('app finished rc:%s' % self.rc)
+                    try:
+                        out_file = open(os.path.join(self.app.basedir, 'log/startup.log'), 'a')
+                        out_file.write(
+                            '----- %s ----- application start -----\n' % datetime.datetime.now().strftime(
+                                saf.time_format))
+
+                        # limits are applied in the child only so that apps which are started
+                        # concurrently do not influence each other
+                        def prepare_process():
+                            for limit, soft_limit in self.limits:
+                                resource.setrlimit(limit,
+                                                   (soft_limit, resource.getrlimit(limit)[1]))
+                            # everything the app forks from now on stays in its cgroup
+                            if self.cgroup_procs is not None:
+                                with open(self.cgroup_procs, 'w') as procs:
+                                    procs.write(str(os.getpid()))
+
+                        with _launch_lock:
+                            process = subprocess.Popen(self.app.launch_command(),
+                                                       cwd=self.app.basedir, stdout=out_file,
+                                                       stderr=out_file, env=self.env,
+                                                       close_fds=True, preexec_fn=prepare_process)
+                        out_file.close()
+                        self.rc = process.wait()
+                        logger.debug('app finished rc:%s' % self.rc)
+                    except Exception as e:
+                        self.error = e
+                    finally:
+                        try:
+                            os.write(exit_pipe_w, 'x')
+                            os.close(exit_pipe_w)
+                        except OSError as e:
+                            logger.debug('cannot signal launcher exit: %s' % e)
 
                 app_thread = threading.Thread(target=run_the_app)
                 app_thread.daemon = True
                 app_thread.start()
 
-                if self.pidfile is None:
-                    logger.debug('waiting for app_thread')
-                    app_thread.join(self.timeout)
-                    if not app_thread.is_alive():
-                        if self.rc == 0:
-                            logger.warning(
-                                'application exited with rc=0. This is not the expected behaviour. If your application daemonizes then please change its app.conf to use launcher.daemon.pidfile instead of process.regex')
-                        else:
+                try:
+                    if self.pidfile is None:
+                        logger.debug('waiting for app_thread')
+                        app_thread.join(self.timeout)
+                        if self.error is not None:
                             raise SafExecutionException(
-                                'application exited with rc=%s. See %s for details' % (
-                                    self.rc, os.path.join(self.app.basedir, 'log/startup.log')))
-                else:
-                    app_thread.join(5)
-                    if not app_thread.is_alive():
-                        logger.debug('daemon dead')
-                        if self.rc != 0:
+                                'could not launch application: %s' % self.error)
+                        if not app_thread.is_alive():
+                            if self.rc == 0:
+                                logger.warning(
+                                    'application exited with rc=0. This is not the expected behaviour. If your application daemonizes then please change its app.conf to use launcher.daemon.pidfile instead of process.regex')
+                            else:
+                                raise SafExecutionException(
+                                    'application exited with rc=%s. See %s for details' % (
+                                        self.rc, os.path.join(self.app.basedir, 'log/startup.log')))
+                    else:
+                        self.wait_for_daemon(exit_pipe_r)
+                finally:
+                    os.close(exit_pipe_r)
+
+            @safutils.method_trace
+            def wait_for_daemon(self, exit_pipe_r):
+                """ Wait until the daemon has written its pidfile or the launcher failed. Uses
+                inotify on the pidfile directory if possible and falls back to polling """
+                watcher = None
+                try:
+                    watcher = safutils.Inotify()
+                    watcher.add_watch(os.path.dirname(self.pidfile),
+                                      safutils.Inotify.IN_CREATE | safutils.Inotify.IN_CLOSE_WRITE |
+                                      safutils.Inotify.IN_MOVED_TO | safutils.Inotify.IN_MODIFY)
+                except SafExecutionException as e:
+                    logger.debug('falling back to polling for pidfile: %s' % e)
+                    if watcher is not None:
+                        watcher.close()
+                        watcher = None
+
+                try:
+                    launcher_alive = True
+                    deadline = time.time() + self.timeout
+                    while not self.pidfile_complete():
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
                             raise SafExecutionException(
-                                'daemon exited with rc=%s. See %s for details' % (
-                                    self.rc, os.path.join(self.app.basedir, 'log/startup.log')))
-                    pidfile_exists = False
-                    now = time.time()
-                    while time.time() - now < self.timeout:
-                        if os.path.isfile(self.pidfile):
-                            pidfile_exists = True
-                            break
-                        time.sleep(0.3)
-                    if pidfile_exists:
+                                'daemon did not create a pidfile %s in time' % self.pidfile)
+                        wait_for = []
+                        if launcher_alive:
+                            wait_for.append(exit_pipe_r)
+                        if watcher is None:
+                            remaining = min(remaining, 0.3)
+                        else:
+                            wait_for.append(watcher)
                         try:
-                            self.app.is_running()
-                        except Exception as e:
-                            raise e
-                    else:
-                        raise SafExecutionException(
-                            'daemon did not create a pidfile %s in time' % self.pidfile)
+                            readable = select.select(wait_for, [], [], remaining)[0]
+                        except select.error as e:
+                            if e.args[0] == errno.EINTR:
+                                continue
+                            raise
+                        if exit_pipe_r in readable:
+                            os.read(exit_pipe_r, 1)
+                            launcher_alive = False
+                            logger.debug('launcher terminated')
+                            if self.error is not None:
+                                raise SafExecutionException(
+                                    'could not launch daemon: %s' % self.error)
+                            if self.rc != 0:
+                                raise SafExecutionException(
+                                    'daemon exited with rc=%s. See %s for details' % (
+                                        self.rc, os.path.join(self.app.basedir, 'log/startup.log')))
+                        if watcher in readable:
+                            logger.debug('events:%s' % watcher.read_events(0))
+                finally:
+                    if watcher is not None:
+                        watcher.close()
+
+                # the daemon was started after any shared snapshot has been taken
+                if not self.app.is_running(process_table=ProcessTable()):
+                    raise SafExecutionException(
+                        'daemon wrote pidfile %s but is not running. See %s for details' % (
+                            self.pidfile, os.path.join(self.app.basedir, 'log/startup.log')))
 
-        AppRunner(self).do_command()
+        AppRunner(self, env, limits, cgroup_procs).do_command()
 
     @safutils.method_trace
-    def __init__(self, name):
+    def __init__(self, name, process_table=None):
+        """
+        :param name: The name of the app
+        :param process_table: Optional ProcessTable which is shared with other Application objects
+            of the same command. If None then every PID lookup scans the process table
+        """
         self.basedir = os.path.join(saf.config['basedir'], 'apps', name)
         self.name = name
+        self.process_table = process_table
 
-        self._config = safutils.parse_kv_file('%s.conf' % self.basedir)
+        self._config = safutils.parse_kv_file_cached('%s.conf' % self.basedir)
 
         self._knowhow = dict([(key, self._config[key]) for key in self._config.keys() if
                               key.startswith('knowhow.app')])
@@ -135,7 +352,7 @@ class Application(safutils.IKnowhow):
         app_meta_file = '%s.meta' % self.basedir
         logger.debug('app_meta_file:%s' % app_meta_file)
         try:
-            self.meta = safutils.parse_kv_file(app_meta_file)
+            self.meta = safutils.parse_kv_file_cached(app_meta_file)
             # "pre-versioning saf2" uses partly different meta prop names. Remove this as soon
             # legacy saf (bash code) is gone
             if 'version' in self.meta.keys():
@@ -159,22 +376,25 @@ class Application(safutils.IKnowhow):
 
         safutils.assert_knowhow(self, 'knowhow.app.start', iknow)
 
+        limits = []
         if self.maxfiles() is not None:
             current_nofile = resource.getrlimit(resource.RLIMIT_NOFILE)
             if current_nofile[0] != self.maxfiles():
                 logger.debug(
                     'setting nofile(soft) from %s to %s' % (current_nofile[0], self.maxfiles()))
-                resource.setrlimit(resource.RLIMIT_NOFILE, (self.maxfiles(), current_nofile[1]))
+                limits.append((resource.RLIMIT_NOFILE, self.maxfiles()))
 
         if self.maxprocs() is not None:
             current_noproc = resource.getrlimit(resource.RLIMIT_NPROC)
             if current_noproc[0] != self.maxprocs():
                 logger.debug(
                     'setting noproc(soft) from %s to %s' % (current_noproc[0], self.maxprocs()))
-                resource.setrlimit(resource.RLIMIT_NPROC, (self.maxprocs(), current_noproc[1]))
+                limits.append((resource.RLIMIT_NPROC, self.maxprocs()))
 
+        # do not modify os.environ, other apps might be started concurrently
+        env = dict(os.environ)
         for env_entry in self.env_entries():
-            os.environ[env_entry[0]] = env_entry[1]
+            env[env_entry[0]] = env_entry[1]
 
         try:
             if not os.path.exists(os.path.join(self.basedir, 'log')):
@@ -182,52 +402,136 @@ class Application(safutils.IKnowhow):
         except OSError as e:
             raise SafExecutionException('Cannot create application log directory: %s' % e)
 
-        self._run_app()
+        self._run_app(env, limits, self._prepare_cgroup())
 
     @safutils.method_trace
-    def stop(self, iknow):
-        @safutils.method_trace
-        def on_terminate(proc):
-            logger.debug('pid %s ended after SIGTERM' % proc.pid)
-
-        @safutils.method_trace
-        def on_kill(proc):
-            logger.debug('pid %s ended after SIGKILL' % proc.pid)
+    def _prepare_cgroup(self):
+        """ Create the cgroup of the app if cgroups are used
+        :return: The cgroup.procs file the app process has to join or None
+        """
+        cgroup = self.cgroup()
+        if cgroup is None:
+            return None
+        if not os.path.isfile(os.path.join(saf.config['cgroup.root'], 'cgroup.procs')):
+            logger.warn('cgroup.root %s is no cgroup v2 directory, not using a cgroup for %s' % (
+                saf.config['cgroup.root'], self.name))
+            return None
+        try:
+            os.mkdir(cgroup, 0o0755)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                logger.warn('cannot create cgroup %s, not using a cgroup for %s: %s' % (
+                    cgroup, self.name, e))
+                return None
+        return os.path.join(cgroup, 'cgroup.procs')
 
-        timeout = self.stop_timeout()
+    @safutils.method_trace
+    def _remove_cgroup(self):
+        """ Remove the (empty) cgroup of the app including any cgroups the app created below it """
+        cgroup = self.cgroup()
+        if cgroup is None or not os.path.isdir(cgroup):
+            return
+        for dir_name, sub_dirs, file_names in os.walk(cgroup, topdown=False):
+            try:
+                os.rmdir(dir_name)
+            except OSError as e:
+                # e.g. EBUSY if a process has been forked in the meantime
+                logger.warn('cannot remove cgroup %s: %s' % (dir_name, e))
+                return
 
+    @safutils.method_trace
+    def stop(self, iknow):
         if not self.is_running():
             raise SafExecutionException('%s not running' % self.name)
 
         safutils.assert_knowhow(self, 'knowhow.app.stop', iknow)
 
-        proc_list = [psutil.Process(pid) for pid in self.pids()]
+        result, seconds, detail = _terminate_apps([self])[self.name]
+        if result == 'FAIL':
+            raise SafExecutionException('Could not end %s (%s)' % (self.name, detail))
+
+    @safutils.method_trace
+    def _kill(self, proc_list):
+        """ Send SIGKILL to the (remaining) processes of the app """
         for proc in proc_list:
-            logger.debug('terminating pid %s, cmdline "%s"' % (proc.pid, proc.cmdline()))
-            proc.terminate()
-        gone, still_alive = psutil.wait_procs(proc_list, timeout=timeout, callback=on_terminate)
-        logger.debug('gone (after SIGTERM) %s ...' % gone)
-        logger.debug('still_alive (after SIGTERM) %s ...' % still_alive)
-        if len(still_alive) > 0:
-            for proc in still_alive:
-                logger.warn('forcefully killing pid %s (cmdline "%s")' % (proc.pid, ' '.join(
-                    proc.cmdline())))
-                proc.kill()
-            gone, still_alive = psutil.wait_procs(proc_list, timeout=timeout, callback=on_kill)
-            logger.debug('gone (after SIGKILL) %s ...' % gone)
-            logger.debug('still_alive (after SIGKILL) %s ...' % still_alive)
-        if len(still_alive) > 0:
-            pid_list = [str(proc.pid) for proc in still_alive]
-            raise SafExecutionException(
-                'Could not end %s (PID(s) %s)' % (self.name, ','.join(pid_list)))
+            logger.warn('forcefully killing pid %s of %s' % (proc.pid, self.name))
+        cgroup_kill = None
+        if len(self.cgroup_pids()) > 0:
+            cgroup_kill = os.path.join(self.cgroup(), 'cgroup.kill')
+        if cgroup_kill is not None and os.path.isfile(cgroup_kill):
+            # also catches processes forked after the pids have been read
+            with open(cgroup_kill, 'w') as kill_file:
+                kill_file.write('1')
         else:
-            if self.daemonizes():
-                if os.path.exists(self.pidfile()):
-                    os.remove(self.pidfile())
+            for proc in proc_list:
+                try:
+                    proc.kill()
+                except psutil.NoSuchProcess as e:
+                    logger.debug('pid %s ended before SIGKILL: %s' % (proc.pid, e))
 
     @safutils.method_trace
-    def pids(self, recursive=True):
-        procs = []
+    def _cleanup_after_stop(self):
+        if self.daemonizes():
+            if os.path.exists(self.pidfile()):
+                os.remove(self.pidfile())
+        self._remove_cgroup()
+
+    @safutils.method_trace
+    def cgroup(self):
+        """ The cgroup v2 directory of the app or None if the app is not placed in a cgroup. Apps
+        get their own cgroup below cgroup.root (saf.conf) unless process.cgroup=false """
+        result = None
+        if 'cgroup.root' in saf.config.keys():
+            use_cgroup = self._config.get('process.cgroup', 'true').lower()
+            if use_cgroup not in ['true', 'false']:
+                raise SafConfigException(
+                    'invalid process.cgroup: must be true or false, found %s' % use_cgroup)
+            if use_cgroup == 'true':
+                result = os.path.join(saf.config['cgroup.root'], self.name)
+        logger.debug('result:%s' % result)
+        return result
+
+    @safutils.method_trace
+    def cgroup_pids(self):
+        """ The PIDs of all processes in the cgroup of the app (including nested cgroups). Empty if
+        the app has no cgroup, e.g. because it has been started before cgroups were enabled """
+        result = []
+        cgroup = self.cgroup()
+        if cgroup is None or not os.path.isdir(cgroup):
+            return result
+        for dir_name, sub_dirs, file_names in os.walk(cgroup):
+            try:
+                with open(os.path.join(dir_name, 'cgroup.procs')) as procs:
+                    result.extend([int(pid) for pid in procs.read().split()])
+            except IOError as e:
+                # nested cgroup removed while walking
+                if e.errno != errno.ENOENT:
+                    raise SafExecutionException('Could not read cgroup %s: %s' % (dir_name, e))
+        result = sorted(set(result))
+        logger.debug('result:%s' % result)
+        return result
+
+    @safutils.method_trace
+    def pids(self, recursive=True, process_table=None):
+        # the cgroup contains exactly the app processes, no matter how they have been forked,
+        # re-parented or renamed. Reading it does not depend on the number of host processes
+        cgroup_pids = self.cgroup_pids()
+
+        if process_table is None:
+            process_table = self.process_table
+        if len(cgroup_pids) > 0:
+            if recursive:
+                return cgroup_pids
+            if process_table is None:
+                process_table = ProcessTable()
+            pids = [pid for pid in cgroup_pids if
+                    pid not in process_table or process_table.ppid(pid) not in cgroup_pids]
+            logger.debug('pids:%s' % pids)
+            return pids
+        if process_table is None:
+            process_table = ProcessTable()
+
+        pids = []
         if self.daemonizes():
             pidfile_name = self.pidfile()
 
@@ -238,12 +542,23 @@ class Application(safutils.IKnowhow):
                     pidfile.close()
                     daemon_pid = int(content)
                     logger.debug('daemon_pid:%s' % daemon_pid)
-                    try:
-                        procs.append(psutil.Process(daemon_pid))
+                    if daemon_pid in process_table:
+                        pids.append(daemon_pid)
+                        if recursive:
+                            pids.extend(process_table.children(daemon_pid))
+                    elif psutil.pid_exists(daemon_pid):
+                        # started after the snapshot was taken
+                        logger.debug('daemon_pid %s not in process table' % daemon_pid)
+                        pids.append(daemon_pid)
                         if recursive:
-                            procs.extend(procs[0].children(recursive=True))
-                    except psutil.NoSuchProcess as e:
-                        logger.warn('Removing stale pidfile %s: %s' % (pidfile_name, e))
+                            try:
+                                pids.extend([child.pid for child in psutil.Process(
+                                    daemon_pid).children(recursive=True)])
+                            except psutil.NoSuchProcess as e:
+                                logger.debug('daemon_pid %s vanished: %s' % (daemon_pid, e))
+                    else:
+                        logger.warn('Removing stale pidfile %s: no process with pid %s' % (
+                            pidfile_name, daemon_pid))
                         os.remove(pidfile_name)
                 except IOError as e:
                     raise SafExecutionException('Could not open pidfile %s: %s' % (pidfile_name, e))
@@ -259,26 +574,19 @@ class Application(safutils.IKnowhow):
             except sre_constants.error as e:
                 raise SafConfigException(
                     'Invalid regular expression "%s": %s' % (self._config['process.regex'], e))
-            master_procs = []
-            for process in psutil.process_iter():
-                process_info = process.as_dict(attrs=['pid', 'cmdline'])
-                if process_info['cmdline'] is not None:
-                    if re.search(pattern, ' '.join(process_info['cmdline'])):
-                        master_procs.append(process)
-            logger.debug('master_pids:%s' % [proc.pid for proc in master_procs])
-            if recursive:
-                for master_proc in master_procs:
-                    procs.append(master_proc)
-                    procs.extend(master_proc.children(recursive=True))
-            else:
-                procs = master_procs
-        pids = sorted([proc.pid for proc in procs])
+            master_pids = process_table.match(pattern)
+            logger.debug('master_pids:%s' % master_pids)
+            for master_pid in master_pids:
+                pids.append(master_pid)
+                if recursive:
+                    pids.extend(process_table.children(master_pid))
+        pids = sorted(set(pids))
         logger.debug('pids:%s' % pids)
         return pids
 
     @safutils.method_trace
-    def is_running(self):
-        return len(self.pids()) > 0
+    def is_running(self, process_table=None):
+        return len(self.pids(process_table=process_table)) > 0
 
     @safutils.method_trace
     def launch_command(self):
@@ -305,6 +613,15 @@ class Application(safutils.IKnowhow):
         logger.debug('command:%s' % command)
         return command
 
+    @safutils.method_trace
+    def depends(self):
+        """ Return the names of the apps which have to run before this app can be started """
+        result = self._config.get('depends', '').replace(',', ' ').split()
+        if self.name in result:
+            raise SafConfigException('app %s cannot depend on itself' % self.name)
+        logger.debug('result:%s' % result)
+        return result
+
     @safutils.method_trace
     def maxfiles(self):
         result = None
@@ -415,7 +732,7 @@ class Application(safutils.IKnowhow):
                 raise SafConfigException('invalid check.%s.port: %s' % (check_name, e))
             if path[0] != '/':
                 raise SafConfigException('check.%s.path needs to start with "/"' % check_name)
-            result = '%s://%s:%s%s' % (method, socket.getfqdn(), port, path)
+            result = '%s://%s:%s%s' % (method, _get_fqdn(), port, path)
         elif 'check.%s.url' % check_name in self._config.keys():
             result = self._config['check.%s.url' % check_name]
         else:
@@ -433,11 +750,53 @@ class Application(safutils.IKnowhow):
             raise SafConfigException('must specify "success" literal for check %s' % name)
         return self._config['check.%s.success' % name]
 
+    @safutils.method_trace
+    def check_timeout(self, name):
+        """ Seconds to wait for the connection and for the response of check name """
+        if name not in self.check_names():
+            raise SafConfigException('No check named "%s"' % name)
+        result = 10
+        param_name = 'check.%s.timeout' % name
+        if param_name in self._config.keys():
+            try:
+                val = int(self._config[param_name])
+                if val < 1 or val > 180:
+                    raise ValueError('allowable range is 1..180')
+                result = val
+            except ValueError as e:
+                raise SafConfigException('invalid %s: %s' % (param_name, e))
+        logger.debug('result:%s' % result)
+        return result
+
+    @safutils.method_trace
+    def checks(self):
+        """ Return a list of dicts describing the configured checks, ready for _run_checks() """
+        result = []
+        for check_name in self.check_names():
+            result.append({'app': self.name,
+                           'name': check_name,
+                           'url': self.check_url(check_name),
+                           'pattern': self.check_success_pattern(check_name),
+                           'timeout': self.check_timeout(check_name)})
+        return result
+
     @safutils.method_trace
     def knowhow(self):
         return safutils.ImmutableDict(self._knowhow)
 
 
+_fqdn = None
+
+
+@safutils.method_trace
+def _get_fqdn():
+    """ socket.getfqdn() can be slow (DNS), so only resolve it once per process """
+    global _fqdn
+    if _fqdn is None:
+        _fqdn = socket.getfqdn()
+    return _fqdn
+
+
 @safutils.method_trace
 def get_all_app_names():
     app_names = []
@@ -452,13 +811,13 @@ def get_all_app_names():
 
 @safutils.method_trace
 def _get_bootstart_app_names():
-    app_names = get_all_app_names()
+    app_names = []
     apps_dir = os.path.join(saf.config['basedir'], 'apps')
 
-    for app_name in app_names:
-        app_config = safutils.parse_kv_file(os.path.join(apps_dir, '%s.conf' % app_name))
-        if 'bootstart' in app_config.keys() and app_config['bootstart'].lower() == 'false':
-            app_names.remove(app_name)
+    for app_name in get_all_app_names():
+        app_config = safutils.parse_kv_file_cached(os.path.join(apps_dir, '%s.conf' % app_name))
+        if 'bootstart' not in app_config.keys() or app_config['bootstart'].lower() != 'false':
+            app_names.append(app_name)
     logger.debug('bootstart_app_names:%s' % app_names)
     return app_names
 
@@ -488,28 +847,31 @@ def get_app_names(regex=None, all=False, bootstart=False):
 
 
 @safutils.method_trace
-def ls(app_regex, all=False, bootstart=False, details=False, asjson=False):
+def ls(app_regex, all=False, bootstart=False, details=False, asjson=False, ndjson=False):
     app_names = get_app_names(app_regex, all, bootstart)
 
-    apps = dict()
-    for app_name in app_names:
-        apps[app_name] = Application(app_name)
+    output = None
+    if asjson or ndjson:
+        output = safutils.JsonOutput('app', ndjson=ndjson)
 
     result = dict()
-    for app_name in app_names:
+    apps = [Application(app_name) for app_name in app_names]
+    app_sizes = saf.safutils.indexed_directory_sizes([app.basedir for app in apps],
+                                                     max_age=app_size_max_age)
+    for app in apps:
+        app_name = app.name
         result[app_name] = dict()
         for app_property in ['app_version', 'deploy_time']:
-            result[app_name][app_property] = apps[app_name].meta[app_property]
-        result[app_name]['app_size'] = saf.safutils.directory_size(apps[app_name].basedir)
-
-    if details:
-        for app_name in app_names:
+            result[app_name][app_property] = app.meta[app_property]
+        result[app_name]['app_size'] = app_sizes[app.basedir]
+        if details:
             for app_property in ['create_user', 'create_time', 'deploy_user', 'deploy_time']:
-                result[app_name][app_property] = apps[app_name].meta[app_property]
-            result[app_name]['app_size'] = saf.safutils.directory_size(apps[app_name].basedir)
+                result[app_name][app_property] = app.meta[app_property]
+        if output is not None:
+            output.add(app_name, result[app_name])
 
-    if asjson:
-        logger.info(result)
+    if output is not None:
+        output.close()
     else:
         if details:
             app_list = [['NAME', 'VERSION', 'SIZE', 'CRT_USER', 'CRT_TIME', 'DPL_USER', 'DPL_TIME']]
@@ -532,37 +894,82 @@ def ls(app_regex, all=False, bootstart=False, details=False, asjson=False):
 
 
 @safutils.method_trace
-def ps(app_regex, all=False):
-    app_names = get_app_names(app_regex, all)
+def _sample_processes(pids, interval):
+    """
+    Collect resource usage of the given processes. The CPU usage is measured as the difference of
+    the consumed CPU time over interval seconds. Only the given processes are read
+    :param pids: The pids to sample
+    :param interval: Seconds between the two CPU time samples
+    :return: dict of pid to dict with create_time, cpu_percent, rss, num_fds and num_threads.
+        Processes which ended or cannot be accessed are missing
+    """
+    processes = dict()
+    first_cpu = dict()
+    for pid in pids:
+        try:
+            process = psutil.Process(pid)
+            cpu_times = process.cpu_times()
+            first_cpu[pid] = cpu_times.user + cpu_times.system
+            processes[pid] = process
+        except (psutil.NoSuchProcess, psutil.AccessDenied) as e:
+            logger.debug('cannot sample pid %s: %s' % (pid, e))
+    start_time = time.time()
+
+    time.sleep(interval)
+
+    result = dict()
+    elapsed = max(time.time() - start_time, 0.001)
+    for pid, process in processes.items():
+        try:
+            usage = process_usage(process)
+        except (psutil.NoSuchProcess, psutil.AccessDenied) as e:
+            logger.debug('cannot sample pid %s: %s' % (pid, e))
+            continue
+        usage['cpu_percent'] = round((usage['cpu_time'] - first_cpu[pid]) / elapsed * 100, 1)
+        del usage['cpu_time']
+        result[pid] = usage
+    logger.debug('result:%s' % result)
+    return result
+
+
+def process_usage(process):
+    """ Read the current resource usage of a psutil.Process in one go. Raises
+    psutil.NoSuchProcess or psutil.AccessDenied """
+    with process.oneshot():
+        cpu_times = process.cpu_times()
+        return {'create_time': process.create_time(),
+                'cpu_time': cpu_times.user + cpu_times.system,
+                'rss': process.memory_info().rss,
+                'num_fds': process.num_fds(),
+                'num_threads': process.num_threads()}
 
-    result = [['PID', 'APP', 'START', '%CPU', 'RSS', '#FD', '#THR']]
 
-    import time
-    process_data = {}
+@safutils.method_trace
+def ps(app_regex, all=False, interval=0.5):
+    app_names = get_app_names(app_regex, all)
 
-    # sampling two times with small delay to get (more or less) current cpu_percent usage
-    for p in psutil.process_iter():
-        process_data[p.pid] = p.as_dict(
-            ['create_time', 'cpu_percent', 'memory_info', 'num_fds', 'num_threads',
-             'cpu_times'])
-    time.sleep(0.5)
-    for p in psutil.process_iter():
-        process_data[p.pid] = p.as_dict(
-            ['create_time', 'cpu_percent', 'memory_info', 'num_fds', 'num_threads',
-             'cpu_times'])
+    result = [['PID', 'APP', 'START', '%CPU', 'RSS', '#FD', '#THR']]
 
+    process_table = get_process_table()
+    app_pids = []
     for app_name in app_names:
-        app = Application(app_name)
-        pids = app.pids()
+        app = Application(app_name, process_table)
+        app_pids.append((app_name, app.pids()))
+
+    process_data = _sample_processes([pid for app_name, pids in app_pids for pid in pids],
+                                     interval)
 
+    for app_name, pids in app_pids:
         for pid in pids:
+            if pid not in process_data.keys():
+                continue
             result.append([pid,
                            app_name,
                            datetime.datetime.fromtimestamp(
                                process_data[pid]['create_time']).strftime(
                                saf.time_format),
                            process_data[pid]['cpu_percent'],
-                           process_data[pid]['memory_info'].rss,
+                           process_data[pid]['rss'],
                            process_data[pid]['num_fds'], process_data[pid]['num_threads']])
 
     formatted_lines = saf.safutils.align_columns(result)
@@ -572,43 +979,472 @@ def ps(app_regex, all=False):
     return 0
 
 
+class _AppUsage(object):
+    """ Resource usage of all processes of an app, sampled repeatedly by "app top". Keeps the
+    psutil.Process objects of the known PIDs between samples so that refreshing does not scan the
+    process table. The last samples are kept in ring buffers to show trends """
+
+    # characters for increasing CPU usage in the trend column
+    TREND_CHARS = '_.:-=+*#%@'
+
+    @safutils.method_trace
+    def __init__(self, app, history):
+        self.app = app
+        self._processes = dict()
+        self._last_cpu_time = dict()
+        self._last_sample_time = None
+        self.cpu_history = collections.deque(maxlen=history)
+        self.rss_history = collections.deque(maxlen=history)
+        self.num_processes = 0
+        self.rss = 0
+        self.num_fds = 0
+        self.num_threads = 0
+
+    @safutils.method_trace
+    def discover(self, process_table=None):
+        """ (Re-)read the PIDs of the app, e.g. to pick up forked processes """
+        pids = self.app.pids(process_table=process_table)
+        for pid in self._processes.keys():
+            if pid not in pids:
+                self._forget(pid)
+        for pid in pids:
+            if pid not in self._processes.keys():
+                try:
+                    self._processes[pid] = psutil.Process(pid)
+                except psutil.NoSuchProcess as e:
+                    logger.debug('pid %s ended before sampling: %s' % (pid, e))
+
+    def _forget(self, pid):
+        del self._processes[pid]
+        if pid in self._last_cpu_time.keys():
+            del self._last_cpu_time[pid]
+
+    @safutils.method_trace
+    def sample(self):
+        """ Read the usage of the known PIDs
+        :return: False if a known process ended, i.e. the PIDs should be discovered again
+        """
+        complete = True
+        now = time.time()
+        elapsed = None
+        if self._last_sample_time is not None:
+            elapsed = max(now - self._last_sample_time, 0.001)
+        self._last_sample_time = now
+
+        cpu_seconds = 0.0
+        self.num_processes = self.rss = self.num_fds = self.num_threads = 0
+        for pid, process in self._processes.items():
+            try:
+                usage = process_usage(process)
+            except (psutil.NoSuchProcess, psutil.AccessDenied) as e:
+                logger.debug('cannot sample pid %s: %s' % (pid, e))
+                self._forget(pid)
+                complete = False
+                continue
+            # processes which are new in this round count from the next round on
+            if pid in self._last_cpu_time.keys():
+                cpu_seconds += usage['cpu_time'] - self._last_cpu_time[pid]
+            self._last_cpu_time[pid] = usage['cpu_time']
+            self.num_processes += 1
+            self.rss += usage['rss']
+            self.num_fds += usage['num_fds']
+            self.num_threads += usage['num_threads']
+
+        if elapsed is not None:
+            self.cpu_history.append(round(cpu_seconds / elapsed * 100, 1))
+            self.rss_history.append(self.rss)
+        return complete
+
+    def cpu_percent(self):
+        if len(self.cpu_history) == 0:
+            return 0.0
+        return self.cpu_history[-1]
+
+    def cpu_average(self):
+        if len(self.cpu_history) == 0:
+            return 0.0
+        return round(sum(self.cpu_history) / len(self.cpu_history), 1)
+
+    def cpu_trend(self):
+        """ One character per sample, scaled to the highest sample (but at least 100%) """
+        top_value = max([100.0] + list(self.cpu_history))
+        return ''.join(
+            [self.TREND_CHARS[int(value / top_value * (len(self.TREND_CHARS) - 1))] for value in
+             self.cpu_history])
+
+    def rss_change(self):
+        """ Change of RSS since the oldest sample in the ring buffer """
+        if len(self.rss_history) == 0:
+            return 0
+        return self.rss_history[-1] - self.rss_history[0]
+
+
+@safutils.method_trace
+def top(app_regex, all=False, interval=2.0, iterations=None, history=20, rescan=10):
+    """
+    Continuously show the resource usage per app, summed over all processes of each app
+    :param interval: Seconds between refreshes
+    :param iterations: Number of refreshes, None for "until interrupted"
+    :param history: Number of samples to keep for the trend columns
+    :param rescan: Re-read the PIDs of all apps every rescan refreshes to pick up new processes.
+        The PIDs of an app are always re-read if one of its processes ended
+    """
+    if interval <= 0:
+        raise SafExecutionException('Interval must be greater than 0')
+    if history < 1:
+        raise SafExecutionException('History must be at least 1')
+    app_names = get_app_names(app_regex, all)
+
+    process_table = ProcessTable()
+    usages = []
+    for app_name in app_names:
+        usage = _AppUsage(Application(app_name), history)
+        usage.discover(process_table)
+        usage.sample()
+        usages.append(usage)
+
+    clear_screen = sys.stdout.isatty()
+    count = 0
+    try:
+        while iterations is None or count < iterations:
+            time.sleep(interval)
+            count += 1
+            process_table = None
+            if count % rescan == 0:
+                process_table = ProcessTable()
+            changed = []
+            for usage in usages:
+                if process_table is not None:
+                    usage.discover(process_table)
+                if not usage.sample():
+                    changed.append(usage)
+            if len(changed) > 0:
+                # one scan for all apps whose processes ended, taken after sampling
+                process_table = ProcessTable()
+                for usage in changed:
+                    usage.discover(process_table)
+
+            result = [['APP', '#PROC', '%CPU', '%CPU(AVG)', 'TREND', 'RSS', 'RSS(CHANGE)', '#FD',
+                       '#THR']]
+            for usage in usages:
+                result.append([usage.app.name, usage.num_processes, usage.cpu_percent(),
+                               usage.cpu_average(), '[%s]' % usage.cpu_trend().ljust(history),
+                               usage.rss, '%+d' % usage.rss_change(), usage.num_fds,
+                               usage.num_threads])
+
+            if clear_screen:
+                sys.stdout.write('\033[H\033[2J')
+                sys.stdout.flush()
+            logger.info('%s, refresh every %ss, trend over last %s samples' % (
+                datetime.datetime.now().strftime(saf.time_format), interval, history))
+            for line in saf.safutils.align_columns(result):
+                logger.info(line)
+    except KeyboardInterrupt:
+        logger.debug('KeyboardInterrupt')
+
+    return 0
+
+
+# Process attributes which "app pinfo" reads by default. They are read from a few /proc files
+PINFO_DEFAULT_FIELDS = ['pid', 'ppid', 'name', 'exe', 'cmdline', 'username', 'status', 'create_time',
+                        'cwd', 'nice', 'terminal', 'uids', 'gids', 'cpu_times', 'memory_info',
+                        'num_threads', 'num_fds', 'num_ctx_switches']
+
+# psutil 6 renamed Process.connections() to net_connections()
+_CONNECTIONS_FIELD = 'net_connections' if hasattr(psutil.Process, 'net_connections') else \
+    'connections'
+
+# Process attributes which can be costly for big processes (e.g. JVMs with thousands of threads,
+# mapped files or sockets). They are only read if requested explicitly
+PINFO_EXPENSIVE_FIELDS = ['open_files', _CONNECTIONS_FIELD, 'memory_maps', 'memory_full_info',
+                          'environ', 'threads', 'io_counters', 'cpu_affinity', 'ionice',
+                          'cpu_percent', 'memory_percent']
+
+# Seconds over which "app pinfo" measures cpu_percent
+PINFO_CPU_INTERVAL = 0.5
+
+
+def _jsonable(value):
+    """ Convert psutil results (namedtuples, lists of namedtuples) to plain dicts and lists """
+    if hasattr(value, '_asdict'):
+        value = value._asdict()
+    if isinstance(value, dict):
+        return dict([(key, _jsonable(elem)) for key, elem in value.items()])
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(elem) for elem in value]
+    return value
+
+
+@safutils.method_trace
+def _pinfo_fields(fields):
+    """ Return the list of process attributes for a comma separated field selection. None selects
+    the default fields. "all" returns None which means all attributes psutil knows about """
+    if fields is None:
+        return PINFO_DEFAULT_FIELDS
+    result = []
+    for field in [elem.strip() for elem in fields.split(',') if elem.strip() != '']:
+        if field == 'all':
+            return None
+        elif field in ['connections', 'net_connections']:
+            result.append(_CONNECTIONS_FIELD)
+        elif field in PINFO_DEFAULT_FIELDS or field in PINFO_EXPENSIVE_FIELDS:
+            result.append(field)
+        else:
+            raise SafExecutionException('Unknown field %s. Valid fields: %s' % (
+                field, ', '.join(['all'] + PINFO_DEFAULT_FIELDS + PINFO_EXPENSIVE_FIELDS)))
+    if len(result) == 0:
+        raise SafExecutionException('No fields selected')
+    # keep the order, drop duplicates
+    result = [field for i, field in enumerate(result) if field not in result[:i]]
+    logger.debug('result:%s' % result)
+    return result
+
+
 @safutils.method_trace
-def pinfo(app_name, asjson=False):
+def pinfo(app_name, asjson=False, ndjson=False, fields=None, compact=False):
+    """
+    Show process details of the PIDs of an app
+    :param fields: Comma separated list of process attributes. Defaults to PINFO_DEFAULT_FIELDS,
+        "all" reads every attribute (including the expensive ones)
+    :param compact: Output single line json
+    """
     if app_name not in get_all_app_names():
         raise SafExecutionException('No such app: %s' % app_name)
+    attrs = _pinfo_fields(fields)
 
-    app = Application(app_name)
+    app = Application(app_name, get_process_table())
     if not app.is_running():
         raise SafExecutionException('Application %s is not running' % app_name)
 
-    pids = app.pids()
+    output = None
+    if asjson or ndjson:
+        output = safutils.JsonOutput('pid', ndjson=ndjson)
 
-    if asjson:
-        result = dict()
-        for pid in pids:
-            pdict = psutil.Process(pid).as_dict()
-            result[pid] = pdict
-        logger.info(result)
+    processes = []
+    for pid in app.pids():
+        try:
+            processes.append(psutil.Process(pid))
+        except psutil.NoSuchProcess as e:
+            logger.debug('pid %s ended: %s' % (pid, e))
+    if attrs is None or 'cpu_percent' in attrs:
+        # cpu_percent is measured against the previous call on the same Process object
+        for process in processes:
+            try:
+                process.cpu_percent(None)
+            except (psutil.NoSuchProcess, psutil.AccessDenied) as e:
+                logger.debug('cannot sample pid %s: %s' % (process.pid, e))
+        time.sleep(PINFO_CPU_INTERVAL)
+
+    result = dict()
+    for process in processes:
+        pid = process.pid
+        try:
+            # read all attributes with as few /proc reads as possible
+            with process.oneshot():
+                pdict = process.as_dict(attrs=attrs, ad_value=None)
+        except psutil.NoSuchProcess as e:
+            logger.debug('pid %s ended: %s' % (pid, e))
+            continue
+        except ValueError as e:
+            # field names differ between psutil versions
+            raise SafExecutionException('Cannot read process attributes: %s' % e)
+        result[pid] = _jsonable(pdict)
+        if output is not None and not compact:
+            output.add(pid, result[pid])
+
+    if compact:
+        logger.info(json.dumps(result, sort_keys=True, separators=(',', ':'), default=str))
+    elif output is not None:
+        output.close()
     else:
-        for pid in pids:
+        for pid in sorted(result.keys()):
             logger.info('%s:' % pid)
-            pdict = psutil.Process(pid).as_dict()
-            safutils.prettyprint_dict(pdict)
+            safutils.prettyprint_dict(result[pid])
             # logger.info(saf.packages.yaml.dump(pdict, default_flow_style=False, indent=4))
 
     return 0
 
 
 @safutils.method_trace
-def start(app_regex, all=False, bootstart=False, iknow=False):
+def _start_order(apps):
+    """
+    Order app names such that every app comes after the apps it depends on
+    :param apps: dict of app name to Application
+    :raises SafConfigException if the dependencies are cyclic
+    :return: list of app names. Apps without mutual dependencies keep their alphabetical order
+    """
+    result = []
+    visiting = []
+
+    def visit(app_name):
+        if app_name in result:
+            return
+        if app_name in visiting:
+            raise SafConfigException('Cyclic app dependency: %s' % ' -> '.join(
+                visiting[visiting.index(app_name):] + [app_name]))
+        visiting.append(app_name)
+        for dependency in apps[app_name].depends():
+            if dependency in apps.keys():
+                visit(dependency)
+        visiting.remove(app_name)
+        result.append(app_name)
+
+    for app_name in sorted(apps.keys()):
+        visit(app_name)
+    logger.debug('result:%s' % result)
+    return result
+
+
+@safutils.method_trace
+def _unavailable_dependency(app, selected):
+    """
+    :param app: The Application to start
+    :param selected: The names of the apps which are started by the same command
+    :return: Why a dependency of app which is not started by the same command is unavailable,
+        None if all of them are running
+    """
+    for dependency in app.depends():
+        if dependency in selected:
+            continue
+        if dependency not in get_all_app_names():
+            return 'dependency %s not deployed' % dependency
+        if not Application(dependency, app.process_table).is_running():
+            return 'dependency %s not running' % dependency
+    return None
+
+
+@safutils.method_trace
+def _print_summary(results, app_names):
+    """
+    Log the outcome of a command which handled several apps as a table
+    :param results: dict of app name to [result, seconds, detail]
+    :param app_names: The names of the apps in the order in which they are listed
+    """
+    summary = [['APP', 'RESULT', 'SECONDS', 'DETAIL']]
+    for app_name in app_names:
+        summary.append([app_name, results[app_name][0], '%.1f' % results[app_name][1],
+                        results[app_name][2]])
+    for line in saf.safutils.align_columns(summary):
+        logger.info(line)
+
+
+@safutils.method_trace
+def _start_parallel(apps, app_names, iknow, parallel):
+    """
+    Start apps concurrently using a pool of parallel workers. An app is only started once all the
+    apps it depends on are running
+    :param apps: dict of app name to Application
+    :param app_names: The names of the apps to start in dependency order (see _start_order)
+    :param iknow: Acknowledge knowhow asserts
+    :param parallel: The maximum number of apps which are started at the same time
+    :return: The number of apps which could not be started
+    """
+    # knowhow asserts are interactive and have to be handled before starting concurrently
+    for app_name in app_names:
+        if not apps[app_name].is_running():
+            safutils.assert_knowhow(apps[app_name], 'knowhow.app.start', iknow)
+
+    # app_name -> [result, seconds, detail]
+    results = dict()
+    finished = Queue.Queue()
+
+    def start_one(app_name):
+        start_time = time.time()
+        try:
+            apps[app_name].start(True)
+            finished.put((app_name, 'OK', time.time() - start_time, ''))
+        except Exception as e:
+            finished.put((app_name, 'FAIL', time.time() - start_time, str(e)))
+
+    def blocking_dependency(app_name):
+        """ Return (dependency, reason) if app_name cannot be started (yet), None otherwise """
+        for dependency in apps[app_name].depends():
+            if dependency in apps.keys():
+                if dependency not in results.keys():
+                    return dependency, None
+                if results[dependency][0] not in ['OK', 'RUNNING']:
+                    return dependency, 'dependency %s not started' % dependency
+        reason = _unavailable_dependency(apps[app_name], apps.keys())
+        if reason is not None:
+            return None, reason
+        return None
+
+    pending = list(app_names)
+    running = 0
+    pool = ThreadPool(parallel)
+    try:
+        while len(pending) > 0 or running > 0:
+            for app_name in list(pending):
+                if apps[app_name].is_running():
+                    logger.info('%s already running' % app_name)
+                    results[app_name] = ['RUNNING', 0, '']
+                    pending.remove(app_name)
+                    continue
+                blocker = blocking_dependency(app_name)
+                if blocker is None:
+                    if running < parallel:
+                        logger.info('Starting %s ...' % app_name)
+                        pool.apply_async(start_one, (app_name,))
+                        running += 1
+                        pending.remove(app_name)
+                elif blocker[1] is not None:
+                    logger.info('Skipping %s (%s)' % (app_name, blocker[1]))
+                    results[app_name] = ['SKIPPED', 0, blocker[1]]
+                    pending.remove(app_name)
+            if running == 0:
+                continue
+            # poll with timeout, a blocking get() cannot be interrupted by Ctrl-C
+            while True:
+                try:
+                    app_name, result, seconds, detail = finished.get(True, 1)
+                    break
+                except Queue.Empty:
+                    pass
+            running -= 1
+            results[app_name] = [result, seconds, detail]
+            if result == 'OK':
+                logger.info('%s started' % app_name)
+            else:
+                logger.warn('%s failed to start: %s' % (app_name, detail))
+    finally:
+        pool.close()
+
+    _print_summary(results, app_names)
+
+    return len([name for name in app_names if results[name][0] not in ['OK', 'RUNNING']])
+
+
+@safutils.method_trace
+def start(app_regex, all=False, bootstart=False, iknow=False, parallel=None):
     app_names = get_app_names(app_regex, all, bootstart)
 
+    if parallel is None:
+        try:
+            parallel = int(saf.config.get('app.start.parallel', 1))
+        except ValueError as e:
+            raise SafConfigException('invalid app.start.parallel: %s' % e)
+    if parallel < 1:
+        raise SafExecutionException('Parallelism must be at least 1')
+
+    process_table = ProcessTable()
+    apps = dict()
+    for app_name in app_names:
+        apps[app_name] = Application(app_name, process_table)
+    app_names = _start_order(apps)
+
+    if parallel > 1:
+        return _start_parallel(apps, app_names, iknow, parallel)
+
     started = 0
     for app_name in app_names:
-        app = Application(app_name)
+        app = apps[app_name]
         if app.is_running():
             logger.info('%s already running' % app_name)
         else:
+            # the selected apps it depends on have been started before
+            reason = _unavailable_dependency(app, apps.keys())
+            if reason is not None:
+                raise SafExecutionException('Cannot start %s: %s' % (app_name, reason))
             logger.info('Starting %s ...' % app_name)
             app.start(iknow)
             logger.info('OK')
@@ -618,12 +1454,125 @@ def start(app_regex, all=False, bootstart=False, iknow=False):
 
 
 @safutils.method_trace
-def stop(app_regex, all=False, bootstart=False, iknow=False):
+def _terminate_apps(apps):
+    """
+    Send SIGTERM to the processes of all apps at once and wait for all of them together. The
+    processes of an app which are still alive after its timeout.stop are killed. If they do not end
+    within another timeout.stop the app fails
+    :param apps: List of running Application objects. Knowhow has to be acknowledged already
+    :return: dict of app name to [result, seconds, detail] with result OK (ended after SIGTERM),
+        KILLED (ended after SIGKILL) or FAIL
+    """
+    start_time = time.time()
+    end_times = dict()
+
+    @safutils.method_trace
+    def on_end(proc):
+        logger.debug('pid %s ended' % proc.pid)
+        end_times[proc.pid] = time.time()
+
+    procs = dict()
+    deadlines = dict()
+    for app in apps:
+        procs[app.name] = []
+        for pid in app.pids():
+            try:
+                proc = psutil.Process(pid)
+                if app.process_table is not None and pid in app.process_table and \
+                        proc.create_time() != app.process_table.process_create_time(pid):
+                    # the process of the snapshot ended and its pid has been reused
+                    logger.debug('pid %s has been reused, not terminating it' % pid)
+                    continue
+                logger.debug('terminating pid %s, cmdline "%s"' % (proc.pid, proc.cmdline()))
+                proc.terminate()
+                procs[app.name].append(proc)
+            except psutil.NoSuchProcess as e:
+                logger.debug('pid %s ended before SIGTERM: %s' % (pid, e))
+        deadlines[app.name] = start_time + app.stop_timeout()
+
+    alive = dict([(app_name, list(procs[app_name])) for app_name in procs.keys()])
+    killed = []
+    results = dict()
+    while True:
+        now = time.time()
+        for app in apps:
+            if app.name in results.keys():
+                continue
+            if len(alive[app.name]) == 0:
+                seconds = max([start_time] + [end_times.get(ended.pid, now) for ended in
+                                              procs[app.name]]) - start_time
+                results[app.name] = ['KILLED' if app.name in killed else 'OK', seconds, '']
+                app._cleanup_after_stop()
+            elif now >= deadlines[app.name]:
+                if app.name in killed:
+                    pid_list = [str(survivor.pid) for survivor in alive[app.name]]
+                    results[app.name] = ['FAIL', now - start_time,
+                                         'PID(s) %s still alive' % ','.join(pid_list)]
+                else:
+                    app._kill(alive[app.name])
+                    killed.append(app.name)
+                    deadlines[app.name] = now + app.stop_timeout()
+
+        waiting = [app.name for app in apps if app.name not in results.keys()]
+        if len(waiting) == 0:
+            break
+        # returns as soon as all processes ended or the next app reaches its deadline
+        gone, still_alive = psutil.wait_procs(
+            [survivor for app_name in waiting for survivor in alive[app_name]],
+            timeout=max(min([deadlines[app_name] for app_name in waiting]) - time.time(), 0),
+            callback=on_end)
+        for app_name in waiting:
+            alive[app_name] = [survivor for survivor in alive[app_name] if survivor in still_alive]
+
+    logger.debug('results:%s' % results)
+    return results
+
+
+@safutils.method_trace
+def _stop_bulk(apps, app_names, iknow):
+    """
+    Stop all apps at once (see _terminate_apps) and report the outcome per app
+    :param apps: dict of app name to Application
+    :param app_names: The names of the apps to stop
+    :param iknow: Acknowledge knowhow asserts
+    :return: The number of apps which could not be stopped
+    """
+    running = []
+    results = dict()
+    for app_name in app_names:
+        if apps[app_name].is_running():
+            # knowhow asserts are interactive, ask for all apps before stopping any
+            safutils.assert_knowhow(apps[app_name], 'knowhow.app.stop', iknow)
+            running.append(apps[app_name])
+        else:
+            logger.info('%s already stopped' % app_name)
+            results[app_name] = ['STOPPED', 0, '']
+
+    if len(running) > 0:
+        logger.info('Stopping %s ...' % ', '.join([app.name for app in running]))
+        results.update(_terminate_apps(running))
+
+    _print_summary(results, app_names)
+
+    return len([app_name for app_name in app_names if results[app_name][0] == 'FAIL'])
+
+
+@safutils.method_trace
+def stop(app_regex, all=False, bootstart=False, iknow=False, bulk=False):
     app_names = get_app_names(app_regex, all, bootstart)
 
+    if bulk:
+        # all apps are terminated right after the scan, they can share one snapshot
+        process_table = ProcessTable()
+        apps = dict()
+        for app_name in app_names:
+            apps[app_name] = Application(app_name, process_table)
+        return _stop_bulk(apps, app_names, iknow)
+
     stopped = 0
     for app_name in app_names:
-        app = Application(app_name)
+        # stopping the previous app may have taken a while, do not use a snapshot from before
+        app = Application(app_name, ProcessTable())
 
         if not app.is_running():
             logger.info('%s already stopped' % app_name)
@@ -637,13 +1586,171 @@ def stop(app_regex, all=False, bootstart=False, iknow=False):
 
 
 @safutils.method_trace
-def restart(app_regex, all=False, bootstart=False, iknow=False):
+def _wait_healthy(apps, timeout, parallel):
+    """
+    Wait until all checks of the given apps succeed. Apps without checks are healthy as soon as
+    they run
+    :param apps: List of Application objects
+    :param timeout: Seconds to wait at most
+    :param parallel: The maximum number of concurrent check requests
+    :return: dict of app name to None (healthy) or the reason why the app is not healthy
+    """
+    deadline = time.time() + timeout
+    result = dict()
+    pending = list(apps)
+    while len(pending) > 0:
+        process_table = ProcessTable()
+        checks = []
+        for app in list(pending):
+            if not app.is_running(process_table=process_table):
+                result[app.name] = 'not running'
+                pending.remove(app)
+            else:
+                checks.extend(app.checks())
+        _run_checks(checks, parallel)
+
+        for app in list(pending):
+            failed = [check for check in checks if check['app'] == app.name and
+                      not check['success']]
+            if len(failed) == 0:
+                logger.info('%s is healthy' % app.name)
+                result[app.name] = None
+                pending.remove(app)
+            else:
+                result[app.name] = 'check %s failed: %s' % (
+                    failed[0]['name'], failed[0]['error'] or 'success pattern not found')
+
+        remaining = deadline - time.time()
+        if len(pending) > 0:
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, 2))
+    logger.debug('result:%s' % result)
+    return result
+
+
+@safutils.method_trace
+def _restart_batches(apps, app_names, rolling):
+    """
+    Split apps into batches of at most rolling apps which are restarted one after the other. An
+    app never shares a batch with an app it depends on
+    :param apps: dict of app name to Application
+    :param app_names: The names of the apps in dependency order (see _start_order)
+    :param rolling: The maximum batch size
+    :return: list of lists of app names
+    """
+    batches = []
+    batch = []
+    for app_name in app_names:
+        if len(batch) == rolling or len(
+                [dependency for dependency in apps[app_name].depends() if dependency in batch]) > 0:
+            batches.append(batch)
+            batch = []
+        batch.append(app_name)
+    if len(batch) > 0:
+        batches.append(batch)
+    logger.debug('batches:%s' % batches)
+    return batches
+
+
+@safutils.method_trace
+def _restart_rolling(apps, app_names, iknow, rolling, health_timeout):
+    """
+    Restart apps in batches of at most rolling apps. The next batch is only restarted once all
+    apps of the current batch pass their checks. Stops at the first unhealthy batch
+    :param apps: dict of app name to Application
+    :param app_names: The names of the apps to restart in dependency order (see _start_order)
+    :param iknow: Acknowledge knowhow asserts
+    :param rolling: The maximum number of apps restarted at the same time
+    :param health_timeout: Seconds to wait for the checks of a batch to succeed
+    :return: The number of apps which failed or have been skipped
+    """
+    # knowhow asserts are interactive and have to be handled before restarting concurrently
+    for app_name in app_names:
+        safutils.assert_knowhow(apps[app_name], 'knowhow.app.stop', iknow)
+        safutils.assert_knowhow(apps[app_name], 'knowhow.app.start', iknow)
+
+    check_parallel = check_parallelism()
+
+    # app_name -> [result, seconds, detail]
+    results = dict()
+
+    def start_one(app):
+        try:
+            app.start(True)
+            return None
+        except Exception as e:
+            return str(e)
+
+    for batch in _restart_batches(apps, app_names, rolling):
+        if len([r for r in results.values() if r[0] == 'FAIL']) > 0:
+            for app_name in batch:
+                results[app_name] = ['SKIPPED', 0, 'previous batch failed']
+            continue
+
+        logger.info('Restarting %s ...' % ', '.join(batch))
+        start_time = time.time()
+        # the shared snapshot is outdated once the previous batch has been restarted
+        batch_apps = [Application(app_name) for app_name in batch]
+        running = [app for app in batch_apps if app.is_running()]
+        stop_results = _terminate_apps(running)
+
+        to_start = []
+        for app in batch_apps:
+            if app.name in stop_results.keys() and stop_results[app.name][0] == 'FAIL':
+                results[app.name] = ['FAIL', time.time() - start_time,
+                                     'stop failed: %s' % stop_results[app.name][2]]
+            else:
+                to_start.append(app)
+
+        start_timeout = sum([app.start_timeout() for app in to_start]) + 60
+        try:
+            start_errors = safutils._map_concurrently(start_one, to_start, rolling, start_timeout)
+        except multiprocessing.TimeoutError:
+            start_errors = ['not finished within %s seconds' % start_timeout] * len(to_start)
+        started = []
+        for app, error in zip(to_start, start_errors):
+            if error is None:
+                started.append(app)
+            else:
+                results[app.name] = ['FAIL', time.time() - start_time,
+                                     'start failed: %s' % error]
+
+        health = _wait_healthy(started, health_timeout, check_parallel)
+        for app in started:
+            if health[app.name] is None:
+                results[app.name] = ['OK', time.time() - start_time, '']
+            else:
+                results[app.name] = ['FAIL', time.time() - start_time, health[app.name]]
+                logger.warn('%s is not healthy: %s' % (app.name, health[app.name]))
+
+    _print_summary(results, app_names)
+
+    return len([app_name for app_name in app_names if results[app_name][0] != 'OK'])
+
+
+@safutils.method_trace
+def restart(app_regex, all=False, bootstart=False, iknow=False, rolling=None,
+            health_timeout=None):
     app_names = get_app_names(app_regex, all, bootstart)
 
     rc = 0
     if len(app_names) == 0:
         raise SafExecutionException('No app found matching %s' % app_regex)
 
+    if rolling is not None:
+        if rolling < 1:
+            raise SafExecutionException('Rolling batch size must be at least 1')
+        if health_timeout is None:
+            try:
+                health_timeout = int(saf.config.get('app.restart.health_timeout', 120))
+            except ValueError as e:
+                raise SafConfigException('invalid app.restart.health_timeout: %s' % e)
+        apps = dict()
+        for app_name in app_names:
+            apps[app_name] = Application(app_name)
+        return _restart_rolling(apps, _start_order(apps), iknow, rolling, health_timeout)
+
     for app_name in app_names:
         rc += stop(app_name, iknow=iknow)
         rc += start(app_name, iknow=iknow)
@@ -652,18 +1759,19 @@ def restart(app_regex, all=False, bootstart=False, iknow=False):
 
 
 @safutils.method_trace
-def status(app_regex, all=False, bootstart=False, asjson=False):
+def status(app_regex, all=False, bootstart=False, asjson=False, ndjson=False):
     app_names = get_app_names(app_regex, all, bootstart)
 
-    if asjson:
-        result = dict()
+    process_table = get_process_table()
+    if asjson or ndjson:
+        output = safutils.JsonOutput('app', value_name='pids', ndjson=ndjson)
         for app_name in app_names:
-            app = Application(app_name)
-            result[app_name] = app.pids()
-        logger.info(result)
+            app = Application(app_name, process_table)
+            output.add(app_name, app.pids())
+        output.close()
     else:
         for app_name in app_names:
-            app = Application(app_name)
+            app = Application(app_name, process_table)
 
             if not app.is_running():
                 logger.info("%s is stopped" % app_name)
@@ -679,58 +1787,155 @@ def status(app_regex, all=False, bootstart=False, asjson=False):
 
 
 @safutils.method_trace
-def tail(app_regex, all=False, bootstart=False):
+def tail(app_regex, all=False, bootstart=False, filter=None):
     app_names = get_app_names(app_regex, all, bootstart)
 
-    command = ['tail', '-n0', '-f']
-    files = list()
+    line_filter = None
+    if filter is not None:
+        try:
+            line_filter = re.compile(filter)
+        except sre_constants.error as e:
+            raise SafExecutionException('Invalid regular expression: %s' % e)
+
+    log_dirs = dict()
     for app_name in app_names:
         app = Application(app_name)
-        for root, dirnames, filenames in os.walk(os.path.join(app.basedir, 'log')):
-            for filename in filenames:
-                files.append(os.path.join(root, filename))
-    if len(files) > 0:
-        command.extend(files)
-        saf.safutils.run_process(' '.join(command), log_output=False)
+        log_dir = os.path.join(app.basedir, 'log')
+        if os.path.isdir(log_dir):
+            log_dirs[app_name] = log_dir
+    if len(log_dirs) > 0:
+        try:
+            safutils.LogFollower(log_dirs, line_filter).follow()
+        except KeyboardInterrupt:
+            logger.debug('KeyboardInterrupt')
     else:
-        logger.warning('No logfiles found')
+        logger.warning('No log directories found')
     return 0
 
 
 @safutils.method_trace
-def check(app_regex, all=False, bootstart=False, details=False):
+def check_parallelism():
+    """
+    :return: The maximum number of concurrent check requests (app.check.parallel of saf.conf or 8)
+    """
+    try:
+        return int(saf.config.get('app.check.parallel', 8))
+    except ValueError as e:
+        raise SafConfigException('invalid app.check.parallel: %s' % e)
+
+
+@safutils.method_trace
+def _run_checks(checks, parallel):
+    """
+    Query check URLs concurrently using a shared HTTP connection pool
+    :param checks: List of check dicts as returned by Application.checks(). Each dict is updated
+        with the keys success, latency (seconds), findings and error
+    :param parallel: The maximum number of concurrent requests
+    """
+    if len(checks) == 0:
+        return
+    parallel = min(parallel, len(checks))
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=parallel, pool_maxsize=parallel)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    def run_check(check):
+        result = {'findings': [], 'error': None}
+        start_time = time.time()
+        try:
+            resp = session.get(check['url'], verify=False, timeout=check['timeout'])
+            result['findings'] = re.findall('.*%s.*' % check['pattern'], resp.text)
+            logger.debug('findings:%s' % result['findings'])
+        except requests.exceptions.RequestException as e:
+            result['error'] = str(e)
+        except Exception as e:
+            # e.g. an invalid check.<name>.pattern
+            result['error'] = '%s: %s' % (e.__class__.__name__, e)
+        result['latency'] = time.time() - start_time
+        result['success'] = len(result['findings']) > 0
+        check.update(result)
+
+    timeout = sum([check['timeout'] for check in checks]) * 2 + 60
+    start_time = time.time()
+    try:
+        safutils._map_concurrently(run_check, checks, parallel, timeout)
+    except multiprocessing.TimeoutError:
+        for check in checks:
+            if 'success' not in check.keys():
+                check.update({'findings': [], 'success': False,
+                              'latency': time.time() - start_time,
+                              'error': 'no result within %s seconds' % timeout})
+    finally:
+        session.close()
+
+
+@safutils.method_trace
+def check(app_regex, all=False, bootstart=False, details=False, asjson=False, ndjson=False,
+          parallel=None):
     app_names = get_app_names(app_regex, all, bootstart)
 
+    if parallel is None:
+        parallel = check_parallelism()
+    if parallel < 1:
+        raise SafExecutionException('Parallelism must be at least 1')
+
+    process_table = get_process_table()
+    running = dict()
+    checks = []
+    for app_name in app_names:
+        app = Application(app_name, process_table)
+        running[app_name] = app.is_running()
+        if running[app_name]:
+            checks.extend(app.checks())
+
+    _run_checks(checks, parallel)
+
+    output = None
+    if asjson or ndjson:
+        output = safutils.JsonOutput('app', ndjson=ndjson)
+
     count = 0
     success = 0
+    result = dict()
     for app_name in app_names:
-        logger.info('Checking application %s ...' % app_name)
-        app = Application(app_name)
-        if app.is_running():
-            check_names = app.check_names()
-            for check_name in check_names:
-                count += 1
-                url = app.check_url(check_name)
-                pattern = app.check_success_pattern(check_name)
-                logger.info('Check "%s": Matching %s with pattern "%s"' % (check_name, url, pattern))
-                findings = []
-                try:
-                    resp = requests.get(url, verify=False)
-                    findings = re.findall('.*%s.*' % pattern, resp.text)
-                    logger.debug('findings:%s' % findings)
-                except requests.exceptions.RequestException as e:
-                    logger.warning('Problem with request: %s' % e)
-                if len(findings) > 0:
-                    if details:
-                        for line in findings:
-                            logger.info(line)
-                    logger.info('OK')
-                    success += 1
-                else:
-                    logger.info('FAIL')
-        else:
+        app_checks = [check for check in checks if check['app'] == app_name]
+        result[app_name] = {'running': running[app_name], 'checks': dict()}
+        if not running[app_name]:
             count += 1
+        for app_check in app_checks:
+            count += 1
+            if app_check['success']:
+                success += 1
+            result[app_name]['checks'][app_check['name']] = {
+                'url': app_check['url'],
+                'success': app_check['success'],
+                'latency_ms': int(app_check['latency'] * 1000),
+                'error': app_check['error']}
+
+        if output is not None:
+            output.add(app_name, result[app_name])
+            continue
+        logger.info('Checking application %s ...' % app_name)
+        if not running[app_name]:
             logger.info('FAIL (app is stopped)')
+        for app_check in app_checks:
+            logger.info('Check "%s": Matching %s with pattern "%s"' % (
+                app_check['name'], app_check['url'], app_check['pattern']))
+            if app_check['error'] is not None:
+                logger.warning('Problem with request: %s' % app_check['error'])
+            if app_check['success']:
+                if details:
+                    for line in app_check['findings']:
+                        logger.info(line)
+                logger.info('OK (%d ms)' % (app_check['latency'] * 1000))
+            else:
+                logger.info('FAIL (%d ms)' % (app_check['latency'] * 1000))
+
+    if output is not None:
+        output.close()
+        return 0 if success == count else 1
 
     logger.info('%s checks executed, %s failed' % (count, count - success))
     if success == count:
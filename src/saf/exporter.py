@@ -0,0 +1,252 @@
+# ATTENTION! File managed by Puppet. Changes will be overwritten.
+
+""" SAF metrics exporter
+A local HTTP server which serves the state and resource usage of all apps in the Prometheus text
+format (version 0.0.4) on /metrics. The values are collected by a background thread every few
+seconds and cached, so a scrape only returns the last rendered text and its cost does not depend
+on the number of apps or processes.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import threading
+import time
+
+import saf
+import saf.app
+
+from . import safutils
+
+from saf.exceptions import *
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    import psutil
+except ImportError as e:
+    raise SafExecutionException(e)
+
+# (name, type, help) of all exported metrics, in output order
+METRICS = [
+    ('saf_app_up', 'gauge', 'Whether the app is running (1) or not (0)'),
+    ('saf_app_processes', 'gauge', 'Number of processes of the app'),
+    ('saf_app_cpu_seconds_total', 'counter',
+     'User and system CPU time of the current processes of the app plus that of its processes '
+     'which ended while the exporter was running'),
+    ('saf_app_resident_memory_bytes', 'gauge', 'Resident memory of all processes of the app'),
+    ('saf_app_open_fds', 'gauge', 'Open file descriptors of all processes of the app'),
+    ('saf_app_threads', 'gauge', 'Threads of all processes of the app'),
+    ('saf_app_check_success', 'gauge', 'Result of the last run of an app check (1 = success)'),
+    ('saf_app_check_latency_seconds', 'gauge', 'Duration of the last run of an app check'),
+    ('saf_exporter_last_refresh_timestamp_seconds', 'gauge',
+     'Time of the last refresh of the app metrics'),
+    ('saf_exporter_refresh_duration_seconds', 'gauge', 'Duration of the last refresh'),
+    ('saf_exporter_refresh_errors_total', 'counter', 'Number of failed refreshes'),
+]
+
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _MetricsCollector(object):
+    """ Periodically collects the metrics and keeps the rendered text """
+
+    @safutils.method_trace
+    def __init__(self, interval, check_interval, check_parallel):
+        self.interval = interval
+        self.check_interval = check_interval
+        self.check_parallel = check_parallel
+        self._samples = []
+        self._check_samples = []
+        self._last_check_time = None
+        # app name -> {(pid, create time): cpu seconds} of the processes seen by the last refresh
+        self._cpu_seen = dict()
+        # app name -> cpu seconds, as of their last refresh, of processes which ended while the
+        # exporter was running. Processes which ended before are not counted
+        self._cpu_ended = dict()
+        self._errors = 0
+        self._text = ''
+        self._text_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def text(self):
+        with self._text_lock:
+            return self._text
+
+    @safutils.method_trace
+    def _collect_apps(self):
+        """ Read state and resource usage of all apps using a single process table scan """
+        samples = []
+        checks = []
+        process_table = saf.app.ProcessTable()
+        for app_name in saf.app.get_all_app_names():
+            try:
+                app = saf.app.Application(app_name, process_table)
+                pids = app.pids()
+            except (SafConfigException, SafExecutionException) as e:
+                logger.warn('cannot collect metrics of %s: %s' % (app_name, e))
+                continue
+            labels = 'app="%s"' % _escape_label(app_name)
+            usage = {'cpu_time': 0.0, 'rss': 0, 'num_fds': 0, 'num_threads': 0}
+            num_processes = 0
+            cpu_seen = dict()
+            for pid in pids:
+                try:
+                    current = saf.app.process_usage(psutil.Process(pid))
+                except (psutil.NoSuchProcess, psutil.AccessDenied) as e:
+                    logger.debug('cannot sample pid %s: %s' % (pid, e))
+                    continue
+                num_processes += 1
+                cpu_seen[(pid, current['create_time'])] = current['cpu_time']
+                for key in usage.keys():
+                    usage[key] += current[key]
+            # the counter must not go down when processes end, so their last known CPU time is
+            # kept. CPU time used after the previous refresh by an ended process is not counted
+            for process_key, cpu_time in self._cpu_seen.get(app_name, dict()).items():
+                if process_key not in cpu_seen.keys():
+                    self._cpu_ended[app_name] = self._cpu_ended.get(app_name, 0.0) + cpu_time
+            self._cpu_seen[app_name] = cpu_seen
+            samples.append(('saf_app_up', labels, 1 if num_processes > 0 else 0))
+            samples.append(('saf_app_processes', labels, num_processes))
+            samples.append(('saf_app_cpu_seconds_total', labels,
+                            self._cpu_ended.get(app_name, 0.0) + usage['cpu_time']))
+            samples.append(('saf_app_resident_memory_bytes', labels, usage['rss']))
+            samples.append(('saf_app_open_fds', labels, usage['num_fds']))
+            samples.append(('saf_app_threads', labels, usage['num_threads']))
+            if num_processes > 0:
+                try:
+                    checks.extend(app.checks())
+                except SafConfigException as e:
+                    logger.warn('cannot collect checks of %s: %s' % (app_name, e))
+        return samples, checks
+
+    @safutils.method_trace
+    def _collect_checks(self, checks):
+        saf.app._run_checks(checks, self.check_parallel)
+        samples = []
+        for check in checks:
+            labels = 'app="%s",check="%s"' % (_escape_label(check['app']),
+                                              _escape_label(check['name']))
+            samples.append(('saf_app_check_success', labels, 1 if check['success'] else 0))
+            samples.append(('saf_app_check_latency_seconds', labels, round(check['latency'], 3)))
+        return samples
+
+    @safutils.method_trace
+    def refresh(self):
+        start_time = time.time()
+        try:
+            self._samples, checks = self._collect_apps()
+            # checks are slower and put load on the apps, so they run less often
+            if self._last_check_time is None or \
+                    start_time - self._last_check_time >= self.check_interval:
+                self._check_samples = self._collect_checks(checks)
+                self._last_check_time = start_time
+        except Exception as e:
+            # keep serving the previous values
+            logger.exception('refreshing metrics failed: %s' % e)
+            self._errors += 1
+
+        end_time = time.time()
+        samples = self._samples + self._check_samples + [
+            ('saf_exporter_last_refresh_timestamp_seconds', None, round(end_time, 3)),
+            ('saf_exporter_refresh_duration_seconds', None, round(end_time - start_time, 3)),
+            ('saf_exporter_refresh_errors_total', None, self._errors)]
+
+        lines = []
+        for name, metric_type, help_text in METRICS:
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for sample_name, labels, value in samples:
+                if sample_name != name:
+                    continue
+                if labels is None:
+                    lines.append('%s %s' % (name, value))
+                else:
+                    lines.append('%s{%s} %s' % (name, labels, value))
+        with self._text_lock:
+            self._text = '%s\n' % '\n'.join(lines)
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            self.refresh()
+
+    def stop(self):
+        self._stop.set()
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404, 'Metrics are served on /metrics')
+            return
+        body = self.server.collector.text()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('%s %s' % (self.address_string(), format % args))
+
+
+class _ExporterServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, collector):
+        self.collector = collector
+        BaseHTTPServer.HTTPServer.__init__(self, address, _RequestHandler)
+
+
+@safutils.method_trace
+def serve(address='127.0.0.1', port=None, interval=None, check_interval=None):
+    """
+    Serve app metrics on http://address:port/metrics until interrupted
+    :param address: The address to listen on
+    :param port: The port to listen on. Defaults to exporter.port of saf.conf or 9561
+    :param interval: Seconds between refreshes of the process metrics. Defaults to
+        exporter.interval of saf.conf or 15
+    :param check_interval: Seconds between runs of the app checks. Defaults to
+        exporter.check_interval of saf.conf or 60
+    """
+    try:
+        if port is None:
+            port = int(saf.config.get('exporter.port', 9561))
+        if interval is None:
+            interval = float(saf.config.get('exporter.interval', 15))
+        if check_interval is None:
+            check_interval = float(saf.config.get('exporter.check_interval', 60))
+    except ValueError as e:
+        raise SafConfigException('invalid exporter configuration: %s' % e)
+    if interval <= 0 or check_interval <= 0:
+        raise SafExecutionException('Intervals must be greater than 0')
+
+    collector = _MetricsCollector(interval, check_interval, saf.app.check_parallelism())
+    # serve complete metrics from the first scrape on
+    collector.refresh()
+
+    try:
+        server = _ExporterServer((address, port), collector)
+    except IOError as e:
+        raise SafExecutionException('Cannot listen on %s:%s: %s' % (address, port, e))
+
+    collector_thread = threading.Thread(target=collector.run)
+    collector_thread.daemon = True
+    collector_thread.start()
+
+    logger.info('saf exporter serving metrics on http://%s:%s/metrics' % (address, port))
+    safutils.interrupt_on_sigterm()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.debug('KeyboardInterrupt')
+    finally:
+        collector.stop()
+        server.server_close()
+        logger.info('saf exporter stopped')
+    return 0
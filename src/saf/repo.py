@@ -101,9 +101,10 @@ class MixinRepo(object):
         if not os.path.exists(abs_inode):
             raise SafRepositoryException('No file named %s' % inode_name)
         if os.path.isdir(abs_inode):
-            shutil.copytree(abs_inode, os.path.join(target_name, os.path.basename(inode_name)))
+            safutils.copy_tree(abs_inode, os.path.join(target_name, os.path.basename(inode_name)))
         else:
-            shutil.copy2(abs_inode, os.path.join(target_name, os.path.basename(inode_name)))
+            safutils.copy_files(
+                [(abs_inode, os.path.join(target_name, os.path.basename(inode_name)))])
 
     @safutils.method_trace
     def copy_inode_content(self, inode_name, target_name):
@@ -115,12 +116,8 @@ class MixinRepo(object):
             raise SafRepositoryException('No inode named %s' % abs_parent)
         if not os.path.isdir(target_name):
             raise SafRepositoryException('Target directory %s does not exist' % target_name)
-        for inode in os.listdir(abs_parent):
-
-            if os.path.isdir(os.path.join(abs_parent, inode)):
-                shutil.copytree(os.path.join(abs_parent, inode), os.path.join(target_name, inode))
-            else:
-                shutil.copy2(os.path.join(abs_parent, inode), os.path.join(target_name, inode))
+        # no hardlinks, the copies are rendered in place
+        safutils.copy_tree(abs_parent, target_name)
 
     @safutils.method_trace
     def get_app_overlay(self, app_name):
@@ -251,7 +248,8 @@ def pull(app_name, app_version, ignore_mr=False, deploy=False, iknow=False, bran
             logger.info('Please merge and retry (or use --ignore_mr to ignore).')
             return 1
 
-    # Create new tx
+    # Create new tx. Files are added by hardlinking them, the temporary copies are wiped after
+    # each step
     app_tx = saf.tx.Transaction()
     app_tx.meta['app_name'] = app_name
     app_tx.meta['app_version'] = app_version
@@ -262,7 +260,7 @@ def pull(app_name, app_version, ignore_mr=False, deploy=False, iknow=False, bran
 
     # ...then add artifact...
     repo.download_recursive('%s/%s' % (app_name, app_version), tmp_dir_name)
-    app_tx.add_directory_content(tmp_dir_name, parent_dir='instance')
+    app_tx.add_directory_content(tmp_dir_name, parent_dir='instance', hardlink=True)
     safutils.wipe_dir(tmp_dir_name)
 
     mixin_repo.copy_inode('apps/%s/app.conf' % app_name, tmp_dir_name)
@@ -271,7 +269,7 @@ def pull(app_name, app_version, ignore_mr=False, deploy=False, iknow=False, bran
         safutils.render_template('%s/app.conf' % tmp_dir_name, app_vars)
     app_conf = safutils.parse_kv_file('%s/app.conf' % tmp_dir_name)
     os.rename('%s/app.conf' % tmp_dir_name, '%s/conf' % tmp_dir_name)
-    app_tx.add_directory_content(tmp_dir_name)
+    app_tx.add_directory_content(tmp_dir_name, hardlink=True)
     safutils.wipe_dir(tmp_dir_name)
 
     # ...then overlay with all mixins in order...
@@ -287,7 +285,7 @@ def pull(app_name, app_version, ignore_mr=False, deploy=False, iknow=False, bran
                     for root, dirs, files in os.walk(tmp_dir_name):
                         for filename in files:
                             safutils.render_template(os.path.join(root, filename), mixin_vars)
-                app_tx.add_directory_content(tmp_dir_name, parent_dir='instance')
+                app_tx.add_directory_content(tmp_dir_name, parent_dir='instance', hardlink=True)
                 safutils.wipe_dir(tmp_dir_name)
             else:
                 raise SafConfigException('no mixin named %s' % mixin_name)
@@ -299,7 +297,7 @@ def pull(app_name, app_version, ignore_mr=False, deploy=False, iknow=False, bran
             for root, dirs, files in os.walk(tmp_dir_name):
                 for filename in files:
                     safutils.render_template(os.path.join(root, filename), app_vars)
-        app_tx.add_directory_content(tmp_dir_name, parent_dir='instance')
+        app_tx.add_directory_content(tmp_dir_name, parent_dir='instance', hardlink=True)
         safutils.wipe_dir(tmp_dir_name)
 
     app_tx.commit()
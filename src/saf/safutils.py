@@ -4,16 +4,33 @@ from __future__ import print_function
 
 import ConfigParser
 import StringIO
+import bisect
+import ctypes
+import ctypes.util
+import difflib
+import errno
+import fcntl
+import hashlib
 import inspect
 import itertools
+import json
 import os
 import re
+import select
 import shlex
 import shutil
+import signal
+import stat
+import struct
 import subprocess
+import sys
+import tempfile
 import threading
+import time
 import urllib
 
+from multiprocessing.pool import ThreadPool
+
 import saf
 
 from saf.exceptions import *
@@ -40,6 +57,16 @@ def method_trace(fn):
     return wrapper
 
 
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt('signal %s' % signum)
+
+
+def interrupt_on_sigterm():
+    """ Let SIGTERM raise KeyboardInterrupt in the main thread so that long running commands (e.g.
+    servers) can clean up the same way as on Ctrl-C """
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+
+
 @method_trace
 def command_rc(cmd, cwd=None, assert_rc=True, silent=True):
     """
@@ -255,6 +282,36 @@ def parse_kv_file(file_name):
         raise SafConfigException('Could not parse file: %s' % e)
 
 
+# file name -> ((mtime, size, inode), parsed dict)
+_kv_file_cache = dict()
+_kv_file_cache_lock = threading.Lock()
+
+
+@method_trace
+def parse_kv_file_cached(file_name):
+    """
+    Retrieve contents of plain key=value file like parse_kv_file() but parse every file only once
+    per process as long as its mtime, size and inode do not change
+    :param file_name: The name of the file
+    :raises SafConfigException if the file could not be parsed
+    :return: dict containing all key/value pairs. The dict is a copy and may be modified
+    """
+    try:
+        stat = os.stat(file_name)
+    except OSError as e:
+        raise SafConfigException('Could not parse file: %s' % e)
+    key = (stat.st_mtime, stat.st_size, stat.st_ino)
+    with _kv_file_cache_lock:
+        cached = _kv_file_cache.get(file_name)
+    if cached is None or cached[0] != key:
+        cached = (key, parse_kv_file(file_name))
+        with _kv_file_cache_lock:
+            _kv_file_cache[file_name] = cached
+    else:
+        logger.debug('cache hit:%s' % file_name)
+    return dict(cached[1])
+
+
 @method_trace
 def encrypt(literal):
     literal = ' '.join(literal)
@@ -337,6 +394,229 @@ def render_template(file_name, overlay_dict):
         f.close()
 
 
+# Above this number of differing lines a region without unique common lines is not searched for
+# common lines anymore but replaced as a whole
+_MYERS_MAX_COST = 1000
+
+
+def _myers_matches(a, b, a0, a1, b0, b1):
+    """
+    Find a shortest edit script between a[a0:a1] and b[b0:b1] (Myers, O((N+M)D))
+    :return: List of matching (index in a, index in b) or None if more than _MYERS_MAX_COST lines
+        differ
+    """
+    n = a1 - a0
+    m = b1 - b0
+    v = {1: 0}
+    trace = []
+    for d in range(0, min(n + m, _MYERS_MAX_COST) + 1):
+        trace.append(dict(v))
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]
+            else:
+                x = v[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[a0 + x] == b[b0 + y]:
+                x += 1
+                y += 1
+            v[k] = x
+            if x >= n and y >= m:
+                # walk back through the trace and collect the diagonals
+                matches = []
+                for prev_d in range(d, -1, -1):
+                    prev_v = trace[prev_d]
+                    k = x - y
+                    if k == -prev_d or (k != prev_d and prev_v[k - 1] < prev_v[k + 1]):
+                        prev_k = k + 1
+                    else:
+                        prev_k = k - 1
+                    prev_x = prev_v[prev_k]
+                    prev_y = prev_x - prev_k
+                    while x > prev_x and y > prev_y:
+                        x -= 1
+                        y -= 1
+                        matches.append((a0 + x, b0 + y))
+                    x = prev_x
+                    y = prev_y
+                return matches
+    return None
+
+
+def _patience_anchors(a, b, a0, a1, b0, b1):
+    """
+    :return: The longest list of (index in a, index in b) of lines which occur exactly once in both
+        a[a0:a1] and b[b0:b1], ascending in both indexes
+    """
+    counts = dict()
+    for i in range(a0, a1):
+        entry = counts.setdefault(a[i], [0, 0, i])
+        entry[0] += 1
+    for j in range(b0, b1):
+        entry = counts.get(b[j])
+        if entry is not None:
+            entry[1] += 1
+            entry.append(j)
+    candidates = sorted([(count[2], count[3]) for count in counts.values() if
+                         count[0] == 1 and count[1] == 1])
+    if len(candidates) == 0:
+        return []
+
+    # longest increasing subsequence of the b indexes (patience sorting)
+    pile_tops = []
+    tops_j = []
+    back = []
+    for pos, (i, j) in enumerate(candidates):
+        pile = bisect.bisect_left(tops_j, j)
+        back.append(pile_tops[pile - 1] if pile > 0 else None)
+        if pile == len(pile_tops):
+            pile_tops.append(pos)
+            tops_j.append(j)
+        else:
+            pile_tops[pile] = pos
+            tops_j[pile] = j
+    result = []
+    pos = pile_tops[-1]
+    while pos is not None:
+        result.append(candidates[pos])
+        pos = back[pos]
+    result.reverse()
+    return result
+
+
+@method_trace
+def matching_blocks(a, b):
+    """
+    Find the common lines of a and b (patience diff, Myers diff between the anchors). Regions
+    without common unique lines and more than _MYERS_MAX_COST differences count as replaced
+    :param a: List of hashable items (e.g. lines)
+    :param b: List of hashable items
+    :return: List of (index in a, index in b, length) like difflib.SequenceMatcher
+        .get_matching_blocks() including the final (len(a), len(b), 0)
+    """
+    # compare small ints instead of strings
+    ids = dict()
+    a = [ids.setdefault(item, len(ids)) for item in a]
+    b = [ids.setdefault(item, len(ids)) for item in b]
+
+    matches = []
+    pending = [(0, len(a), 0, len(b))]
+    while len(pending) > 0:
+        a0, a1, b0, b1 = pending.pop()
+        while a0 < a1 and b0 < b1 and a[a0] == b[b0]:
+            matches.append((a0, b0))
+            a0 += 1
+            b0 += 1
+        while a0 < a1 and b0 < b1 and a[a1 - 1] == b[b1 - 1]:
+            a1 -= 1
+            b1 -= 1
+            matches.append((a1, b1))
+        if a0 == a1 or b0 == b1:
+            continue
+        anchors = _patience_anchors(a, b, a0, a1, b0, b1)
+        if len(anchors) > 0:
+            prev_i = a0
+            prev_j = b0
+            for i, j in anchors:
+                pending.append((prev_i, i, prev_j, j))
+                matches.append((i, j))
+                prev_i = i + 1
+                prev_j = j + 1
+            pending.append((prev_i, a1, prev_j, b1))
+        else:
+            matches.extend(_myers_matches(a, b, a0, a1, b0, b1) or [])
+
+    blocks = []
+    for i, j in sorted(matches):
+        if len(blocks) > 0 and blocks[-1][0] + blocks[-1][2] == i and \
+                blocks[-1][1] + blocks[-1][2] == j:
+            blocks[-1][2] += 1
+        else:
+            blocks.append([i, j, 1])
+    blocks.append([len(a), len(b), 0])
+    return [tuple(block) for block in blocks]
+
+
+class _BlockMatcher(difflib.SequenceMatcher):
+    """ SequenceMatcher which uses precomputed matching blocks (see matching_blocks()) instead of
+    its own quadratic search, so that its opcode grouping can be reused """
+
+    def __init__(self, a, b, blocks):
+        difflib.SequenceMatcher.__init__(self, None, [], [])
+        self.a = a
+        self.b = b
+        self.matching_blocks = blocks
+        self.opcodes = None
+
+
+def _unified_range(start, length):
+    if length == 1:
+        return '%s' % (start + 1)
+    if length == 0:
+        return '%s,0' % start
+    return '%s,%s' % (start + 1, length)
+
+
+@method_trace
+def log_file_diff(from_file, to_file, from_label, to_label):
+    """
+    log.info the unified diff of two text files line by line. Files larger than diff.max_size of
+    saf.conf (default 10 MB) are not read. If more than diff.max_lines lines (default 5000) differ
+    then only their number is logged
+    :param from_file: The old file
+    :param to_file: The new file
+    :param from_label: Name of the old file in the output
+    :param to_label: Name of the new file in the output
+    :return: The number of differing lines or None if the files were not compared line by line
+    """
+    try:
+        max_size = int(saf.config.get('diff.max_size', 10485760))
+        max_lines = int(saf.config.get('diff.max_lines', 5000))
+    except ValueError as e:
+        raise SafConfigException('invalid diff limit: %s' % e)
+
+    logger.info('--- %s' % from_label)
+    logger.info('+++ %s' % to_label)
+    if is_binary(from_file) or is_binary(to_file):
+        logger.info('(binary files differ)\n')
+        return None
+    from_size = os.path.getsize(from_file)
+    to_size = os.path.getsize(to_file)
+    if from_size > max_size or to_size > max_size:
+        logger.info('(files differ, %s and %s bytes, not compared above diff.max_size=%s)\n' % (
+            from_size, to_size, max_size))
+        return None
+
+    with open(from_file) as data:
+        a = data.readlines()
+    with open(to_file) as data:
+        b = data.readlines()
+    matcher = _BlockMatcher(a, b, matching_blocks(a, b))
+    changed = sum([(i2 - i1) + (j2 - j1) for tag, i1, i2, j1, j2 in matcher.get_opcodes() if
+                   tag != 'equal'])
+    if changed > max_lines:
+        logger.info('(files differ, %s lines changed, more than diff.max_lines=%s)\n' % (
+            changed, max_lines))
+        return changed
+
+    for group in matcher.get_grouped_opcodes(3):
+        first = group[0]
+        last = group[-1]
+        logger.info('@@ -%s +%s @@' % (_unified_range(first[1], last[2] - first[1]),
+                                       _unified_range(first[3], last[4] - first[3])))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                for line in a[i1:i2]:
+                    logger.info(' %s' % line.rstrip('\n'))
+                continue
+            for line in a[i1:i2]:
+                logger.info('-%s' % line.rstrip('\n'))
+            for line in b[j1:j2]:
+                logger.info('+%s' % line.rstrip('\n'))
+    logger.info('')
+    return changed
+
+
 # http://stackoverflow.com/questions/3685195/line-up-columns-of-numbers-print-output-in-table-format#3685943
 @method_trace
 def align_columns(lines, is_left_align=True):
@@ -378,16 +658,649 @@ def directory_size(path):
         for f in filenames:
             fp = os.path.join(dirpath, f)
             try:
-                stat = os.stat(fp)
+                file_stat = os.stat(fp)
             except OSError:
                 continue
-            if stat.st_ino in seen:
+            if file_stat.st_ino in seen:
                 continue
-            seen.add(stat.st_ino)
-            total_size += stat.st_size
+            seen.add(file_stat.st_ino)
+            total_size += file_stat.st_size
     return total_size  # size in bytes
 
 
+@method_trace
+def _scan_size_index_dir(dir_name):
+    """
+    Collect the size information of the files directly inside dir_name. Files which are
+    hardlinked within dir_name count once
+    :return: size index entry [mtime, size of the files, [names of subdirectories]]
+    """
+    size = 0
+    linked = set()
+    subdirs = []
+    for entry in os.listdir(dir_name):
+        entry_abs = os.path.join(dir_name, entry)
+        try:
+            entry_stat = os.lstat(entry_abs)
+            if stat.S_ISDIR(entry_stat.st_mode):
+                subdirs.append(entry)
+                continue
+            if stat.S_ISLNK(entry_stat.st_mode):
+                # like os.walk, symlinked directories are not followed but symlinked files count
+                entry_stat = os.stat(entry_abs)
+                if stat.S_ISDIR(entry_stat.st_mode):
+                    continue
+        except OSError:
+            continue
+        if entry_stat.st_nlink > 1:
+            if entry_stat.st_ino in linked:
+                continue
+            linked.add(entry_stat.st_ino)
+        size += entry_stat.st_size
+    return [os.stat(dir_name).st_mtime, size, subdirs]
+
+
+@method_trace
+def _refresh_size_index_entry(path, old_dirs):
+    """
+    Rescan the tree below path but only list directories whose mtime changed since old_dirs has
+    been built. Files which change in place do not change their directory mtime, so their growth
+    is only noticed by the next full scan
+    :param path: The root of the tree
+    :param old_dirs: dict of relative directory name to index entry (see _scan_size_index_dir)
+    :return: (total size in bytes, new dict of relative directory name to index entry)
+    """
+    dirs = dict()
+    pending = ['']
+    while len(pending) > 0:
+        rel_dir = pending.pop()
+        abs_dir = os.path.join(path, rel_dir) if rel_dir != '' else path
+        try:
+            old_entry = old_dirs.get(rel_dir)
+            if old_entry is not None and old_entry[0] == os.stat(abs_dir).st_mtime:
+                entry = old_entry
+            else:
+                entry = _scan_size_index_dir(abs_dir)
+        except OSError:
+            continue
+        dirs[rel_dir] = entry
+        pending.extend([os.path.join(rel_dir, subdir) for subdir in entry[2]])
+
+    total_size = sum([dir_entry[1] for dir_entry in dirs.values()])
+    return total_size, dirs
+
+
+class JsonIndex(object):
+    """ A JSON index file in var/, locked while in use. The entries are a dict which the user
+    changes in place, setting modified writes them back when the with block ends. Files of another
+    version are ignored, the index is then rebuilt by its user. If var/ is not writable the index
+    is only read, without lock """
+
+    def __init__(self, name, version):
+        """
+        :param name: The file name of the index in var/
+        :param version: The version of the entry format
+        """
+        self._file_name = os.path.join(saf.config['basedir'], 'var', name)
+        self._version = version
+
+    def __enter__(self):
+        self.modified = False
+        try:
+            self._lock_file = open('%s.lock' % self._file_name, 'a')
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        except IOError as e:
+            if e.errno not in [errno.EACCES, errno.EPERM, errno.EROFS]:
+                raise
+            logger.debug('using %s read-only: %s' % (self._file_name, e))
+            self._lock_file = None
+        try:
+            with open(self._file_name) as index_file:
+                index = json.load(index_file)
+            if index.get('version') != self._version:
+                raise ValueError('unknown version %s' % index.get('version'))
+            self.entries = index['entries']
+        except (IOError, ValueError, KeyError, AttributeError) as e:
+            logger.debug('starting new %s: %s' % (self._file_name, e))
+            self.entries = dict()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self._lock_file is None:
+            return
+        try:
+            if self.modified and exc_type is None:
+                with open('%s.tmp' % self._file_name, 'w') as index_file:
+                    json.dump({'version': self._version, 'entries': self.entries}, index_file)
+                os.rename('%s.tmp' % self._file_name, self._file_name)
+        finally:
+            self._lock_file.close()
+
+
+def _size_index():
+    """ The size index var/size.index. It maps directory trees to the time of their last full
+    scan and their directories (see _scan_size_index_dir()) """
+    return JsonIndex('size.index', 2)
+
+
+@method_trace
+def indexed_directory_sizes(paths, max_age=None):
+    """
+    Return the sizes of directory trees like directory_size() but use (and maintain) the size
+    index in var/ so that only directories which changed since the last call are listed. The
+    index is read and written once for all trees
+    :param paths: The roots of the directory trees
+    :param max_age: Completely rescan trees which have not been for max_age seconds. Files which
+        change in place (e.g. logs) do not change the mtime of their directory, so without max_age
+        their growth is only noticed by update_directory_size()
+    :return: dict of path to size in bytes
+    """
+    result = dict()
+    now = time.time()
+    with _size_index() as index:
+        for path in paths:
+            abs_path = os.path.abspath(path)
+            old_entry = index.entries.get(abs_path)
+            if old_entry is None or (max_age is not None and now - old_entry['time'] > max_age):
+                result[path], dirs = _refresh_size_index_entry(abs_path, dict())
+                index.entries[abs_path] = {'time': now, 'dirs': dirs}
+                index.modified = True
+            else:
+                result[path], dirs = _refresh_size_index_entry(abs_path, old_entry['dirs'])
+                if dirs != old_entry['dirs']:
+                    index.entries[abs_path] = {'time': old_entry['time'], 'dirs': dirs}
+                    index.modified = True
+    logger.debug('result:%s' % result)
+    return result
+
+
+@method_trace
+def indexed_directory_size(path, max_age=None):
+    """
+    Return the size of directory tree path (see indexed_directory_sizes())
+    :param path: The root of the directory tree
+    :param max_age: See indexed_directory_sizes()
+    :return: Size in bytes
+    """
+    return indexed_directory_sizes([path], max_age)[path]
+
+
+@method_trace
+def update_directory_size(path):
+    """
+    Completely rescan directory tree path and store the result in the size index. Call this after
+    a tree was created or modified
+    :param path: The root of the directory tree
+    :return: Size in bytes
+    """
+    path = os.path.abspath(path)
+    with _size_index() as index:
+        total_size, dirs = _refresh_size_index_entry(path, dict())
+        index.entries[path] = {'time': time.time(), 'dirs': dirs}
+        index.modified = True
+    return total_size
+
+
+@method_trace
+def forget_directory_size(path):
+    """ Remove directory tree path from the size index. Call this after removing the tree """
+    path = os.path.abspath(path)
+    with _size_index() as index:
+        if path in index.entries.keys():
+            del index.entries[path]
+            index.modified = True
+
+
+def _object_store_dir():
+    return os.path.join(saf.config['basedir'], 'var', 'objects')
+
+
+@method_trace
+def object_store_enabled():
+    """ Whether transaction files are deduplicated in the object store (tx.object_store in
+    saf.conf, default true) """
+    value = saf.config.get('tx.object_store', 'true')
+    if value not in ['true', 'false']:
+        raise SafConfigException('invalid tx.object_store: must be true or false, found %s' % value)
+    return value == 'true'
+
+
+def _file_sha1(file_name):
+    digest = hashlib.sha1()
+    with open(file_name, 'rb') as data:
+        while True:
+            chunk = data.read(1024 * 1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@method_trace
+def _link_to_object(file_name, object_name):
+    """
+    Make file_name a hardlink of object_name. If the object does not exist yet then file_name
+    becomes the object
+    :return: True if file_name now shares its inode with the object
+    """
+    while True:
+        try:
+            os.link(file_name, object_name)
+            return True
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # replace file_name by a link to the existing object
+        tmp_name = '%s.saf-link' % file_name
+        try:
+            os.link(object_name, tmp_name)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                # object pruned in the meantime, create it again
+                continue
+            if e.errno == errno.EMLINK:
+                logger.debug('too many links to %s, keeping %s' % (object_name, file_name))
+                return False
+            raise
+        os.rename(tmp_name, file_name)
+        return True
+
+
+@method_trace
+def store_tree(path, manifest=None):
+    """
+    Deduplicate the regular files of directory tree path using the content addressed object store
+    in var/objects. Every file is replaced by a hardlink to the object with the same content and
+    permissions (the first file with a new content becomes the object itself). Linked files share
+    mtime and owner with the object. The tree must not be modified in place afterwards
+    :param path: The root of the directory tree
+    :param manifest: Manifest of path (see tree_manifest()). Its hashes are used instead of
+        reading the files again and its mtimes are updated for the linked files
+    :return: (number of files, number of files which were already in the store)
+    """
+    store_dir = _object_store_dir()
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir, mode=0o0755)
+    if os.stat(store_dir).st_dev != os.stat(path).st_dev:
+        logger.warn('%s is not on the file system of %s, not deduplicating' % (path, store_dir))
+        return 0, 0
+
+    files = 0
+    known = 0
+    for dir_name, sub_dirs, file_names in os.walk(path):
+        for file_name in file_names:
+            file_abs = os.path.join(dir_name, file_name)
+            file_stat = os.lstat(file_abs)
+            if not stat.S_ISREG(file_stat.st_mode):
+                continue
+            files += 1
+            rel_name = os.path.relpath(file_abs, path)
+            if manifest is not None and rel_name in manifest.keys():
+                digest = manifest[rel_name][3]
+            else:
+                digest = _file_sha1(file_abs)
+            object_dir = os.path.join(store_dir, digest[:2])
+            object_name = os.path.join(object_dir, '%s.%o' % (digest[2:],
+                                                             stat.S_IMODE(file_stat.st_mode)))
+            try:
+                object_stat = os.stat(object_name)
+                known += 1
+                if object_stat.st_ino == file_stat.st_ino and \
+                        object_stat.st_dev == file_stat.st_dev:
+                    continue
+            except OSError:
+                if not os.path.isdir(object_dir):
+                    try:
+                        os.mkdir(object_dir, 0o0755)
+                    except OSError as e:
+                        if e.errno != errno.EEXIST:
+                            raise
+            if _link_to_object(file_abs, object_name) and manifest is not None and \
+                    rel_name in manifest.keys():
+                manifest[rel_name][2] = int(os.stat(file_abs).st_mtime)
+    logger.debug('files:%s known:%s' % (files, known))
+    return files, known
+
+
+@method_trace
+def hash_files(file_names, threads=None):
+    """
+    Compute the sha1 of many files concurrently
+    :param file_names: List of file names
+    :param threads: Number of files read at the same time. Defaults to copy.threads of saf.conf
+        or 4
+    :return: dict file name -> hex digest
+    """
+    return dict(zip(file_names, _map_concurrently(_file_sha1, file_names, threads)))
+
+
+@method_trace
+def tree_manifest(path, exclude=None, threads=None):
+    """
+    Describe the files of directory tree path (symlinks are followed like by os.walk)
+    :param path: The root of the directory tree
+    :param exclude: List of names directly inside path which are left out
+    :param threads: See hash_files()
+    :return: dict relative file name -> [size, permissions, mtime in seconds, sha1]
+    """
+    result = dict()
+    for dir_name, sub_dirs, file_names in os.walk(path):
+        if dir_name == path and exclude is not None:
+            sub_dirs[:] = [name for name in sub_dirs if name not in exclude]
+            file_names = [name for name in file_names if name not in exclude]
+        for file_name in file_names:
+            file_abs = os.path.join(dir_name, file_name)
+            try:
+                file_stat = os.stat(file_abs)
+            except OSError as e:
+                logger.debug('skipping %s: %s' % (file_abs, e))
+                continue
+            result[os.path.relpath(file_abs, path)] = [
+                file_stat.st_size, stat.S_IMODE(file_stat.st_mode), int(file_stat.st_mtime), None]
+    digests = hash_files([os.path.join(path, rel_name) for rel_name in result.keys()], threads)
+    for rel_name in result.keys():
+        result[rel_name][3] = digests[os.path.join(path, rel_name)]
+    return result
+
+
+@method_trace
+def prune_object_store():
+    """
+    Remove objects which are not linked from any transaction anymore
+    :return: The number of bytes freed
+    """
+    store_dir = _object_store_dir()
+    if not os.path.isdir(store_dir):
+        return 0
+    freed = 0
+    for object_dir in os.listdir(store_dir):
+        object_dir_abs = os.path.join(store_dir, object_dir)
+        for object_name in os.listdir(object_dir_abs):
+            object_abs = os.path.join(object_dir_abs, object_name)
+            try:
+                object_stat = os.lstat(object_abs)
+                if object_stat.st_nlink == 1:
+                    os.remove(object_abs)
+                    freed += object_stat.st_size
+            except OSError as e:
+                logger.debug('cannot prune %s: %s' % (object_abs, e))
+        try:
+            os.rmdir(object_dir_abs)
+        except OSError:
+            # not empty
+            pass
+    logger.debug('freed:%s' % freed)
+    return freed
+
+
+# ioctl which makes a file share the data blocks of another one (btrfs, xfs)
+_FICLONE = 0x40049409
+_copy_libc = None
+_copy_file_range_missing = False
+# (source device, target device) pairs which cannot reflink
+_no_reflink_devices = set()
+
+
+def _copy_file_range(src_fd, dst_fd, size):
+    """
+    Copy size bytes in kernel space. Copies on the same file system are often offloaded (server
+    side copy on nfs, shared extents on some file systems)
+    :return: False if copy_file_range is not available for these files
+    """
+    global _copy_libc, _copy_file_range_missing
+    if _copy_file_range_missing:
+        return False
+    if _copy_libc is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            libc.copy_file_range.restype = ctypes.c_ssize_t
+            libc.copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                                             ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+            _copy_libc = libc
+        except (OSError, AttributeError) as e:
+            logger.debug('copy_file_range not available: %s' % e)
+            _copy_file_range_missing = True
+            return False
+    copied = 0
+    while copied < size:
+        result = _copy_libc.copy_file_range(src_fd, None, dst_fd, None, size - copied, 0)
+        if result < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if err == errno.ENOSYS:
+                _copy_file_range_missing = True
+            if copied == 0 and err in [errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+                                       errno.EBADF]:
+                return False
+            raise OSError(err, os.strerror(err))
+        if result == 0:
+            # file shrunk while copying
+            break
+        copied += result
+    return True
+
+
+def _copy_file(src, dst, hardlink):
+    """
+    Copy the file src to dst like shutil.copy2, using the cheapest method available. An existing
+    dst is replaced, never written through (it may be a hardlink of src or of a stored object)
+    :return: The method used: link, reflink, copy_file_range or copy
+    """
+    tmp_name = '%s.saf-copy' % dst
+    if hardlink:
+        try:
+            os.link(src, tmp_name)
+            os.rename(tmp_name, dst)
+            return 'link'
+        except OSError as e:
+            if e.errno not in [errno.EXDEV, errno.EMLINK, errno.EPERM]:
+                raise
+    try:
+        with open(src, 'rb') as src_file:
+            with open(tmp_name, 'wb') as dst_file:
+                method = 'copy'
+                devices = (os.fstat(src_file.fileno()).st_dev,
+                           os.fstat(dst_file.fileno()).st_dev)
+                if devices not in _no_reflink_devices:
+                    try:
+                        fcntl.ioctl(dst_file.fileno(), _FICLONE, src_file.fileno())
+                        method = 'reflink'
+                    except IOError as e:
+                        logger.debug('no reflink from %s: %s' % (src, e))
+                        _no_reflink_devices.add(devices)
+                if method == 'copy':
+                    if _copy_file_range(src_file.fileno(), dst_file.fileno(),
+                                        os.fstat(src_file.fileno()).st_size):
+                        method = 'copy_file_range'
+                    else:
+                        shutil.copyfileobj(src_file, dst_file, 1024 * 1024)
+        shutil.copystat(src, tmp_name)
+        os.rename(tmp_name, dst)
+    except (IOError, OSError):
+        if os.path.lexists(tmp_name):
+            os.remove(tmp_name)
+        raise
+    return method
+
+
+def _map_concurrently(fn, items, threads, timeout=None):
+    """
+    Call fn for every item using a thread pool of threads threads (default copy.threads of
+    saf.conf or 4)
+    :param timeout: Seconds to wait for all results at most. None waits forever
+    :return: List of the results in the order of items
+    :raise multiprocessing.TimeoutError: If not all results are available after timeout seconds
+    """
+    if threads is None:
+        try:
+            threads = int(saf.config.get('copy.threads', 4))
+        except ValueError as e:
+            raise SafConfigException('invalid copy.threads: %s' % e)
+    if threads < 1:
+        raise SafConfigException('invalid copy.threads: must be at least 1, found %s' % threads)
+
+    if len(items) == 0:
+        return []
+    if timeout is None and (threads == 1 or len(items) < 2):
+        return [fn(item) for item in items]
+    pool = ThreadPool(min(threads, len(items)))
+    try:
+        # map_async().get() with a timeout can be interrupted by Ctrl-C, plain map() cannot
+        return pool.map_async(fn, items).get(sys.maxint if timeout is None else timeout)
+    finally:
+        pool.close()
+
+
+@method_trace
+def copy_files(file_pairs, hardlink=False, threads=None):
+    """
+    Copy many files concurrently. Data is shared with the source where the file system allows it
+    (reflink), else copied by the kernel (copy_file_range) or read and written
+    :param file_pairs: List of (source file, target file). Target directories must exist, existing
+        targets are overwritten
+    :param hardlink: Link instead of copying where possible. Only safe if neither the source nor
+        the target is changed in place afterwards
+    :param threads: Number of files copied at the same time. Defaults to copy.threads of saf.conf
+        or 4
+    :return: dict method -> number of files copied with it
+    """
+    def copy_one(file_pair):
+        return _copy_file(file_pair[0], file_pair[1], hardlink)
+
+    methods = _map_concurrently(copy_one, file_pairs, threads)
+
+    result = dict()
+    for method in methods:
+        result[method] = result.get(method, 0) + 1
+    logger.debug('result:%s' % result)
+    return result
+
+
+@method_trace
+def copy_tree(src, dst, symlinks=False, hardlink=False, threads=None):
+    """
+    Recursively copy directory src to dst using copy_files(). Like shutil.copytree, but dst may
+    exist in which case the trees are merged and existing files are overwritten
+    :param src: The source directory
+    :param dst: The target directory
+    :param symlinks: Copy symlinks as symlinks. If False, the content of their targets is copied
+    :param hardlink: See copy_files()
+    :param threads: See copy_files()
+    :return: dict method -> number of files copied with it
+    """
+    dir_pairs = []
+    file_pairs = []
+    for src_root, src_dirs, src_files in os.walk(src, followlinks=not symlinks):
+        dst_root = os.path.join(dst, os.path.relpath(src_root, src))
+        if not os.path.isdir(dst_root):
+            os.makedirs(dst_root)
+        dir_pairs.append((src_root, dst_root))
+        for name in src_dirs + src_files:
+            src_name = os.path.join(src_root, name)
+            dst_name = os.path.join(dst_root, name)
+            if symlinks and os.path.islink(src_name):
+                if os.path.lexists(dst_name):
+                    os.remove(dst_name)
+                os.symlink(os.readlink(src_name), dst_name)
+            elif name in src_files:
+                file_pairs.append((src_name, dst_name))
+        if symlinks:
+            src_dirs[:] = [name for name in src_dirs
+                           if not os.path.islink(os.path.join(src_root, name))]
+
+    result = copy_files(file_pairs, hardlink=hardlink, threads=threads)
+    # after the files, else copying would change the directory mtimes again
+    for src_dir, dst_dir in reversed(dir_pairs):
+        shutil.copystat(src_dir, dst_dir)
+    return result
+
+
+@method_trace
+def move(src, dst):
+    """
+    Move a file or directory. Between file systems the data is copied with copy_tree() and the
+    source is removed afterwards
+    :param src: The source file or directory
+    :param dst: The target name, which must not exist
+    """
+    try:
+        os.rename(src, dst)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    logger.debug('%s and %s are on different file systems, copying' % (src, dst))
+    if os.path.isdir(src) and not os.path.islink(src):
+        copy_tree(src, dst, symlinks=True)
+        shutil.rmtree(src)
+    else:
+        shutil.move(src, dst)
+
+
+def _trash_dir():
+    return os.path.join(saf.config['basedir'], 'var', 'trash')
+
+
+@method_trace
+def move_to_trash(path):
+    """
+    Remove path from its place by renaming it into var/trash. Renaming is immediate even for large
+    trees, the content is removed by empty_trash(). Paths on other file systems are removed
+    right away
+    :param path: The file or directory to remove
+    """
+    trash_dir = _trash_dir()
+    if not os.path.isdir(trash_dir):
+        os.makedirs(trash_dir, mode=0o0755)
+    holder = tempfile.mkdtemp(prefix='%s.' % os.path.basename(path), dir=trash_dir)
+    try:
+        os.rename(path, os.path.join(holder, os.path.basename(path)))
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            os.rmdir(holder)
+            raise
+        logger.debug('%s is not on the file system of %s, removing it directly' % (
+            path, trash_dir))
+        os.rmdir(holder)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+# Seconds after which empty_trash() removes a holder directory of move_to_trash() which is still
+# empty, e.g. because saf was interrupted. Younger ones may be about to be filled
+_EMPTY_HOLDER_MAX_AGE = 3600
+
+
+@method_trace
+def empty_trash():
+    """
+    Remove the content of var/trash in a background process which outlives saf. Holders which
+    move_to_trash() has not filled yet are left alone
+    :return: The number of removed entries
+    """
+    trash_dir = _trash_dir()
+    if not os.path.isdir(trash_dir):
+        return 0
+    entries = []
+    for entry in os.listdir(trash_dir):
+        holder = os.path.join(trash_dir, entry)
+        try:
+            if len(os.listdir(holder)) > 0 or \
+                    os.stat(holder).st_ctime < time.time() - _EMPTY_HOLDER_MAX_AGE:
+                entries.append(holder)
+        except OSError as e:
+            # removed by a concurrent empty_trash()
+            logger.debug('skipping %s: %s' % (holder, e))
+    if len(entries) > 0:
+        with open(os.devnull, 'r+') as devnull:
+            subprocess.Popen(['rm', '-rf', '--'] + entries, stdin=devnull, stdout=devnull,
+                             stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+    return len(entries)
+
+
 # http://stackoverflow.com/questions/10123929/python-requests-fetch-a-file-from-a-local-url
 class LocalFileAdapter(requests.adapters.BaseAdapter):
     """Protocol Adapter to allow Requests to GET file:// URLs
@@ -482,6 +1395,329 @@ class IKnowhow(object):
         raise NotImplementedError
 
 
+class Inotify(object):
+    """ Minimal binding to the Linux inotify API using ctypes. Use it to wait for file system
+    events instead of polling. The object can be passed to select.select()
+
+    :raises SafExecutionException if inotify is not available on this system
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+
+    _IN_CLOEXEC = 0o2000000
+    _IN_NONBLOCK = 0o4000
+    _EVENT_HEADER = struct.Struct('iIII')
+
+    _libc = None
+
+    @method_trace
+    def __init__(self):
+        if Inotify._libc is None:
+            try:
+                Inotify._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                                            use_errno=True)
+                Inotify._libc.inotify_init1
+            except (OSError, AttributeError) as e:
+                raise SafExecutionException('inotify not available: %s' % e)
+        self._fd = Inotify._libc.inotify_init1(Inotify._IN_NONBLOCK | Inotify._IN_CLOEXEC)
+        if self._fd < 0:
+            raise SafExecutionException(
+                'inotify not available: %s' % os.strerror(ctypes.get_errno()))
+        # watch descriptor -> watched path
+        self._watches = dict()
+
+    def fileno(self):
+        return self._fd
+
+    @method_trace
+    def add_watch(self, path, mask):
+        """
+        Watch path for events
+        :param path: File or directory to watch
+        :param mask: Combination of IN_* flags
+        :raises SafExecutionException if path cannot be watched
+        :return: watch descriptor
+        """
+        wd = Inotify._libc.inotify_add_watch(self._fd, path, mask)
+        if wd < 0:
+            raise SafExecutionException(
+                'Cannot watch %s: %s' % (path, os.strerror(ctypes.get_errno())))
+        self._watches[wd] = path
+        return wd
+
+    @method_trace
+    def rm_watch(self, wd):
+        if wd in self._watches.keys():
+            Inotify._libc.inotify_rm_watch(self._fd, wd)
+            del self._watches[wd]
+
+    def read_events(self, timeout=None):
+        """
+        Wait for events
+        :param timeout: Maximum seconds to wait. None waits forever, 0 does not wait at all
+        :return: List of (watched path, mask, name) tuples. name is '' for events on the watched
+        path itself. The list is empty if the timeout expired
+        """
+        try:
+            readable = select.select([self._fd], [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        if len(readable) == 0:
+            return []
+        try:
+            data = os.read(self._fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, name_len = Inotify._EVENT_HEADER.unpack_from(data, offset)
+            offset += Inotify._EVENT_HEADER.size
+            name = data[offset:offset + name_len].rstrip('\0')
+            offset += name_len
+            if mask & Inotify.IN_IGNORED:
+                self._watches.pop(wd, None)
+            events.append((self._watches.get(wd), mask, name))
+        return events
+
+    @method_trace
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+            self._watches = dict()
+
+
+class LogFollower(object):
+    """ Follow all files below a set of directories like "tail -f" does, but in-process. Files
+    which are created or rotated while following are picked up. Each output line is prefixed
+    with the label of its directory. Uses inotify if available and polls otherwise """
+
+    _CHUNK_SIZE = 65536
+    _POLL_INTERVAL = 1
+    _WATCH_MASK = Inotify.IN_CREATE | Inotify.IN_MODIFY | Inotify.IN_MOVED_TO | \
+                  Inotify.IN_MOVED_FROM | Inotify.IN_DELETE
+
+    @method_trace
+    def __init__(self, dirs, line_filter=None, out_func=None):
+        """
+        :param dirs: dict of label to directory name
+        :param line_filter: Compiled regular expression. Only lines matching it are output
+        :param out_func: Function called with every output line. Defaults to stdout
+        """
+        self._dirs = dirs
+        self._line_filter = line_filter
+        self._out_func = out_func if out_func is not None else self._write_stdout
+        # file name -> [label, file object, inode, incomplete last line]
+        self._files = dict()
+        # inode -> entry of renamed files which are not yet seen under their new name
+        self._moved = dict()
+        # watched directory -> label
+        self._watched = dict()
+        self._inotify = None
+
+    @staticmethod
+    def _write_stdout(line):
+        sys.stdout.write('%s\n' % line)
+        sys.stdout.flush()
+
+    def _open(self, label, file_name, at_end):
+        try:
+            f = open(file_name, 'rb')
+            if at_end:
+                f.seek(0, os.SEEK_END)
+            self._files[file_name] = [label, f, os.fstat(f.fileno()).st_ino, '']
+        except (IOError, OSError) as e:
+            logger.debug('cannot follow %s: %s' % (file_name, e))
+
+    def _close(self, file_name):
+        if file_name in self._files.keys():
+            entry = self._files.pop(file_name)
+            self._read(entry)
+            entry[1].close()
+
+    def _moved_away(self, file_name):
+        """ file_name was renamed (e.g. rotated), keep following it until its new name shows up """
+        if file_name in self._files.keys():
+            entry = self._files.pop(file_name)
+            self._moved[entry[2]] = entry
+
+    def _moved_here(self, file_name):
+        """ Continue following file_name if it is a renamed file. Return True in that case """
+        try:
+            inode = os.stat(file_name).st_ino
+        except OSError:
+            return False
+        if inode in self._moved.keys():
+            self._files[file_name] = self._moved.pop(inode)
+            return True
+        return False
+
+    def _close_moved(self):
+        """ Stop following renamed files which did not show up again """
+        for entry in self._moved.values():
+            self._read(entry)
+            entry[1].close()
+        self._moved = dict()
+
+    def _read(self, entry):
+        label, f, inode, rest = entry
+        try:
+            if os.fstat(f.fileno()).st_size < f.tell():
+                logger.debug('%s truncated' % f.name)
+                f.seek(0)
+            while True:
+                chunk = f.read(LogFollower._CHUNK_SIZE)
+                if chunk == '':
+                    break
+                lines = (rest + chunk).split('\n')
+                rest = lines.pop()
+                for line in lines:
+                    if self._line_filter is None or self._line_filter.search(line):
+                        self._out_func('%s: %s' % (label, line))
+        except (IOError, OSError) as e:
+            logger.debug('cannot read %s: %s' % (f.name, e))
+        entry[3] = rest
+
+    def _add_dir(self, label, dir_name, at_end):
+        """ Start following dir_name and all files and directories below it """
+        for root, dir_names, file_names in os.walk(dir_name):
+            if root not in self._watched.keys():
+                if self._inotify is not None:
+                    try:
+                        self._inotify.add_watch(root, LogFollower._WATCH_MASK)
+                    except SafExecutionException as e:
+                        logger.debug(e)
+                        continue
+                self._watched[root] = label
+            for file_name in file_names:
+                file_abs = os.path.join(root, file_name)
+                if file_abs not in self._files.keys() and not self._moved_here(file_abs):
+                    self._open(label, file_abs, at_end)
+
+    def _rescan(self):
+        """ Catch up with all changes without relying on events """
+        for file_name in list(self._files.keys()):
+            try:
+                if os.stat(file_name).st_ino == self._files[file_name][2]:
+                    continue
+            except OSError:
+                pass
+            self._moved_away(file_name)
+        # renamed files usually have been written to before their successor was created
+        for entry in self._moved.values():
+            self._read(entry)
+        for label, dir_name in self._dirs.items():
+            self._add_dir(label, dir_name, at_end=False)
+        for entry in self._files.values():
+            self._read(entry)
+        self._close_moved()
+
+    def _handle_event(self, dir_name, mask, name):
+        if dir_name is None or mask & Inotify.IN_IGNORED:
+            if dir_name is not None:
+                self._watched.pop(dir_name, None)
+            return
+        label = self._watched.get(dir_name)
+        path = os.path.join(dir_name, name)
+        if mask & Inotify.IN_ISDIR:
+            if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                self._add_dir(label, path, at_end=False)
+            return
+        if mask & Inotify.IN_MOVED_FROM:
+            self._moved_away(path)
+        elif mask & Inotify.IN_DELETE:
+            self._close(path)
+        elif mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+            self._close(path)
+            if not self._moved_here(path):
+                self._open(label, path, at_end=False)
+        elif mask & Inotify.IN_MODIFY:
+            if path not in self._files.keys():
+                self._open(label, path, at_end=False)
+        if path in self._files.keys():
+            self._read(self._files[path])
+
+    @method_trace
+    def follow(self):
+        """ Output new lines forever (i.e. until KeyboardInterrupt) """
+        try:
+            self._inotify = Inotify()
+        except SafExecutionException as e:
+            logger.debug('polling, %s' % e)
+        try:
+            for label, dir_name in self._dirs.items():
+                self._add_dir(label, dir_name, at_end=True)
+            while True:
+                if self._inotify is None:
+                    time.sleep(LogFollower._POLL_INTERVAL)
+                    self._rescan()
+                    continue
+                for dir_name, mask, name in self._inotify.read_events():
+                    if mask & Inotify.IN_Q_OVERFLOW:
+                        self._rescan()
+                    else:
+                        self._handle_event(dir_name, mask, name)
+                self._close_moved()
+        finally:
+            for entry in self._files.values() + self._moved.values():
+                entry[1].close()
+            self._files = dict()
+            self._moved = dict()
+            if self._inotify is not None:
+                self._inotify.close()
+
+
+class JsonOutput(object):
+    """ Output the records of a command (e.g. one per app) as json. By default the records are
+    collected and written as a single json object {key: record, ...} by close(). With ndjson each
+    record is written on its own line as soon as it is added, with the key stored in the record
+    itself, so that consumers can process them while the command is still running """
+
+    @method_trace
+    def __init__(self, key_name, value_name=None, ndjson=False):
+        """
+        :param key_name: Name of the key in ndjson records, e.g. "app"
+        :param value_name: Name of the value in ndjson records if the record values are no dicts
+        :param ndjson: Write newline delimited json
+        """
+        self.key_name = key_name
+        self.value_name = value_name
+        self.ndjson = ndjson
+        self._result = dict()
+
+    def add(self, key, value):
+        if not self.ndjson:
+            self._result[key] = value
+            return
+        if self.value_name is None:
+            record = dict(value)
+        else:
+            record = {self.value_name: value}
+        record[self.key_name] = key
+        logger.info(json.dumps(record, sort_keys=True, default=str))
+
+    def close(self):
+        if not self.ndjson:
+            logger.info(json.dumps(self._result, sort_keys=True, indent=4, separators=(',', ': '),
+                                   default=str))
+
+
 class ImmutableDict(dict):
     """ Use ImmutableDict for handling dicts which are meant to be readonly.
     An attempt to modify the dict leads to AttributeError. This hack is not
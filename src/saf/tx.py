@@ -1,13 +1,17 @@
 # ATTENTION! File managed by Puppet. Changes will be overwritten.
-import difflib
+import errno
+import fcntl
 import filecmp
 import glob
+import json
 import os
 import random
 import re
 import shutil
 import sre_constants
 import string
+import sys
+import tarfile
 import tempfile
 
 import subprocess
@@ -40,7 +44,8 @@ class Transaction(safutils.IKnowhow):
         immediately closed
         As a result, a transaction is immutable
 
-        A transaction is transferred to a running application instance using tx.activate()
+        A transaction is transferred to a running application instance using tx.stage() and
+        _cut_over()
         """
     @safutils.method_trace
     def __init__(self, tx_id=None):
@@ -57,6 +62,7 @@ class Transaction(safutils.IKnowhow):
 
             self.basedir = os.path.join(saf.config['basedir'], 'transactions', self.id)
             self._tmp_dir_name = tempfile.mkdtemp(prefix=self.id, dir=saf.temp_dir)
+            self._manifest = None
 
             self.meta = dict()
 
@@ -71,19 +77,20 @@ class Transaction(safutils.IKnowhow):
         else:
             self._indoubt = False
             self._closed = True
-            if tx_id not in get_transaction_ids():
+            if tx_id in ['', '.', '..'] or os.sep in tx_id or not os.path.isdir(
+                    os.path.join(saf.config['basedir'], 'transactions', tx_id)):
                 raise SafExecutionException(
                     'No transaction with id %s' % tx_id)
             self.id = tx_id
             self.basedir = os.path.join(saf.config['basedir'], 'transactions', self.id)
             self._assert_valid()
             try:
-                self.meta = saf.safutils.parse_kv_file(os.path.join(self.basedir, 'meta'))
+                self.meta = saf.safutils.parse_kv_file_cached(os.path.join(self.basedir, 'meta'))
                 for meta in ['app_name', 'stage', 'app_version', 'tx_type']:
                     if meta not in self.meta.keys():
                         raise SafConfigException(
                             'Cannot load transaction. Metadata "%s" missing' % meta)
-                self._config = safutils.parse_kv_file(os.path.join(self.basedir, 'conf'))
+                self._config = safutils.parse_kv_file_cached(os.path.join(self.basedir, 'conf'))
                 self._knowhow = dict([(key, self._config[key]) for key in self._config.keys() if
                                       key.startswith('knowhow.tx')])
                 # use nicer dict comprehension syntax in py2.7+ instead of above dict()
@@ -94,12 +101,14 @@ class Transaction(safutils.IKnowhow):
                     'Cannot load incomplete transaction %s: %s' % (tx_id, e))
 
     @safutils.method_trace
-    def add_directory_content(self, dir_name, parent_dir='.'):
+    def add_directory_content(self, dir_name, parent_dir='.', hardlink=False):
         """
         Recursively add contents of dir_name to transaction. Overwrite any existing files in
         transaction and log.info the diff
         :param dir_name: Directory to add from
         :param parent_dir: Put dir_name contents in transaction subdir parent_dir
+        :param hardlink: Link the files instead of copying them where possible. Only use it if
+            the files in dir_name are not changed in place afterwards
         :raises SafTransactionException If transaction is indoubt or if any OSError
         """
         if not self._indoubt:
@@ -109,6 +118,7 @@ class Transaction(safutils.IKnowhow):
             if not os.path.exists(os.path.join(self._tmp_dir_name, parent_dir)):
                 os.mkdir(os.path.join(self._tmp_dir_name, parent_dir))
 
+            file_pairs = []
             for src_root, src_dirs, src_files in os.walk(dir_name):
                 dst_root = os.path.join(self._tmp_dir_name, parent_dir,
                                         src_root[len(dir_name) + 1:])
@@ -128,12 +138,12 @@ class Transaction(safutils.IKnowhow):
                         if filecmp.cmp(from_file, to_file):
                             logger.info('(files are identical)')
                         else:
-                            # http://stackoverflow.com/questions/977491/comparing-two-txt-files-using-difflib-in-python
-                            diff_result = difflib.unified_diff(open(to_file).readlines(),
-                                                               open(from_file).readlines())
-                            logger.info(''.join(diff_result))
-                    shutil.copy2(from_file, to_file)
-        except OSError as e:
+                            rel_name = os.path.normpath(os.path.join(
+                                parent_dir, src_root[len(dir_name) + 1:], src_file))
+                            safutils.log_file_diff(to_file, from_file, rel_name, rel_name)
+                    file_pairs.append((from_file, to_file))
+            safutils.copy_files(file_pairs, hardlink=hardlink)
+        except (IOError, OSError) as e:
             raise SafTransactionException(e)
 
     @safutils.method_trace
@@ -143,7 +153,11 @@ class Transaction(safutils.IKnowhow):
         self._closed = False
 
     @safutils.method_trace
-    def commit(self):
+    def commit(self, archive=False):
+        """
+        :param archive: Store the instance of a new transaction as compressed archive (see
+            archive())
+        """
         if self._closed:
             raise SafTransactionException(
                 'Cannot commit, transaction closed')
@@ -153,6 +167,7 @@ class Transaction(safutils.IKnowhow):
                 raise SafTransactionException(
                     'Cannot commit transaction. Metadata incomplete ("%s" missing)' % meta)
 
+        was_indoubt = self._indoubt
         try:
             if self._indoubt:
                 logger.debug('persisting indoubt transaction from %s to %s' % (
@@ -161,7 +176,8 @@ class Transaction(safutils.IKnowhow):
                 for inode in os.listdir(self._tmp_dir_name):
                     logger.debug(
                         'mv "%s" "%s"' % (os.path.join(self._tmp_dir_name, inode), self.basedir))
-                    shutil.move(os.path.join(self._tmp_dir_name, inode), self.basedir)
+                    safutils.move(os.path.join(self._tmp_dir_name, inode),
+                                  os.path.join(self.basedir, inode))
                 os.rmdir(self._tmp_dir_name)
 
             with open(os.path.join(self.basedir, 'meta'), 'w') as meta_file:
@@ -186,42 +202,322 @@ class Transaction(safutils.IKnowhow):
                     shutil.rmtree(self.basedir)
             raise SafTransactionException('Error while persisting transaction: %s' % e)
 
+        if was_indoubt:
+            self._store_content(archive)
+        self._update_index()
+
+    @safutils.method_trace
+    def _update_index(self):
+        size = safutils.update_directory_size(self.basedir)
+        with _tx_index() as index:
+            index.entries[self.id] = _tx_index_entry(self.meta, size, self.is_archived())
+            index.modified = True
+
+    @safutils.method_trace
+    def _store_content(self, archive):
+        """
+        Write the manifest of the transaction (all files except meta) and either archive the
+        instance or deduplicate it in the object store. The transaction stays valid if this fails,
+        it just takes more space and cannot be diffed as fast
+        """
+        try:
+            manifest = self._manifest
+            if manifest is None:
+                manifest = safutils.tree_manifest(self.basedir, exclude=['meta', 'manifest'])
+        except (IOError, OSError) as e:
+            logger.warn('Could not create manifest of transaction %s: %s' % (self.id, e))
+            return
+        if archive:
+            try:
+                self._archive_instance()
+            except (IOError, OSError, tarfile.TarError) as e:
+                logger.warn('Could not archive transaction %s: %s' % (self.id, e))
+        elif safutils.object_store_enabled():
+            try:
+                files, known = safutils.store_tree(os.path.join(self.basedir, 'instance'),
+                                                   _sub_manifest(manifest, 'instance'))
+                logger.debug('%s of %s files already in object store' % (known, files))
+            except (IOError, OSError) as e:
+                logger.warn('Could not deduplicate transaction %s: %s' % (self.id, e))
+        try:
+            _write_manifest(os.path.join(self.basedir, 'manifest'), manifest)
+        except (IOError, OSError) as e:
+            logger.warn('Could not write manifest of transaction %s: %s' % (self.id, e))
+
+    @safutils.method_trace
+    def is_archived(self):
+        return os.path.exists(os.path.join(self.basedir, 'instance.tar.gz'))
+
+    @safutils.method_trace
+    def _archive_instance(self):
+        """
+        Replace the instance directory by instance.tar.gz (see _add_tree())
+        """
+        instance_dir = os.path.join(self.basedir, 'instance')
+        archive_name = os.path.join(self.basedir, 'instance.tar.gz')
+        tar = tarfile.open('%s.tmp' % archive_name, 'w:gz', compresslevel=6)
+        complete = False
+        try:
+            _add_tree(tar, instance_dir)
+            complete = True
+        finally:
+            tar.close()
+            if not complete:
+                os.remove('%s.tmp' % archive_name)
+        os.rename('%s.tmp' % archive_name, archive_name)
+        shutil.rmtree(instance_dir)
+
+    @safutils.method_trace
+    def archive(self):
+        """
+        Store the instance of the transaction as compressed archive. Metadata, conf and manifest
+        stay readable, the instance is only extracted by stage() (or temporarily by diff())
+        :return: False if the transaction was already archived
+        """
+        if not self._closed:
+            raise SafTransactionException('Cannot archive open transaction')
+        if self.is_archived():
+            return False
+        try:
+            self._archive_instance()
+        except (IOError, OSError, tarfile.TarError) as e:
+            raise SafTransactionException('Cannot archive transaction %s: %s' % (self.id, e))
+        self._update_index()
+        return True
+
+    @safutils.method_trace
+    def extract_instance(self, target_dir):
+        """
+        Write the instance of the transaction to the new directory target_dir. An archived
+        instance is decompressed and extracted in one pass
+        """
+        if not self.is_archived():
+            # no hardlinks, the app may change its files in place
+            safutils.copy_tree(os.path.join(self.basedir, 'instance'), target_dir)
+            return
+
+        os.mkdir(target_dir)
+        try:
+            tar = tarfile.open(os.path.join(self.basedir, 'instance.tar.gz'), 'r|gz')
+            try:
+                tar.extractall(target_dir, members=_checked_members(
+                    tar, 'archive of transaction %s' % self.id))
+            finally:
+                tar.close()
+        except (IOError, OSError, tarfile.TarError) as e:
+            raise SafTransactionException(
+                'Cannot extract archive of transaction %s: %s' % (self.id, e))
+
+    @safutils.method_trace
+    def export(self, fileobj):
+        """
+        Write the transaction as gzip compressed tar stream to fileobj. All files are below the
+        directory <txid>. meta, conf and manifest come first so that import_content() can check
+        them before it reads the instance. An archived instance is recompressed on the fly
+        """
+        if not self._closed:
+            raise SafTransactionException('Cannot export open transaction')
+        first = [inode for inode in ['meta', 'conf', 'manifest'] if
+                 os.path.exists(os.path.join(self.basedir, inode))]
+        others = sorted([inode for inode in os.listdir(self.basedir) if
+                         inode not in first + ['instance', 'instance.tar.gz']])
+        try:
+            tar = tarfile.open(fileobj=fileobj, mode='w|gz')
+            try:
+                _add_file(tar, self.basedir, self.id)
+                for inode in first + others:
+                    _add_file(tar, os.path.join(self.basedir, inode), '%s/%s' % (self.id, inode))
+                    if os.path.isdir(os.path.join(self.basedir, inode)):
+                        _add_tree(tar, os.path.join(self.basedir, inode),
+                                  '%s/%s' % (self.id, inode))
+                if self.is_archived():
+                    archive_name = os.path.join(self.basedir, 'instance.tar.gz')
+                    tarinfo = tarfile.TarInfo('%s/instance' % self.id)
+                    tarinfo.type = tarfile.DIRTYPE
+                    tarinfo.mode = 0o0755
+                    tarinfo.mtime = os.stat(archive_name).st_mtime
+                    tar.addfile(tarinfo)
+                    instance_tar = tarfile.open(archive_name, 'r|gz')
+                    try:
+                        for tarinfo in _checked_members(
+                                instance_tar, 'archive of transaction %s' % self.id):
+                            data = instance_tar.extractfile(tarinfo) if tarinfo.isreg() else None
+                            tarinfo.name = '%s/instance/%s' % (self.id, tarinfo.name)
+                            tar.addfile(tarinfo, data)
+                    finally:
+                        instance_tar.close()
+                else:
+                    _add_file(tar, os.path.join(self.basedir, 'instance'), '%s/instance' % self.id)
+                    _add_tree(tar, os.path.join(self.basedir, 'instance'),
+                              '%s/instance' % self.id)
+            finally:
+                tar.close()
+        except (IOError, OSError, tarfile.TarError) as e:
+            raise SafTransactionException('Cannot export transaction %s: %s' % (self.id, e))
+
+    @safutils.method_trace
+    def import_content(self, fileobj):
+        """
+        Fill the new transaction with a transaction written by export(), read from fileobj in one
+        pass. The metadata is checked before the instance is read, the files are verified against
+        the exported manifest. The exported meta replaces the meta of this transaction
+        :return: The id of the exported transaction
+        :raises SafTransactionException If the stream is no valid export for this stage
+        """
+        if not self._indoubt:
+            raise SafTransactionException('Persisted transactions are immutable')
+        if len(os.listdir(self._tmp_dir_name)) > 0:
+            raise SafTransactionException('Can only import into an empty transaction')
+
+        source = []
+
+        def exported_members(tar):
+            meta_checked = False
+            for tarinfo in tar:
+                root, name = (tarinfo.name.split('/', 1) + [''])[:2]
+                if len(source) == 0:
+                    source.append(root)
+                if root != source[0]:
+                    raise SafTransactionException(
+                        'Invalid file %s in exported transaction %s' % (tarinfo.name, source[0]))
+                if name == '':
+                    continue
+                if not meta_checked and name not in ['meta', 'conf', 'manifest']:
+                    # meta has been extracted by now
+                    self._check_exported_meta(source[0])
+                    meta_checked = True
+                tarinfo.name = name
+                yield tarinfo
+            if not meta_checked:
+                self._check_exported_meta(source[0] if len(source) > 0 else None)
+
+        try:
+            tar = tarfile.open(fileobj=fileobj, mode='r|gz')
+            try:
+                tar.extractall(self._tmp_dir_name, members=_checked_members(
+                    exported_members(tar), 'exported transaction'))
+            finally:
+                tar.close()
+            for inode in ['instance', 'conf']:
+                if not os.path.exists(os.path.join(self._tmp_dir_name, inode)):
+                    raise SafTransactionException(
+                        'Exported transaction %s is incomplete, %s missing' % (source[0], inode))
+            self._manifest = safutils.tree_manifest(self._tmp_dir_name,
+                                                    exclude=['meta', 'manifest'])
+        except (IOError, OSError, tarfile.TarError) as e:
+            raise SafTransactionException('Cannot import transaction: %s' % e)
+
+        exported_manifest = _read_manifest(os.path.join(self._tmp_dir_name, 'manifest'))
+        if exported_manifest is None:
+            logger.debug('no manifest in exported transaction %s, not verifying' % source[0])
+        else:
+            exported_manifest = dict([(rel_name.encode('utf-8'), entry) for rel_name, entry in
+                                      exported_manifest.items()])
+            for rel_name in sorted(set(exported_manifest.keys() + self._manifest.keys())):
+                if os.path.islink(os.path.join(self._tmp_dir_name, rel_name)):
+                    # may point to a file which differs between hosts
+                    continue
+                exported = exported_manifest.get(rel_name)
+                imported = self._manifest.get(rel_name)
+                if exported is None or imported is None or exported[0] != imported[0] or \
+                        exported[3] != imported[3]:
+                    raise SafTransactionException(
+                        'Exported transaction %s is corrupt, %s does not match its manifest' % (
+                            source[0], rel_name))
+
+        imported = {'import_user': self.meta['create_user'],
+                    'import_time': self.meta['create_time'],
+                    'import_source_id': source[0]}
+        self.meta = safutils.parse_kv_file(os.path.join(self._tmp_dir_name, 'meta'))
+        self.meta.update(imported)
+        os.remove(os.path.join(self._tmp_dir_name, 'meta'))
+        return source[0]
+
     @safutils.method_trace
-    def activate(self):
-        abs_target_path = os.path.join(saf.config['basedir'], 'apps', self.meta['app_name'])
-        logger.debug('abs_target_path:%s' % abs_target_path)
-        if os.path.exists(abs_target_path):
+    def _check_exported_meta(self, source_id):
+        meta_file = os.path.join(self._tmp_dir_name, 'meta')
+        if not os.path.exists(meta_file):
             raise SafTransactionException(
-                'Cannot activate transaction, %s exists' % abs_target_path)
+                'Exported transaction %s is incomplete, meta missing' % source_id)
+        try:
+            meta = safutils.parse_kv_file(meta_file)
+        except SafConfigException as e:
+            raise SafTransactionException('Exported transaction %s: %s' % (source_id, e))
+        for key in ['app_name', 'stage', 'app_version', 'tx_type', 'create_user', 'create_time']:
+            if key not in meta.keys():
+                raise SafTransactionException(
+                    'Exported transaction %s is incomplete, metadata "%s" missing' % (
+                        source_id, key))
+        if meta.get('tx_version') != saf.__txversion__:
+            raise SafTransactionException(
+                'Exported transaction %s has version %s, expected %s' % (
+                    source_id, meta.get('tx_version'), saf.__txversion__))
+        if meta['stage'] != saf.config.get('stage'):
+            raise SafTransactionException(
+                'Exported transaction %s belongs to stage %s, this is stage %s' % (
+                    source_id, meta['stage'], saf.config.get('stage')))
+
+    @safutils.method_trace
+    def stage(self):
+        """
+        Copy the transaction next to the deployed version of its app so that it can be activated
+        by renaming (see _cut_over()). This can be done while the deployed version is running.
+        The instance becomes apps/.versions/<appname>.<txid>, any other file <name> becomes
+        apps/.versions/<appname>.<txid>.<name>. The manifest still describes the staged instance
+        because the copies keep size, permissions and mtime. An archived instance is extracted
+        :return: The staged instance directory
+        """
+        versions_dir = _get_versions_dir()
+        if not os.path.isdir(versions_dir):
+            os.makedirs(versions_dir, mode=0o0755)
+        staged = os.path.join(versions_dir, '%s.%s' % (self.meta['app_name'], self.id))
+        logger.debug('staged:%s' % staged)
+
+        # leftovers of an interrupted deployment
+        _discard_staged(staged)
 
         # copy instance first
-        shutil.copytree(os.path.join(self.basedir, 'instance'), abs_target_path)
+        self.extract_instance(staged)
 
         # copy others
-        # tx/<name> becomes app/<appname>.<name>
+        # tx/<name> becomes <staged>.<name>
         for inode in os.listdir(self.basedir):
             abs_inode = os.path.join(self.basedir, inode)
             logger.debug('abs_inode:%s' % abs_inode)
-            if inode == 'instance':
+            if inode in ['instance', 'instance.tar.gz']:
                 continue
             else:
                 if os.path.isdir(abs_inode):
-                    shutil.copytree(abs_inode, '%s.%s' % (abs_target_path, inode))
+                    safutils.copy_tree(abs_inode, '%s.%s' % (staged, inode))
                 else:
-                    shutil.copy2(abs_inode, '%s.%s' % (abs_target_path, inode))
+                    safutils.copy_files([(abs_inode, '%s.%s' % (staged, inode))])
+        return staged
 
     @safutils.method_trace
-    def delete(self):
+    def delete(self, prune=True, trash=False):
+        """
+        :param prune: Remove the objects which are not used by other transactions anymore from the
+            object store. Callers deleting many transactions should prune once at the end
+        :param trash: Only move the transaction to var/trash (see safutils.move_to_trash()). Its
+            objects can only be pruned after the trash has been emptied
+        """
         if not self._closed:
             raise SafTransactionException('Cannot delete open transaction')
 
         try:
-            shutil.rmtree(self.basedir)
+            if trash:
+                safutils.move_to_trash(self.basedir)
+            else:
+                shutil.rmtree(self.basedir)
         except OSError as e:
             raise SafTransactionException(e)
+        safutils.forget_directory_size(self.basedir)
+        _forget_tx_index_entry(self.id)
+        if prune:
+            safutils.prune_object_store()
 
     def _assert_valid(self):
-        if not os.path.exists(os.path.join(self.basedir, 'instance')):
+        if not os.path.exists(os.path.join(self.basedir, 'instance')) and not self.is_archived():
             raise SafTransactionException('instance missing')
         if not os.path.exists(os.path.join(self.basedir, 'conf')):
             raise SafTransactionException('conf missing')
@@ -243,6 +539,63 @@ class Transaction(safutils.IKnowhow):
         return safutils.ImmutableDict(self._knowhow)
 
 
+@safutils.method_trace
+def _add_file(tar, abs_name, arc_name):
+    """
+    Add the file or directory (without content) abs_name to tar. Files which are hardlinked
+    (e.g. to the same stored object) are stored with their content and not as hardlinks
+    """
+    tar.inodes.clear()
+    tarinfo = tar.gettarinfo(abs_name, arc_name)
+    if tarinfo is None:
+        logger.warn('Not archiving unsupported file type %s' % abs_name)
+    elif tarinfo.isreg():
+        with open(abs_name, 'rb') as data:
+            tar.addfile(tarinfo, data)
+    else:
+        tar.addfile(tarinfo)
+
+
+@safutils.method_trace
+def _add_tree(tar, root, arc_root=None):
+    """
+    Add the content of directory root to tar (see _add_file()), below arc_root if given
+    """
+    # directories are walked top down, so they precede their content as needed for streamed
+    # extraction
+    for dir_name, sub_dirs, file_names in os.walk(root):
+        for name in sorted(sub_dirs) + sorted(file_names):
+            abs_name = os.path.join(dir_name, name)
+            arc_name = os.path.relpath(abs_name, root)
+            if arc_root is not None:
+                arc_name = '%s/%s' % (arc_root, arc_name)
+            _add_file(tar, abs_name, arc_name)
+
+
+def _checked_members(members, source):
+    """
+    Pass on the tar members which can be extracted safely, i.e. files, directories and symlinks
+    which end up below the target directory, neither at nor below an extracted symlink, and which
+    have not been extracted before
+    :param members: TarInfo iterable, e.g. an open TarFile
+    :param source: Describes the archive in error messages
+    :raises SafTransactionException For the first unsafe member
+    """
+    symlinks = set()
+    extracted = set()
+    for tarinfo in members:
+        name = os.path.normpath(tarinfo.name)
+        parts = name.split(os.sep)
+        if os.path.isabs(name) or parts[0] in ['.', '..'] or name in extracted or not (
+                tarinfo.isreg() or tarinfo.isdir() or tarinfo.issym()) or any(
+                [os.sep.join(parts[:i]) in symlinks for i in range(1, len(parts) + 1)]):
+            raise SafTransactionException('Invalid file %s in %s' % (tarinfo.name, source))
+        if tarinfo.issym():
+            symlinks.add(name)
+        extracted.add(name)
+        yield tarinfo
+
+
 @safutils.method_trace
 def get_transaction_ids():
     tx_basedir = os.path.join(saf.config['basedir'], 'transactions')
@@ -253,53 +606,133 @@ def get_transaction_ids():
     return sorted(transaction_ids)
 
 
+def _tx_index_entry(meta, size, archived):
+    # transactions of older saf versions may lack some metadata, '' sorts before any time
+    result = dict([(key, meta.get(key, '')) for key in ['app_name', 'app_version', 'tx_type',
+                                                        'create_time']])
+    result['size'] = size
+    result['archived'] = archived
+    return result
+
+
+def _tx_index():
+    """ The transaction index var/tx.index. It maps transaction ids to the metadata needed to
+    list and look up transactions (see _tx_index_entry()) """
+    return safutils.JsonIndex('tx.index', 1)
+
+
+class _DeployLock(object):
+    """ The lock file var/deploy.lock. Deployments hold it shared from staging a version until
+    the previous version has been moved to its backout transaction. Both are not referenced by
+    apps/<appname> in between. gc() only looks for stale staged versions while it holds the lock
+    exclusively """
+
+    def __init__(self, exclusive=False):
+        """ :param exclusive: Lock exclusively if possible without waiting, see acquired """
+        self._exclusive = exclusive
+        self.acquired = False
+
+    def __enter__(self):
+        self._lock_file = open(os.path.join(saf.config['basedir'], 'var', 'deploy.lock'), 'a')
+        if self._exclusive:
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.acquired = True
+            except IOError as e:
+                if e.errno not in [errno.EAGAIN, errno.EACCES]:
+                    self._lock_file.close()
+                    raise
+                logger.debug('deploy lock held by another process')
+        else:
+            fcntl.flock(self._lock_file, fcntl.LOCK_SH)
+            self.acquired = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._lock_file.close()
+
+
+@safutils.method_trace
+def _forget_tx_index_entry(tx_id):
+    with _tx_index() as index:
+        if tx_id in index.entries.keys():
+            del index.entries[tx_id]
+            index.modified = True
+
+
+@safutils.method_trace
+def get_transaction_index():
+    """
+    Return the index entries of all valid transactions without loading them. The index is
+    maintained by commit() and delete(). Transactions which were added or removed otherwise are
+    found by comparing the index with the transaction directory, only those are read
+    :return: dict of transaction id to dict with app_name, app_version, tx_type, create_time, size
+    """
+    tx_ids = get_transaction_ids()
+    with _tx_index() as index:
+        for tx_id in [tx_id for tx_id in index.entries.keys() if tx_id not in tx_ids]:
+            logger.debug('removing %s from transaction index' % tx_id)
+            del index.entries[tx_id]
+            index.modified = True
+        new_transactions = []
+        for tx_id in [tx_id for tx_id in tx_ids if tx_id not in index.entries.keys()]:
+            logger.debug('adding %s to transaction index' % tx_id)
+            try:
+                new_transactions.append(Transaction(tx_id))
+            except SafTransactionException as e:
+                # not indexed, tried again next time
+                logger.warn(e)
+        sizes = safutils.indexed_directory_sizes([tx.basedir for tx in new_transactions])
+        for tx in new_transactions:
+            index.entries[tx.id] = _tx_index_entry(tx.meta, sizes[tx.basedir], tx.is_archived())
+            index.modified = True
+        result = dict(index.entries)
+    return result
+
+
 @safutils.method_trace
 def get_transactions_by_regex(app_regex):
-    tx_list = []
     try:
         pattern = re.compile('^%s$' % app_regex)
     except sre_constants.error as e:
         raise SafExecutionException('Invalid regular expression: %s' % e)
-    for tx_id in get_transaction_ids():
-        tx = Transaction(tx_id)
-        if re.search(pattern, tx.meta['app_name']):
-            tx_list.append(tx)
+    tx_index = get_transaction_index()
+    tx_list = [Transaction(tx_id) for tx_id in sorted(tx_index.keys()) if
+               re.search(pattern, tx_index[tx_id]['app_name'])]
     logger.debug('tx_list:%s' % tx_list)
     return tx_list
 
 
 @safutils.method_trace
 def get_transactions_by_name(app_name):
-    tx_list = []
-    for tx_id in get_transaction_ids():
-        tx = Transaction(tx_id)
-        if tx.meta['app_name'] == app_name:
-            tx_list.append(tx)
+    tx_index = get_transaction_index()
+    tx_list = [Transaction(tx_id) for tx_id in sorted(tx_index.keys()) if
+               tx_index[tx_id]['app_name'] == app_name]
     logger.debug('tx_list:%s' % tx_list)
     return tx_list
 
 
 @safutils.method_trace
-def ls(app_regex, asjson=False):
+def ls(app_regex, asjson=False, ndjson=False):
     try:
         pattern = re.compile('^%s$' % app_regex)
     except sre_constants.error as e:
         raise SafExecutionException('Invalid regular expression: %s' % e)
 
-    tx_data = dict()
-    for tx_id in get_transaction_ids():
-        try:
-            tx = Transaction(tx_id)
-            if re.search(pattern, tx.meta['app_name']):
-                tx_data[tx_id] = dict()
-                for prop in ['app_name', 'app_version', 'tx_type', 'create_time']:
-                    tx_data[tx_id][prop] = tx.meta[prop]
-                tx_data[tx_id]['size'] = saf.safutils.directory_size(tx.basedir)
-        except SafTransactionException as e:
-            logger.warn(e)
+    output = None
+    if asjson or ndjson:
+        output = safutils.JsonOutput('tx', ndjson=ndjson)
 
-    if asjson:
-        logger.info(tx_data)
+    tx_data = dict()
+    tx_index = get_transaction_index()
+    for tx_id in sorted(tx_index.keys()):
+        if re.search(pattern, tx_index[tx_id]['app_name']):
+            tx_data[tx_id] = tx_index[tx_id]
+            if output is not None:
+                output.add(tx_id, tx_data[tx_id])
+
+    if output is not None:
+        output.close()
     else:
         tx_list = [['ID', 'APP', 'VERSION', 'TYPE', 'TIME', 'SIZE']]
         for tx_id in tx_data.keys():
@@ -314,15 +747,15 @@ def ls(app_regex, asjson=False):
 
 
 @safutils.method_trace
-def info(txid, asjson=False):
-    if asjson:
-        result = dict()
+def info(txid, asjson=False, ndjson=False):
+    if asjson or ndjson:
+        output = safutils.JsonOutput('tx', ndjson=ndjson)
         try:
             tx = Transaction(txid)
-            result[txid] = tx.meta
+            output.add(txid, tx.meta)
         except SafTransactionException as e:
-            result[txid] = str(e)
-        logger.info(result)
+            output.add(txid, {'error': str(e)})
+        output.close()
     else:
         try:
             tx = Transaction(txid)
@@ -342,6 +775,8 @@ def rm(appname_or_txid):
             tx_dir = os.path.join(saf.config['basedir'], 'transactions', specifier)
             logger.info('Removing transaction %s' % specifier)
             shutil.rmtree(tx_dir)
+            safutils.forget_directory_size(tx_dir)
+            _forget_tx_index_entry(specifier)
         else:
             transactions = get_transactions_by_name(specifier)
             if len(transactions) == 0:
@@ -352,31 +787,362 @@ def rm(appname_or_txid):
                     logger.info(
                         'Removing transaction %s (app %s)' % (
                             transaction.id, transaction.meta['app_name']))
-                    transaction.delete()
+                    transaction.delete(prune=False)
+    safutils.prune_object_store()
     return 0
 
 
 @safutils.method_trace
-def _deactivate(app_name):
-    app = saf.app.Application(app_name)
-    if app.is_running():
-        raise SafExecutionException('Cannot deactivate running app %s' % app_name)
+def archive(appname_or_txid, idle=None):
+    """
+    Store transactions as compressed archives
+    :param appname_or_txid: List of transaction ids or app names (no regex)
+    :param idle: Also archive all transactions of type new which were created more than idle days
+        ago
+    """
+    if len(appname_or_txid) == 0 and idle is None:
+        raise SafExecutionException('Specify transactions and/or --idle')
+    transactions = []
+    for specifier in appname_or_txid:
+        if specifier in get_transaction_ids():
+            transactions.append(Transaction(specifier))
+        else:
+            matching = get_transactions_by_name(specifier)
+            if len(matching) == 0:
+                raise SafExecutionException(
+                    'No transaction matching appname or id %s (no regex allowed)' % specifier)
+            transactions.extend(matching)
+    if idle is not None:
+        limit = time.strftime(saf.time_format, time.localtime(time.time() - idle * 86400))
+        tx_index = get_transaction_index()
+        for tx_id in sorted(tx_index.keys()):
+            if tx_index[tx_id]['tx_type'] == 'new' and \
+                    '' < tx_index[tx_id]['create_time'] < limit:
+                transactions.append(Transaction(tx_id))
+
+    archived = set()
+    for transaction in transactions:
+        if transaction.id in archived:
+            continue
+        archived.add(transaction.id)
+        size = safutils.indexed_directory_size(transaction.basedir)
+        if transaction.archive():
+            logger.info('Archived transaction %s (app %s, %s -> %s bytes)' % (
+                transaction.id, transaction.meta['app_name'], size,
+                safutils.indexed_directory_size(transaction.basedir)))
+        else:
+            logger.info('Transaction %s is already archived' % transaction.id)
+    safutils.prune_object_store()
+    return 0
+
+
+@safutils.method_trace
+def export(txid, output=None):
+    """
+    Write a transaction as gzip compressed tar stream (see Transaction.export())
+    :param output: File to write to, stdout if None or '-'
+    """
+    transaction = Transaction(txid)
+    if output is None or output == '-':
+        if sys.stdout.isatty():
+            raise SafExecutionException(
+                'Not writing compressed data to a terminal, redirect stdout or use --output')
+        # stdout carries the data, so there is no info output
+        transaction.export(sys.stdout)
+        sys.stdout.flush()
+        return 0
+    try:
+        with open('%s.tmp' % output, 'wb') as output_file:
+            transaction.export(output_file)
+        os.rename('%s.tmp' % output, output)
+    except (IOError, OSError) as e:
+        raise SafExecutionException('Cannot write %s: %s' % (output, e))
+    finally:
+        if os.path.exists('%s.tmp' % output):
+            os.remove('%s.tmp' % output)
+    logger.info('Exported transaction %s (%s %s) to %s' % (
+        transaction.id, transaction.meta['app_name'], transaction.meta['app_version'], output))
+    return 0
+
+
+@safutils.method_trace
+def import_tx(archive_file=None):
+    """
+    Create a committed transaction from a stream written by export(). Imported backouts are
+    archived like locally created ones (see _archive_backouts())
+    :param archive_file: File to read from, stdin if None or '-'
+    """
+    transaction = Transaction()
+    if archive_file is None or archive_file == '-':
+        if sys.stdin.isatty():
+            raise SafExecutionException(
+                'Not reading compressed data from a terminal, redirect stdin or specify a file')
+        source_id = transaction.import_content(sys.stdin)
+    else:
+        try:
+            input_file = open(archive_file, 'rb')
+        except IOError as e:
+            raise SafExecutionException('Cannot read %s: %s' % (archive_file, e))
+        with input_file:
+            source_id = transaction.import_content(input_file)
+    transaction.commit(
+        archive=transaction.meta['tx_type'] == 'backout' and _archive_backouts())
+    logger.info('Imported transaction %s (%s %s) as %s' % (
+        source_id, transaction.meta['app_name'], transaction.meta['app_version'],
+        transaction.id))
+    return 0
+
+
+@safutils.method_trace
+def _gc_setting(name, value, default):
+    """ :return: value or else tx.gc.<name> of saf.conf or else default, as int >= 0 """
+    if value is None:
+        value = saf.config.get('tx.gc.%s' % name, default)
+    try:
+        value = int(value)
+    except ValueError as e:
+        raise SafConfigException('invalid tx.gc.%s: %s' % (name, e))
+    if value < 0:
+        raise SafConfigException(
+            'invalid tx.gc.%s: must not be negative, found %s' % (name, value))
+    return value
+
+
+@safutils.method_trace
+def _gc_after_deploy():
+    """ Whether tx deploy runs gc() after a successful deployment (tx.gc.after_deploy in saf.conf,
+    default false) """
+    value = saf.config.get('tx.gc.after_deploy', 'false')
+    if value not in ['true', 'false']:
+        raise SafConfigException(
+            'invalid tx.gc.after_deploy: must be true or false, found %s' % value)
+    return value == 'true'
+
+
+@safutils.method_trace
+def _stale_leftovers(max_age, versions=True):
+    """
+    :param max_age: Minimum age in seconds
+    :param versions: Include staged versions which are not deployed. Only safe while no
+        deployment is in progress (see _DeployLock)
+    :return: Entries of the temp dir and staged versions, which have not been created or changed
+        for max_age seconds. Younger ones may still be in use. The ctime is used because staged
+        versions keep the mtime of the transaction
+    """
+    limit = time.time() - max_age
+    apps_dir = os.path.join(saf.config['basedir'], 'apps')
+    versions_dir = _get_versions_dir()
+    deployed = set([os.path.basename(os.path.realpath(os.path.join(apps_dir, inode))) for inode in
+                    os.listdir(apps_dir) if os.path.islink(os.path.join(apps_dir, inode))])
+    candidates = []
+    if os.path.isdir(saf.temp_dir):
+        candidates.extend([os.path.join(saf.temp_dir, inode) for inode in
+                           os.listdir(saf.temp_dir)])
+    if versions and os.path.isdir(versions_dir):
+        candidates.extend([os.path.join(versions_dir, inode) for inode in
+                           os.listdir(versions_dir) if inode not in deployed])
+    result = []
+    for candidate in candidates:
+        try:
+            if os.lstat(candidate).st_ctime < limit:
+                result.append(candidate)
+        except OSError as e:
+            logger.debug('skipping %s: %s' % (candidate, e))
+    return sorted(result)
+
+
+@safutils.method_trace
+def gc(keep=None, max_age=None, max_size=None, dry_run=False):
+    """
+    Remove backout transactions according to the retention policy and leftovers of interrupted
+    saf runs. Transactions of other types are never removed. Removed files are moved to var/trash
+    and deleted in the background
+    :param keep: Number of most recent backouts kept per app. Defaults to tx.gc.keep_backouts of
+        saf.conf or 3
+    :param max_age: Remove backouts older than max_age days, 0 for no limit. Defaults to
+        tx.gc.max_age_days of saf.conf or 0
+    :param max_size: Remove the oldest backouts while all transactions together take more than
+        max_size bytes, 0 for no limit. Defaults to tx.gc.max_size of saf.conf or 0
+    :param dry_run: Only show what would be removed
+    """
+    keep = _gc_setting('keep_backouts', keep, 3)
+    max_age = _gc_setting('max_age_days', max_age, 0)
+    max_size = _gc_setting('max_size', max_size, 0)
+    temp_max_age = _gc_setting('temp_max_age_hours', None, 24)
+
+    tx_index = get_transaction_index()
+    # newest first
+    backouts = sorted([tx_id for tx_id in tx_index.keys() if
+                       tx_index[tx_id]['tx_type'] == 'backout'],
+                      key=lambda tx_id: tx_index[tx_id]['create_time'], reverse=True)
+    to_remove = dict()
+    kept = dict()
+    for tx_id in backouts:
+        app_name = tx_index[tx_id]['app_name']
+        kept[app_name] = kept.get(app_name, 0) + 1
+        if kept[app_name] > keep:
+            to_remove[tx_id] = 'more than %s backouts of %s' % (keep, app_name)
+    if max_age > 0:
+        limit = time.strftime(saf.time_format, time.localtime(time.time() - max_age * 86400))
+        for tx_id in backouts:
+            if tx_id not in to_remove.keys() and '' < tx_index[tx_id]['create_time'] < limit:
+                to_remove[tx_id] = 'older than %s days' % max_age
+    if max_size > 0:
+        total_size = sum([tx_index[tx_id]['size'] for tx_id in tx_index.keys() if
+                          tx_id not in to_remove.keys()])
+        for tx_id in reversed(backouts):
+            if total_size <= max_size:
+                break
+            if tx_id not in to_remove.keys():
+                to_remove[tx_id] = 'transactions larger than %s bytes' % max_size
+                total_size -= tx_index[tx_id]['size']
+
+    action = 'Would remove' if dry_run else 'Removing'
+    failed = 0
+    for tx_id in sorted(to_remove.keys(), key=lambda tx_id: tx_index[tx_id]['create_time']):
+        logger.info('%s transaction %s (app %s, %s, %s bytes): %s' % (
+            action, tx_id, tx_index[tx_id]['app_name'], tx_index[tx_id]['create_time'],
+            tx_index[tx_id]['size'], to_remove[tx_id]))
+        if not dry_run:
+            try:
+                Transaction(tx_id).delete(prune=False, trash=True)
+            except (SafTransactionException, SafExecutionException) as e:
+                # e.g. removed by a concurrent gc
+                logger.warn('Could not remove transaction %s: %s' % (tx_id, e))
+                failed += 1
+
+    with _DeployLock(exclusive=True) as deploy_lock:
+        if not deploy_lock.acquired:
+            logger.info('Deployment in progress, not removing staged versions')
+        leftovers = _stale_leftovers(temp_max_age * 3600, versions=deploy_lock.acquired)
+        for leftover in leftovers:
+            logger.info('%s leftover %s' % (action, leftover[len(saf.config['basedir']) + 1:]))
+            if not dry_run:
+                try:
+                    safutils.move_to_trash(leftover)
+                except OSError as e:
+                    logger.warn('Could not remove leftover %s: %s' % (leftover, e))
+                    failed += 1
+
+    if not dry_run:
+        safutils.empty_trash()
+        safutils.prune_object_store()
+    logger.info('%s transaction(s) and %s leftover(s) %s' % (
+        len(to_remove), len(leftovers), 'to remove' if dry_run else 'removed'))
+    if failed > 0:
+        logger.warn('%s could not be removed' % failed)
+    return 1 if failed > 0 else 0
+
+
+@safutils.method_trace
+def _get_versions_dir():
+    return os.path.join(saf.config['basedir'], 'apps', '.versions')
+
+
+@safutils.method_trace
+def _archive_backouts():
+    """ Whether backout transactions are stored as compressed archives (tx.archive.backout in
+    saf.conf, default true) """
+    value = saf.config.get('tx.archive.backout', 'true')
+    if value not in ['true', 'false']:
+        raise SafConfigException(
+            'invalid tx.archive.backout: must be true or false, found %s' % value)
+    return value == 'true'
+
+
+@safutils.method_trace
+def _create_backout(app_meta, instance_dir, prefix, archive=None):
+    """
+    Move an app instance into a new backout transaction
+    :param app_meta: The meta dict of the app
+    :param instance_dir: The instance directory
+    :param prefix: Files named <prefix>.<name> are moved to the transaction as <name>
+    :param archive: Store the instance as compressed archive. Defaults to _archive_backouts()
+    """
+    # a config error must not happen after the instance has been moved
+    if archive is None:
+        archive = _archive_backouts()
     backout_tx = Transaction()
-    logger.info(
-        'Moving deployed instance of %s to backout transaction %s' % (app_name, backout_tx.id))
+    logger.info('Moving deployed instance of %s to backout transaction %s' % (
+        app_meta['app_name'], backout_tx.id))
 
     for key in ['app_name', 'app_version', 'stage']:
-        backout_tx.meta[key] = app.meta[key]
+        backout_tx.meta[key] = app_meta[key]
     backout_tx.meta['tx_type'] = 'backout'
 
     # TODO: Ugly hack bypassing Transaction class integrity
-    shutil.move(app.basedir, os.path.join(backout_tx._tmp_dir_name, 'instance'))
+    safutils.move(instance_dir, os.path.join(backout_tx._tmp_dir_name, 'instance'))
     # app/<appname>.<name> becomes tx/<name>
-    for inode in glob.glob('%s.*' % app.basedir):
-        target_name = inode[len(app.basedir) + 1:]
+    for inode in glob.glob('%s.*' % prefix):
+        target_name = inode[len(prefix) + 1:]
         logger.debug('mv %s %s' % (inode, os.path.join(backout_tx._tmp_dir_name, target_name)))
-        shutil.move(inode, os.path.join(backout_tx._tmp_dir_name, target_name))
-    backout_tx.commit()
+        safutils.move(inode, os.path.join(backout_tx._tmp_dir_name, target_name))
+    backout_tx.commit(archive=archive)
+
+
+@safutils.method_trace
+def _deactivate(app_name):
+    app = saf.app.Application(app_name)
+    if app.is_running():
+        raise SafExecutionException('Cannot deactivate running app %s' % app_name)
+
+    if os.path.islink(app.basedir):
+        # staged deployment, apps/<appname> points to apps/.versions/<appname>.<txid>
+        _create_backout(app.meta, os.path.realpath(app.basedir), app.basedir)
+        os.remove(app.basedir)
+    else:
+        _create_backout(app.meta, app.basedir, app.basedir)
+    safutils.forget_directory_size(app.basedir)
+
+
+@safutils.method_trace
+def _discard_staged(staged):
+    """ Remove a staged version (see Transaction.stage()) including its other files """
+    for inode in [staged] + glob.glob('%s.*' % staged):
+        if os.path.isdir(inode) and not os.path.islink(inode):
+            shutil.rmtree(inode)
+        elif os.path.lexists(inode):
+            os.remove(inode)
+
+
+@safutils.method_trace
+def _cut_over(app_name, staged):
+    """
+    Make a staged version (see Transaction.stage()) the deployed version of an app. apps/<appname>
+    becomes a symlink to the staged instance and is replaced atomically. The other files of the
+    staged version replace apps/<appname>.<name>. The app must not run
+    :param app_name: The name of the app
+    :param staged: The staged instance directory
+    :return: The instance directory of the previously deployed version or None. Its other files
+        have been moved to <instance directory>.<name>
+    """
+    apps_dir = os.path.join(saf.config['basedir'], 'apps')
+    app_link = os.path.join(apps_dir, app_name)
+
+    previous = None
+    if os.path.islink(app_link):
+        previous = os.path.realpath(app_link)
+    elif os.path.isdir(app_link):
+        # deployed before deployments were staged. A directory cannot be replaced atomically by a
+        # symlink, so it has to be moved away first
+        previous = os.path.join(_get_versions_dir(),
+                                '%s.unstaged-%s' % (app_name, int(time.time())))
+        logger.debug('mv %s %s' % (app_link, previous))
+        os.rename(app_link, previous)
+    if previous is not None:
+        for inode in glob.glob('%s.*' % app_link):
+            logger.debug('mv %s %s.%s' % (inode, previous, inode[len(app_link) + 1:]))
+            os.rename(inode, '%s.%s' % (previous, inode[len(app_link) + 1:]))
+
+    tmp_link = os.path.join(apps_dir, '.%s.link' % app_name)
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(os.path.relpath(staged, apps_dir), tmp_link)
+    os.rename(tmp_link, app_link)
+    for inode in glob.glob('%s.*' % staged):
+        logger.debug('mv %s %s.%s' % (inode, app_link, inode[len(staged) + 1:]))
+        os.rename(inode, '%s.%s' % (app_link, inode[len(staged) + 1:]))
+    return previous
 
 
 @safutils.method_trace
@@ -394,23 +1160,19 @@ def deploy(appname_or_txid, iknow=False):
                     appname_or_txid, ', '.join([tx.id for tx in transactions])))
         else:
             deploy_tx = transactions[0]
+    app_name = deploy_tx.meta['app_name']
+    archive_backout = _archive_backouts()
+    gc_after_deploy = _gc_after_deploy()
 
-    do_deactivate = False
-    if deploy_tx.meta['app_name'] in saf.app.get_app_names(all=True):
-        if saf.app.Application(deploy_tx.meta['app_name']).is_running():
-            raise SafExecutionException(
-                'Cannot deactivate running app %s' % deploy_tx.meta['app_name'])
-        else:
-            do_deactivate = True
+    deployed_app = None
+    if app_name in saf.app.get_app_names(all=True):
+        deployed_app = saf.app.Application(app_name)
 
     safutils.assert_knowhow(deploy_tx, 'knowhow.tx.deploy', iknow)
+    if deployed_app is not None and deployed_app.is_running():
+        safutils.assert_knowhow(deployed_app, 'knowhow.app.stop', iknow)
 
-    if do_deactivate:
-        # move to backout tx if already deployed
-        _deactivate(deploy_tx.meta['app_name'])
-
-    logger.info('Deploying transaction %s (application %s)' % (
-        deploy_tx.id, deploy_tx.meta['app_name']))
+    logger.info('Deploying transaction %s (application %s)' % (deploy_tx.id, app_name))
     deploy_tx.open()
 
     deploy_tx.meta['deploy_user'] = \
@@ -419,123 +1181,315 @@ def deploy(appname_or_txid, iknow=False):
     # deploy_tx.meta['deploy_user'] = subprocess.check_output("logname").rstrip()
     deploy_tx.meta['deploy_time'] = time.strftime(saf.time_format)
     deploy_tx.commit()
-    deploy_tx.activate()
-    app = saf.app.Application(deploy_tx.meta['app_name'])
-    try:
-        logger.info('Starting %s ...' % app.name)
-        app.start(iknow)
-        logger.info('OK')
+
+    with _DeployLock():
+        # the deployed version keeps running while the new version is copied
+        staged = os.path.join(_get_versions_dir(), '%s.%s' % (app_name, deploy_tx.id))
+        app_link = os.path.join(saf.config['basedir'], 'apps', app_name)
+        previous = None
+        cut_over = False
+        try:
+            deploy_tx.stage()
+            if deployed_app is not None and deployed_app.is_running():
+                logger.info('Stopping %s ...' % app_name)
+                deployed_app.stop(True)
+                logger.info('OK')
+            previous = _cut_over(app_name, staged)
+            cut_over = True
+        finally:
+            # the staged version is useless unless apps/<appname> points to it
+            if not cut_over and os.path.realpath(app_link) != staged:
+                logger.debug('discarding staged %s' % staged)
+                _discard_staged(staged)
+
+        app = saf.app.Application(app_name)
+        try:
+            logger.info('Starting %s ...' % app.name)
+            app.start(iknow)
+            logger.info('OK')
+            rc = 0
+        except SafExecutionException as e:
+            logger.info('Failed to start: %s' % e)
+            rc = 1
+
+        # moving the previous version to a backout transaction does not add to the downtime
+        if previous is not None:
+            _create_backout(deployed_app.meta, previous, previous, archive=archive_backout)
+    safutils.update_directory_size(app.basedir)
+
+    if rc == 0:
         logger.info('Removing transaction %s' % deploy_tx.id)
         deploy_tx.delete()
-        return 0
-    except SafExecutionException as e:
-        logger.info('Failed to start: %s' % e)
+        if gc_after_deploy:
+            gc()
+    else:
         logger.info('Preserving transaction %s' % deploy_tx.id)
-        return 1
+    return rc
 
 
 @safutils.method_trace
-def _diff_recursive(left, right, left_alias, right_alias):
-    def check_and_diff(left_file_abs, right_file_abs):
-        if not os.path.exists(right_file_abs):
-            logger.info(
-                'Only in %s: %s\n' % (left_alias, left_file_abs[len(saf.config['basedir']) + 1:]))
-            return
-        if not os.path.exists(left_file_abs):
-            logger.info(
-                'Only in %s: %s\n' % (right_alias, right_file_abs[len(saf.config['basedir']) + 1:]))
-            return
-        if os.path.isdir(left_file_abs):
-            return
-        if not filecmp.cmp(left_file_abs, right_file_abs, shallow=False):
-            if saf.safutils.is_binary(left_file_abs) or saf.safutils.is_binary(right_file_abs):
-                logger.info('--- %s : %s' % (left_alias, left_file_abs[len(left) + 1:]))
-                logger.info('+++ %s : %s' % (right_alias, right_file_abs[len(right) + 1:]))
-                logger.info('(binary files differ)\n')
-            else:
-                # http://stackoverflow.com/questions/977491/comparing-two-txt-files-using-difflib-in-python
-                diff_result = difflib.unified_diff(open(left_file_abs).readlines(),
-                                                   open(right_file_abs).readlines(),
-                                                   fromfile='%s : %s' % (left_alias,
-                                                                         left_file_abs[
-                                                                         len(saf.config[
-                                                                                 'basedir']) + 1:]),
-                                                   tofile='%s : %s' % (right_alias,
-                                                                       right_file_abs[
-                                                                       len(saf.config[
-                                                                               'basedir']) + 1:]),
-                                                   )
-                logger.info(''.join(diff_result))
-
-    if os.path.isfile(left):
-        check_and_diff(left, right)
+def _write_manifest(file_name, manifest):
+    with open('%s.tmp' % file_name, 'w') as manifest_file:
+        json.dump({'version': 1, 'files': manifest}, manifest_file)
+    os.rename('%s.tmp' % file_name, file_name)
+
+
+@safutils.method_trace
+def _read_manifest(file_name):
+    """
+    :return: dict relative file name -> [size, permissions, mtime, sha1] (see
+        safutils.tree_manifest()) or None if there is no usable manifest
+    """
+    try:
+        with open(file_name) as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest.get('version') == 1:
+            return manifest['files']
+        logger.debug('unknown manifest version in %s' % file_name)
+    except (IOError, ValueError, KeyError, AttributeError) as e:
+        logger.debug('no manifest %s: %s' % (file_name, e))
+    return None
+
+
+def _sub_manifest(manifest, inode):
+    """
+    :return: The part of a transaction manifest which describes the file or directory inode of the
+        transaction, relative to inode. None if manifest is None
+    """
+    if manifest is None:
+        return None
+    result = dict()
+    for rel_name, entry in manifest.items():
+        if rel_name == inode:
+            result[''] = entry
+        elif rel_name.startswith(inode + os.sep):
+            result[rel_name[len(inode) + 1:]] = entry
+    return result
+
+
+@safutils.method_trace
+def _tree_files(root, manifest=None, immutable=False):
+    """
+    Describe the files below root (or root itself if it is a file) without reading them
+    :param root: Directory or file name
+    :param manifest: Manifest of root or None. Its hashes are used for files which did not change
+        size, permissions or mtime since the manifest was written
+    :param immutable: root is the instance of a transaction and cannot have changed since its
+        manifest was written, so the tree is not listed at all
+    :return: dict relative file name ('' for a file root) -> [size, permissions, mtime, sha1 or
+        None if unknown]
+    """
+    if manifest is not None and immutable:
+        return dict([(rel_name, list(entry)) for rel_name, entry in manifest.items()])
+    if not os.path.exists(root):
+        return dict()
+    if os.path.isdir(root):
+        file_names = [os.path.join(dir_name, file_name) for dir_name, sub_dirs, dir_files in
+                      os.walk(root) for file_name in dir_files]
     else:
-        # content compare left to right
-        for left_root, left_dirs, left_files in os.walk(left):
-            right_root_abs = os.path.join(right, left_root[len(left) + 1:])
-            # for left_dir in left_dirs:
-            #    left_dir_abs = os.path.join(left_root_abs, left_dir)
-            #    right_dir_abs = os.path.join(right_root_abs, left_dir)
-            #    check_and_diff(left_dir_abs, right_dir_abs)
-            for left_file in left_files:
-                left_file_abs = os.path.join(left_root, left_file)
-                right_file_abs = os.path.join(right_root_abs, left_file)
-                check_and_diff(left_file_abs, right_file_abs)
-
-        # report right-only (content already compared above)
-        for right_root, right_dirs, right_files in os.walk(right):
-            right_root_abs = right_root
-            left_root_abs = os.path.join(left, right_root[len(right) + 1:])
-            # for right_dir in right_dirs:
-            #    right_dir_abs = os.path.join(right_root_abs, right_dir)
-            #    left_dir_abs = os.path.join(left_root_abs, right_dir)
-            #    if not os.path.exists(left_dir_abs):
-            #        check_and_diff(left_dir_abs, right_dir_abs)
-            for right_file in right_files:
-                right_file_abs = os.path.join(right_root_abs, right_file)
-                left_file_abs = os.path.join(left_root_abs, right_file)
-                check_and_diff(left_file_abs, right_file_abs)
+        file_names = [root]
+
+    result = dict()
+    for file_abs in file_names:
+        try:
+            file_stat = os.stat(file_abs)
+        except OSError as e:
+            logger.debug('skipping %s: %s' % (file_abs, e))
+            continue
+        rel_name = os.path.relpath(file_abs, root) if file_abs != root else ''
+        entry = [file_stat.st_size, file_stat.st_mode & 0o7777, int(file_stat.st_mtime), None]
+        if manifest is not None and rel_name in manifest.keys() and \
+                manifest[rel_name][:3] == entry[:3]:
+            entry[3] = manifest[rel_name][3]
+        result[rel_name] = entry
+    return result
+
+
+@safutils.method_trace
+def _diff_recursive(left, right, left_alias, right_alias, left_files=None, right_files=None,
+                    stat_lines=None, left_display=None, right_display=None):
+    """
+    Log the differences between the files below left and right (or files left and right). Files of
+    different size differ, files of the same size are compared by hash. Only files with missing
+    hashes are read (concurrently), only files which differ are opened for the unified diff
+    (see safutils.log_file_diff())
+    :param left_files: See _tree_files(). Collected from left if None
+    :param right_files: See _tree_files(). Collected from right if None
+    :param stat_lines: If not None then nothing is logged and no file is read. Instead a
+        [status, file, left size, right size] line is appended for every difference. Files
+        without hash are compared by size and mtime
+    :param left_display: Name of left in the output if left is a temporary copy
+    :param right_display: Name of right in the output if right is a temporary copy
+    """
+    if left_files is None:
+        left_files = _tree_files(left)
+    if right_files is None:
+        right_files = _tree_files(right)
+
+    def abs_name(root, rel_name):
+        return os.path.join(root, rel_name) if rel_name != '' else root
+
+    def display_name(root, rel_name):
+        if root == left and left_display is not None:
+            root = left_display
+        elif root == right and right_display is not None:
+            root = right_display
+        return abs_name(root, rel_name)[len(saf.config['basedir']) + 1:]
+
+    common = [rel_name for rel_name in left_files.keys() if rel_name in right_files.keys() and
+              left_files[rel_name][0] == right_files[rel_name][0]]
+    if stat_lines is None:
+        to_hash = [abs_name(left, rel_name) for rel_name in common if
+                   left_files[rel_name][3] is None]
+        to_hash += [abs_name(right, rel_name) for rel_name in common if
+                    right_files[rel_name][3] is None]
+        digests = safutils.hash_files(to_hash)
+        for rel_name in common:
+            if left_files[rel_name][3] is None:
+                left_files[rel_name][3] = digests[abs_name(left, rel_name)]
+            if right_files[rel_name][3] is None:
+                right_files[rel_name][3] = digests[abs_name(right, rel_name)]
+
+    for rel_name in sorted(set(left_files.keys()) | set(right_files.keys())):
+        if rel_name not in right_files.keys():
+            if stat_lines is None:
+                logger.info('Only in %s: %s\n' % (left_alias, display_name(left, rel_name)))
+            else:
+                stat_lines.append(['only %s' % left_alias, display_name(left, rel_name),
+                                   left_files[rel_name][0], '-'])
+            continue
+        if rel_name not in left_files.keys():
+            if stat_lines is None:
+                logger.info('Only in %s: %s\n' % (right_alias, display_name(right, rel_name)))
+            else:
+                stat_lines.append(['only %s' % right_alias, display_name(right, rel_name), '-',
+                                   right_files[rel_name][0]])
+            continue
+
+        left_entry = left_files[rel_name]
+        right_entry = right_files[rel_name]
+        if left_entry[0] == right_entry[0]:
+            if left_entry[3] is not None and right_entry[3] is not None:
+                if left_entry[3] == right_entry[3]:
+                    continue
+            elif left_entry[2] == right_entry[2]:
+                continue
+        if stat_lines is not None:
+            stat_lines.append(['changed', display_name(left, rel_name), left_entry[0],
+                               right_entry[0]])
+            continue
+
+        safutils.log_file_diff(abs_name(left, rel_name), abs_name(right, rel_name),
+                               '%s : %s' % (left_alias, display_name(left, rel_name)),
+                               '%s : %s' % (right_alias, display_name(right, rel_name)))
     return 0
 
 
 @safutils.method_trace
-def diff(txid_1, txid_2=None):
+def _tx_inodes(transaction):
+    """ :return: The names of the files and directories of a transaction which are compared """
+    inodes = set(os.listdir(transaction.basedir)) - set(['manifest', 'instance.tar.gz'])
+    if transaction.is_archived():
+        inodes.add('instance')
+    return inodes
+
+
+@safutils.method_trace
+def _tx_inode_files(transaction, inode, manifest, extract_dir, stat):
+    """
+    Describe the file or directory inode of a transaction, extracting an archived instance to
+    extract_dir if its content is needed
+    :return: (root to read the files from, see _tree_files())
+    """
+    root = os.path.join(transaction.basedir, inode)
+    if inode != 'instance':
+        return root, _tree_files(root, _sub_manifest(manifest, inode))
+    if transaction.is_archived():
+        root = os.path.join(extract_dir, transaction.id)
+        if not stat or manifest is None:
+            logger.debug('extracting archived instance to %s' % root)
+            transaction.extract_instance(root)
+    return root, _tree_files(root, _sub_manifest(manifest, inode), immutable=True)
+
+
+@safutils.method_trace
+def diff(txid_1, txid_2=None, stat=False):
+    """
+    Compare a transaction with the deployed version of its app or with another transaction.
+    Archived instances are extracted to a temporary directory unless the manifest is sufficient
+    :param txid_1: The transaction id
+    :param txid_2: The other transaction id or None to compare with the deployed app
+    :param stat: Only list the files which differ along with their sizes, without unified diffs
+    """
+    stat_lines = [] if stat else None
     if txid_2 is None:
         if txid_1 not in get_transaction_ids():
             raise SafExecutionException(
                 'No transaction with id %s' % txid_1)
-        else:
-            transaction = Transaction(txid_1)
-            app_name = transaction.meta['app_name']
-            if app_name not in saf.app.get_all_app_names():
-                raise SafExecutionException('Cannot diff %s. App %s not deployed.' % (
-                    transaction.id, app_name))
-            else:
-                app = saf.app.Application(app_name)
-                _diff_recursive(os.path.join(transaction.basedir, 'instance'), app.basedir,
-                                left_alias=transaction.id, right_alias=app.name)
-                tx_inodes = os.listdir(transaction.basedir)
-                tx_inodes.remove('instance')
-                for tx_inode in tx_inodes:
-                    tx_inode_abs = os.path.join(transaction.basedir, tx_inode)
-                    app_inode_abs = '%s.%s' % (app.basedir, tx_inode)
-                    _diff_recursive(tx_inode_abs, app_inode_abs, left_alias=transaction.id,
-                                    right_alias=app.name)
-                apps_base = os.path.join(saf.config['basedir'], 'apps')
-                app_inodes = glob.glob1(apps_base, '%s.*' % app.name)
-                for app_inode in app_inodes:
-                    app_inode_abs = os.path.join(apps_base, app_inode)
-                    tx_inode_abs = os.path.join(transaction.basedir, app_inode[len(app.name) + 1:])
-                    _diff_recursive(app_inode_abs, tx_inode_abs, left_alias=app.name,
-                                    right_alias=transaction.id)
+        transaction = Transaction(txid_1)
+        app_name = transaction.meta['app_name']
+        if app_name not in saf.app.get_all_app_names():
+            raise SafExecutionException('Cannot diff %s. App %s not deployed.' % (
+                transaction.id, app_name))
+        app = saf.app.Application(app_name)
+        left_alias = transaction.id
+        right_alias = app.name
     else:
         for tx_id in [txid_1, txid_2]:
             if tx_id not in get_transaction_ids():
                 raise SafExecutionException(
                     'No transaction with tx_id %s' % tx_id)
+        transaction = Transaction(txid_1)
+        transaction2 = Transaction(txid_2)
+        left_alias = transaction.id
+        right_alias = transaction2.id
+
+    extract_dir = tempfile.mkdtemp(prefix='diff', dir=saf.temp_dir)
+    try:
+        tx_manifest = _read_manifest(os.path.join(transaction.basedir, 'manifest'))
+        if txid_2 is None:
+            # tx/<name> is deployed as apps/<appname>.<name>, the manifest of the deployed version
+            # is apps/<appname>.manifest
+            app_manifest = _read_manifest('%s.manifest' % app.basedir)
+            inodes = _tx_inodes(transaction)
+            apps_base = os.path.join(saf.config['basedir'], 'apps')
+            inodes.update([app_inode[len(app.name) + 1:] for app_inode in
+                           glob.glob1(apps_base, '%s.*' % app.name)])
+            inodes.discard('manifest')
+            for inode in sorted(inodes):
+                if inode == 'instance':
+                    app_inode_abs = app.basedir
+                else:
+                    app_inode_abs = '%s.%s' % (app.basedir, inode)
+                tx_root, tx_files = _tx_inode_files(transaction, inode, tx_manifest, extract_dir,
+                                                    stat)
+                _diff_recursive(
+                    tx_root, app_inode_abs, left_alias=transaction.id, right_alias=app.name,
+                    left_files=tx_files,
+                    right_files=_tree_files(app_inode_abs, _sub_manifest(app_manifest, inode)),
+                    stat_lines=stat_lines,
+                    left_display=os.path.join(transaction.basedir, inode))
+        else:
+            tx_manifest2 = _read_manifest(os.path.join(transaction2.basedir, 'manifest'))
+            for inode in sorted(_tx_inodes(transaction) | _tx_inodes(transaction2)):
+                left_root, left_files = _tx_inode_files(transaction, inode, tx_manifest,
+                                                        extract_dir, stat)
+                right_root, right_files = _tx_inode_files(transaction2, inode, tx_manifest2,
+                                                          extract_dir, stat)
+                _diff_recursive(
+                    left_root, right_root, left_alias=transaction.id,
+                    right_alias=transaction2.id, left_files=left_files, right_files=right_files,
+                    stat_lines=stat_lines, left_display=os.path.join(transaction.basedir, inode),
+                    right_display=os.path.join(transaction2.basedir, inode))
+    finally:
+        shutil.rmtree(extract_dir)
+
+    if stat_lines is not None:
+        if len(stat_lines) == 0:
+            logger.info('No differences')
         else:
-            transaction1 = Transaction(txid_1)
-            transaction2 = Transaction(txid_2)
-            _diff_recursive(left=transaction1.basedir, right=transaction2.basedir,
-                            left_alias=transaction1.id, right_alias=transaction2.id)
+            for line in saf.safutils.align_columns(
+                    [['STATUS', 'FILE', 'SIZE %s' % left_alias, 'SIZE %s' % right_alias]] +
+                    stat_lines):
+                logger.info(line)
     return 0
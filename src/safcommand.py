@@ -10,9 +10,59 @@ import os
 import subprocess
 import sys
 
+
+def _run_by_agent(argv):
+    """
+    Let a running saf agent (see saf/agent.py) execute the command. This happens before the saf
+    modules are imported because avoiding their import and initialization is the whole point
+    :param argv: The commandline arguments
+    :return: The rc of the command or None if the command has to be executed locally
+    """
+    import json
+    import socket
+
+    socket_name = os.getenv('SAF_AGENT_SOCKET', os.path.join(
+        os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'var', 'saf-agent.sock'))
+    if not os.path.exists(socket_name):
+        return None
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.settimeout(2)
+        client.connect(socket_name)
+        client.sendall('%s\n' % json.dumps({'argv': argv}))
+        client.settimeout(None)
+        stream = client.makefile('r')
+        output_started = False
+        for line in stream:
+            message = json.loads(line)
+            if 'fallback' in message.keys():
+                return None
+            if 'rc' in message.keys():
+                return message['rc']
+            output_started = True
+            # same stdout/stderr split as the IsEqualFilter setup below
+            out = sys.stdout if message['level'] == 20 else sys.stderr
+            out.write('%s\n' % message['msg'].encode('utf-8'))
+            out.flush()
+        if output_started:
+            sys.stderr.write('Connection to saf agent lost\n')
+            return 1
+        return None
+    except (socket.error, ValueError, KeyError):
+        return None
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    _agent_rc = _run_by_agent(sys.argv[1:])
+    if _agent_rc is not None:
+        exit(_agent_rc)
+
 from saf.packages import yaml
 
-import saf, saf.app, saf.repo, saf.tx
+import saf, saf.agent, saf.app, saf.exporter, saf.repo, saf.tx
 
 from saf.exceptions import *
 
@@ -43,6 +93,8 @@ class IsNotEqualFilter(logging.Filter):
 
 asjson = argparse.ArgumentParser(add_help=False)
 asjson.add_argument('-j', '--asjson', action='store_true', help='Produce json formatted output')
+asjson.add_argument('--ndjson', action='store_true',
+                    help='Produce newline delimited json, one record per line as soon as it is available')
 
 iknow = argparse.ArgumentParser(add_help=False)
 iknow.add_argument('--iknow', action='store_true',
@@ -76,22 +128,32 @@ def _populate_app_parser(parent_parser):
 
     p = sub_parser.add_parser('tail', parents=[bootstart, selector],
                               help='Tail logfiles of app(s) to stdout forever',
-                              description='"Tail -f"\'s all files which reside inide the log/ directories of apps to stdout forever (i.e. until Ctrl-C is pressed)')
+                              description='"Tail -f"\'s all files which reside inside the log/ directories of apps to stdout forever (i.e. until Ctrl-C is pressed). Files which are created later (e.g. by log rotation) are followed as well. Lines are prefixed with the app name')
+    p.add_argument('-f', '--filter',
+                   help='Only output lines matching this python regular expression')
     p.set_defaults(func=saf.app.tail)
 
     p = sub_parser.add_parser('start', parents=[bootstart, selector, iknow],
-                              help='Sequentially start app(s)',
-                              description='Start app(s) sequentially one by one. Will abort on the first error it encounters. Trying to start a started app is not considered an error')
+                              help='Start app(s)',
+                              description='Start app(s) sequentially one by one in the order given by their "depends" entries. Will abort on the first error it encounters. Trying to start a started app is not considered an error. With --parallel, independent apps are started concurrently and a summary is shown at the end instead of aborting')
+    p.add_argument('-p', '--parallel', type=int,
+                   help='Start up to PARALLEL apps at the same time. An app waits until the apps listed in its "depends" entry are running. Defaults to app.start.parallel in saf.conf or 1')
     p.set_defaults(func=saf.app.start)
 
     p = sub_parser.add_parser('stop', parents=[bootstart, selector, iknow],
-                              help='Sequentially stop app(s)',
-                              description='Stop app(s) sequentially one by one. Will abort on the first error it encounters. Trying to stop a stopped app is not considered an error')
+                              help='Stop app(s)',
+                              description='Stop app(s) sequentially one by one. Will abort on the first error it encounters. Trying to stop a stopped app is not considered an error. With --bulk all apps are terminated at once and each app is killed after its own timeout.stop, followed by a report of the outcome per app')
+    p.add_argument('--bulk', action='store_true',
+                   help='Terminate all apps at once and wait for them together')
     p.set_defaults(func=saf.app.stop)
 
     p = sub_parser.add_parser('restart', parents=[bootstart, selector, iknow],
                               help='Sequentially restart app(s)',
-                              description='Restart app(s) sequentially one by one. Will abort on the first error it encounters. Trying to stop a stopped app or to start a started app is not considered an error.')
+                              description='Restart app(s) sequentially one by one. Will abort on the first error it encounters. Trying to stop a stopped app or to start a started app is not considered an error. With --rolling N at most N apps are restarted at the same time and the next apps are only restarted once the restarted apps pass their checks')
+    p.add_argument('--rolling', type=int, metavar='N',
+                   help='Restart at most N apps at a time and only continue when the restarted apps pass their checks')
+    p.add_argument('--health_timeout', type=int,
+                   help='With --rolling: seconds to wait for the checks of restarted apps to succeed (default: app.restart.health_timeout of saf.conf or 120)')
     p.set_defaults(func=saf.app.restart)
 
     p = sub_parser.add_parser('status', parents=[bootstart, selector, asjson],
@@ -106,20 +168,39 @@ def _populate_app_parser(parent_parser):
 
     p = sub_parser.add_parser('ps', parents=[selector],
                               help='List processes of (running) apps',
-                              description='List processes of (running) apps. The CPU consumption is an average of used CPU cycles in the last second (100% = 1 CPU fully utilized)')
+                              description='List processes of (running) apps. The CPU consumption is an average of used CPU cycles during the sampling interval (100% = 1 CPU fully utilized)')
+    p.add_argument('-i', '--interval', type=float, default=0.5,
+                   help='Seconds to sample CPU usage')
     p.set_defaults(func=saf.app.ps)
 
+    p = sub_parser.add_parser('top', parents=[selector],
+                              help='Continuously show resource usage per app',
+                              description='Continuously show resource usage of (running) apps, summed over all processes of each app. The CPU consumption is an average of used CPU cycles since the previous refresh (100% = 1 CPU fully utilized). TREND shows the CPU usage of the last refreshes, RSS(CHANGE) the change of memory usage during that time. Stop with Ctrl-C')
+    p.add_argument('-i', '--interval', type=float, default=2.0,
+                   help='Seconds between refreshes (default: 2)')
+    p.add_argument('-n', '--iterations', type=int,
+                   help='Exit after this number of refreshes (default: run until interrupted)')
+    p.add_argument('--history', type=int, default=20,
+                   help='Number of refreshes to show in the trend columns (default: 20)')
+    p.set_defaults(func=saf.app.top)
+
     p = sub_parser.add_parser('pinfo', parents=[asjson],
                               help='Process details of the pid(s) of app',
-                              description='Show detailed information about all the PIDs of an app (output can be quite lengthy)')
+                              description='Show detailed information about all the PIDs of an app. By default only attributes which are cheap to read are shown. Expensive attributes (e.g. open_files, connections, memory_maps, environ, threads) have to be selected with --fields')
     p.add_argument('app_name', help='Name of (running) app')
+    p.add_argument('-f', '--fields',
+                   help='Comma separated list of process attributes to show, "all" for all attributes (output can be quite lengthy)')
+    p.add_argument('--compact', action='store_true',
+                   help='Produce json formatted output on a single line')
     p.set_defaults(func=saf.app.pinfo)
 
-    p = sub_parser.add_parser('check', parents=[bootstart, selector],
+    p = sub_parser.add_parser('check', parents=[bootstart, selector, asjson],
                               help='Query configured checks of app(s)',
-                              description='Query configured checks of app(s) for success literal (case sensitive)')
+                              description='Query configured checks of app(s) for success literal (case sensitive). Checks are queried concurrently, each one limited by its check.<name>.timeout')
     p.add_argument('-d', '--details', action='store_true',
                    help='Output matching places in HTTP response')
+    p.add_argument('-p', '--parallel', type=int,
+                   help='Query up to PARALLEL checks at the same time. Defaults to app.check.parallel in saf.conf or 8')
     p.set_defaults(func=saf.app.check)
 
 
@@ -182,7 +263,8 @@ def _populate_tx_parser(parent_parser):
     p.set_defaults(func=saf.tx.ls)
 
     p = sub_parser.add_parser('deploy', parents=[iknow],
-                              help='Deploy (i.e. activate and start) transaction')
+                              help='Deploy (i.e. activate and start) transaction',
+                              description='Copy the transaction next to the deployed version of the app, stop the app if it is running, switch to the new version and start it. The previous version is moved to a (compressed) backout transaction')
     p.add_argument('appname_or_txid',
                    help='Transaction to deploy either specified by app name or transaction id (no regex allowed)')
     p.set_defaults(func=saf.tx.deploy)
@@ -192,6 +274,25 @@ def _populate_tx_parser(parent_parser):
                    help='One or more transactions either specified by app name(s) or transaction id(s) (no regex allowed)')
     p.set_defaults(func=saf.tx.rm)
 
+    p = sub_parser.add_parser('archive', help='Store transaction(s) as compressed archive',
+                              description='Replace the instance of transactions by a compressed archive. The metadata stays readable, the instance is extracted when the transaction is deployed. Backout transactions are archived when they are created unless tx.archive.backout=false in saf.conf')
+    p.add_argument('appname_or_txid', nargs='*',
+                   help='Transactions either specified by app name(s) or transaction id(s) (no regex allowed)')
+    p.add_argument('--idle', type=int,
+                   help='Also archive all new transactions created more than IDLE days ago')
+    p.set_defaults(func=saf.tx.archive)
+
+    p = sub_parser.add_parser('gc', help='Remove old backout transactions and leftovers',
+                              description='Remove backout transactions according to the retention policy (tx.gc.keep_backouts, tx.gc.max_age_days, tx.gc.max_size in saf.conf) and temporary files and staged versions of interrupted saf runs which are older than tx.gc.temp_max_age_hours. Other transactions are never removed. Files are moved to var/trash and deleted in the background')
+    p.add_argument('--keep', type=int,
+                   help='Number of most recent backouts to keep per app (default: tx.gc.keep_backouts or 3)')
+    p.add_argument('--max_age', type=int,
+                   help='Remove backouts older than MAX_AGE days, 0 for no limit (default: tx.gc.max_age_days or 0)')
+    p.add_argument('--max_size', type=int,
+                   help='Remove the oldest backouts while all transactions take more than MAX_SIZE bytes, 0 for no limit (default: tx.gc.max_size or 0)')
+    p.add_argument('--dry_run', action='store_true', help='Only show what would be removed')
+    p.set_defaults(func=saf.tx.gc)
+
     p = sub_parser.add_parser('info', parents=[asjson], help='Detailed info about a transaction')
     p.add_argument('txid', help='A transaction id (no regex allowed)')
     p.set_defaults(func=saf.tx.info)
@@ -201,10 +302,21 @@ def _populate_tx_parser(parent_parser):
     p.add_argument('txid_1', help='Transaction to compare')
     p.add_argument('txid_2', nargs='?',
                    help='Compare txid_1 with txid_2. If not specified then diff txid_1 with deployed app')
+    p.add_argument('--stat', action='store_true',
+                   help='Only list the files which differ, without reading their content')
     p.set_defaults(func=saf.tx.diff)
 
-    # export tar
-    # import tar
+    p = sub_parser.add_parser('export', help='Write transaction as compressed tar stream',
+                              description='Write a transaction including its meta and conf as gzip compressed tar stream to stdout or to a file. It can be imported on other hosts of the same stage using "tx import", e.g. saf tx export <txid> | ssh <host> saf tx import')
+    p.add_argument('txid', help='Transaction id')
+    p.add_argument('-o', '--output', help='Write to OUTPUT instead of stdout')
+    p.set_defaults(func=saf.tx.export)
+
+    p = sub_parser.add_parser('import', help='Create transaction from exported tar stream',
+                              description='Create a new transaction from a stream written by "tx export". The stream is read in one pass, its files are verified against the exported manifest. The transaction gets a new id and keeps the exported metadata')
+    p.add_argument('archive_file', nargs='?',
+                   help='File written by "tx export" (default: read from stdin)')
+    p.set_defaults(func=saf.tx.import_tx)
 
 
 def init_parser():
@@ -257,9 +369,96 @@ def init_parser():
     p.add_argument('literal', help='The literal to decrypt (must start with "{ENC}")')
     p.set_defaults(func=saf.safutils.decrypt)
 
+    p = root_parsers.add_parser('agent',
+                                help='Run the saf agent in the foreground',
+                                description='Keep configuration, app metadata and process state in memory and answer read-only app and tx commands (ls, status, ps, pinfo, check, info, diff) over a unix socket. While the agent runs, the saf command forwards these commands to it. All other commands are always executed directly')
+    p.add_argument('--socket_name',
+                   help='Unix socket to listen on. Defaults to $SAF_AGENT_SOCKET or var/saf-agent.sock in the SAF basedir')
+    p.set_defaults(func=_serve_agent)
+
+    p = root_parsers.add_parser('exporter',
+                                help='Serve app metrics for Prometheus in the foreground',
+                                description='Serve state, resource usage and check results of all apps in the Prometheus text format on http://<address>:<port>/metrics. The values are refreshed in the background and cached between scrapes')
+    p.add_argument('--address', default='127.0.0.1',
+                   help='Address to listen on (default: 127.0.0.1)')
+    p.add_argument('--port', type=int,
+                   help='Port to listen on (default: exporter.port of saf.conf or 9561)')
+    p.add_argument('--interval', type=float,
+                   help='Seconds between refreshes of the process metrics (default: exporter.interval of saf.conf or 15)')
+    p.add_argument('--check_interval', type=float,
+                   help='Seconds between runs of the app checks (default: exporter.check_interval of saf.conf or 60)')
+    p.set_defaults(func=saf.exporter.serve)
+
     return parser
 
 
+def config_file_name(args):
+    conf_file = args.config
+    if conf_file[0] != '/':
+        conf_file = os.path.join(saf.base_path, conf_file)
+    return conf_file
+
+
+def build_arg_list(args):
+    """ Turn parsed args into the keyword arguments for args.func """
+    # http://stackoverflow.com/questions/16878315/what-is-the-right-way-to-treat-python-argparse-namespace-as-a-dictionary#16878364
+    # http://stackoverflow.com/questions/2465921/how-to-copy-a-dictionary-and-only-edit-the-copy#2465932
+    arg_list = dict(vars(args))
+    logger.debug('raw arg_list:%s' % arg_list)
+    if arg_list['object'] == 'app':
+        if arg_list['action'] == 'ls' or arg_list['action'] == 'status':
+            if arg_list['app_regex'] is None and arg_list['bootstart'] is False:
+                arg_list['all'] = True
+        elif arg_list['action'] == 'ps' or arg_list['action'] == 'top':
+            if arg_list['app_regex'] is None:
+                arg_list['all'] = True
+        del arg_list['action']
+    if arg_list['object'] == 'repo':
+        del arg_list['action']
+    if arg_list['object'] == 'tx':
+        del arg_list['action']
+
+    del arg_list['config']
+    del arg_list['debug']
+    del arg_list['func']
+    del arg_list['object']
+
+    logger.debug('filtered arg_list:%s' % arg_list)
+    return arg_list
+
+
+def parse_command(argv):
+    args = init_parser().parse_args(argv)
+    return args, build_arg_list(args)
+
+
+def execute_command(args, arg_list):
+    rc = 0
+    try:
+        # http://stackoverflow.com/questions/334655/passing-a-dictionary-to-a-function-in-python-as-keyword-parameters
+        rc = args.func(**arg_list)
+    except SafTransactionException as e:
+        logger.error('Transaction error: %s' % e)
+        rc = 1
+    except SafExecutionException as e:
+        logger.error('Execution error: %s' % e)
+        rc = 1
+    except SafConfigException as e:
+        logger.error('Configuration error: %s' % e)
+        rc = 1
+    except SafRepositoryException as e:
+        logger.error('Repository error: %s' % e)
+        rc = 1
+    except KeyboardInterrupt as e:
+        logger.debug(e)
+    return rc
+
+
+def _serve_agent(socket_name=None):
+    return saf.agent.serve(saf.config_file, parse_command, execute_command, config_file_name,
+                           socket_name)
+
+
 if __name__ == '__main__':
 
     with open(os.path.join(saf.base_path, 'lib/logging.yaml')) as data_file:
@@ -302,56 +501,12 @@ if __name__ == '__main__':
 
     rc = 0  # master rc
     try:
-        conf_file = args.config
-        if conf_file[0] != '/':
-            conf_file = os.path.join(saf.base_path, conf_file)
-        saf.init(conf_file)
-
-        # http://stackoverflow.com/questions/16878315/what-is-the-right-way-to-treat-python-argparse-namespace-as-a-dictionary#16878364
-        # http://stackoverflow.com/questions/2465921/how-to-copy-a-dictionary-and-only-edit-the-copy#2465932
-        arg_list = dict(vars(args))
-        logger.debug('raw arg_list:%s' % arg_list)
-        if arg_list['object'] == 'app':
-            if arg_list['action'] == 'ls' or arg_list['action'] == 'status':
-                if arg_list['app_regex'] is None and arg_list['bootstart'] is False:
-                    arg_list['all'] = True
-            elif arg_list['action'] == 'ps':
-                if arg_list['app_regex'] is None:
-                    arg_list['all'] = True
-            del arg_list['action']
-        if arg_list['object'] == 'repo':
-            del arg_list['action']
-        if arg_list['object'] == 'tx':
-            del arg_list['action']
-
-        del arg_list['config']
-        del arg_list['debug']
-        del arg_list['func']
-        del arg_list['object']
-
-        logger.debug('filtered arg_list:%s' % arg_list)
-
+        saf.init(config_file_name(args))
+        arg_list = build_arg_list(args)
+        rc = execute_command(args, arg_list)
     except SafInitException as e:
         logger.error('Error while initializing SAF: %s' % e)
         rc = 1
 
-    try:
-        # http://stackoverflow.com/questions/334655/passing-a-dictionary-to-a-function-in-python-as-keyword-parameters
-        rc = args.func(**arg_list)
-    except SafTransactionException as e:
-        logger.error('Transaction error: %s' % e)
-        rc = 1
-    except SafExecutionException as e:
-        logger.error('Execution error: %s' % e)
-        rc = 1
-    except SafConfigException as e:
-        logger.error('Configuration error: %s' % e)
-        rc = 1
-    except SafRepositoryException as e:
-        logger.error('Repository error: %s' % e)
-        rc = 1
-    except KeyboardInterrupt as e:
-        logger.debug(e)
-
     logger.debug('exiting with rc %s' % rc)
     exit(rc)
\ No newline at end of file